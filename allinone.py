@@ -17,12 +17,13 @@ def adb_create_remote_folder(remote_path):
 
 def check_all_files_processed_with_retry(conn, max_retries=3):
     """檢查是否所有文件都已處理 - 重試版本"""
+    if scan_in_progress.is_set() or folder_watcher.active:
+        # 掃描仍在寫入新文件，或資料夾監看中持續有新文件
+        return False
     for attempt in range(max_retries):
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM files WHERE status IN ('pending', 'processing')")
-            unfinished_count = cur.fetchone()[0]
-            if unfinished_count == 0:
+            unfinished_count = count_files_with_status(conn, ('pending', 'processing'))
+            if unfinished_count == 0 and next_retry_time(conn) is None:
                 return True
             if attempt < max_retries - 1:
                 time.sleep(0.2)
@@ -32,16 +33,27 @@ def check_all_files_processed_with_retry(conn, max_retries=3):
                 time.sleep(0.5)
 import re
 import os
+import shlex
+import shutil
+import tempfile
+import sys
 import sqlite3
 import subprocess
 import threading
 import time
-from collections import deque
+from collections import deque, OrderedDict
+import itertools
 from datetime import datetime
 import hashlib
-from queue import Queue  # Add this import
-
-from rich.progress import Progress, TextColumn, BarColumn, TimeElapsedColumn, TimeRemainingColumn
+import math
+import mmap
+import struct
+import cProfile
+import pstats
+from queue import Queue, Empty, Full  # Add this import
+
+from rich.progress import (Progress, TextColumn, BarColumn, TimeElapsedColumn, TimeRemainingColumn,
+                           DownloadColumn, TransferSpeedColumn)
 from rich.console import Console
 
 import matplotlib.patches as patches
@@ -54,15 +66,28 @@ from tkinter import filedialog
 import tkinter.messagebox as msgbox
 from matplotlib import rcParams
 
+from fastwalk import FastWalker
+# 與 allinonecmd 共用；split_file_path 的拆分規則需與 _dir_prefix_sql 一致
+from compactpaths import split_file_path, get_status_counts, STATUS_COUNTS_SQL
+
 
 # 嘗試導入 rich 模塊
 try:
-    from rich.progress import Progress, TextColumn, BarColumn, TimeElapsedColumn, TimeRemainingColumn
+    from rich.progress import (Progress, TextColumn, BarColumn, TimeElapsedColumn, TimeRemainingColumn,
+                               DownloadColumn, TransferSpeedColumn)
     from rich.console import Console
     RICH_AVAILABLE = True
 except ImportError:
     RICH_AVAILABLE = False
 
+# 嘗試導入 watchdog 模塊（資料夾監看用系統事件，否則改為輪詢）
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+
 # 統一的日誌函數
 
 
@@ -92,6 +117,7 @@ rcParams['axes.unicode_minus'] = False
 # 參數與全局變數
 DB_PATH = "filetransfer_new.db"
 REMOTE_ROOT = "/sdcard/ToProcess"
+PARTIAL_ROOT = f"{REMOTE_ROOT}/.partial"   # 大文件續傳暫存（不隨批次資料夾搬移）
 CAMERA_ROOT = "/sdcard/DCIM/Camera"
 BATCH_PREFIX = "batch_"
 
@@ -114,7 +140,33 @@ params = {
     'duplicate_handling': 'smart',
     'hash_small_files_only': True,
     'small_file_threshold': 50 * 1024 * 1024,
-    'max_rounds': 9999
+    'max_rounds': 9999,
+    'resumable_push_threshold': 256 * 1024 * 1024,  # 超過此大小改用可續傳推送
+    'resumable_verify_md5': False,       # 續傳完成後比對遠端 md5（需再讀一次本地文件）
+    'cost_aware_batching': True,         # 依學習到的各類型處理成本限制每批處理時間
+    'batch_process_target_minutes': 0,   # 每批預估處理時間上限，0 為自動（等於推送一批的預估時間）
+    'idle_detector': 'cusum',            # 備份完成判定: cusum（EWMA + 變點偵測）/ legacy（連續穩定秒數）
+    'idle_ewma_alpha': 0.2,              # EWMA 平滑係數
+    'idle_hysteresis': 0.2,              # 活躍/閒置切換的遲滯帶（門檻的 ±20%）
+    'idle_confidence': 0.95,             # 變點判定信心（越高需要越多閒置證據）
+    'idle_min_seconds': 30,              # 閒置需維持的秒數（孤立尖峰不中斷計時）
+    'device_poll_interval': 3,           # adb get-state 輪詢間隔（秒）
+    'retry_max_attempts': 6,             # 單一文件推送失敗的最多重試次數
+    'retry_base_delay': 30,              # 重試退避起始秒數，每次失敗加倍
+    'retry_max_delay': 1800,             # 重試退避上限秒數
+    'breaker_failure_threshold': 5,      # 裝置在線時連續推送失敗達此數即斷路
+    'breaker_reset_seconds': 60,         # 斷路後多久放行一次試探推送
+    'cpu_trace_path': None,              # 設定後將每個 CPU 樣本及等待開始標記追加寫入此 CSV
+    'telemetry_path': None,              # 遙測環形檔，None 為數據庫同名 .telemetry
+    'staging_mode': 'network',           # 本地暫存預讀: network（僅網路來源）/ all / off
+    'staging_max_gb': 20,                # 本地暫存上限
+    'staging_dir': None,                 # 暫存目錄，None 為系統暫存目錄下 filetransfer_staging
+    'archive_min_completed': 10000,      # 至少這麼多 completed 才歸檔
+    'archive_batch_days': 7,             # 結束超過此天數的批次歷史才歸檔
+    'maintenance_interval_hours': 24,    # 歸檔 / ANALYZE / VACUUM 的排程間隔
+    'watch_poll_interval': 30,           # 資料夾監看的輪詢間隔（無 watchdog 時）
+    'watch_settle_seconds': 10,          # 文件大小與修改時間需維持不變的秒數，才視為寫入完成
+    'profile_seconds': 300,              # --profile / ALLINONE_PROFILE 的剖析窗口（秒）
 }
 
 # 控制旗標與狀態
@@ -124,7 +176,236 @@ batch_in_process = False
 operation_lock = threading.Lock()
 
 
+# /////////////////////////////////////////////////////////////////////////////
+# 事件驅動等待
+# CPU 閒置轉換、佇列放入/取出、掃描寫入、批次釋放與停止請求都會 notify_pipeline()，
+# 排程線程以 wait_pipeline() 阻塞等待條件成立，不再固定間隔輪詢。
+pipeline_condition = threading.Condition()
+_pipeline_generation = 0
+
+# 執行中的 adb 推送進程（停止時立即終止）
+active_adb_processes = set()
+active_adb_lock = threading.Lock()
+
+
+def notify_pipeline():
+    """喚醒所有等待中的排程線程"""
+    global _pipeline_generation
+    with pipeline_condition:
+        _pipeline_generation += 1
+        pipeline_condition.notify_all()
+
+
+def wait_pipeline(predicate=None, timeout=None):
+    """阻塞至 predicate() 成立（未指定時為任一通知）、停止請求或逾時，回傳是否仍在處理"""
+    if thread_profiler is not None:
+        thread_profiler.checkpoint()
+    with pipeline_condition:
+        start_generation = _pipeline_generation
+        if predicate is None:
+            predicate = lambda: _pipeline_generation != start_generation
+        pipeline_condition.wait_for(lambda: not batch_processing or predicate(), timeout)
+    return batch_processing
+
+
+def pipeline_sleep(seconds):
+    """可被停止請求立即中斷的休眠"""
+    return wait_pipeline(lambda: False, seconds)
+
+
+def terminate_active_adb_processes():
+    """終止所有執行中的 adb 推送進程"""
+    with active_adb_lock:
+        processes = list(active_adb_processes)
+    for process in processes:
+        try:
+            process.terminate()
+        except OSError:
+            pass
+
 
+# /////////////////////////////////////////////////////////////////////////////
+# 選用的線程效能剖析
+# 傳輸邏輯在多個 daemon 線程中執行，主線程的 cProfile 看不到這些線程。以環境變數
+# ALLINONE_PROFILE 或命令列 --profile 啟用（格式 模式[:秒數]）:
+#   sample    每 10ms 以 sys._current_frames() 取樣所有線程的堆疊，輸出各線程統計與
+#             collapsed stacks（flamegraph.pl / speedscope 可直接讀取）
+#   cprofile  每個工作線程各自一個 cProfile，輸出 .prof（pstats / snakeviz）與文字統計；
+#             Python 3.12 起 cProfile 改用全行程唯一的 sys.monitoring，無法每線程各一個，改用 sample
+# 剖析窗口自第一個工作線程啟動起算（預設 profile_seconds 秒），結果寫入 profile_<時間>/。
+# 未啟用時 thread_profiler 為 None: 線程目標不包裝、不啟動取樣線程。
+PROFILE_SAMPLE_INTERVAL = 0.01
+PROFILE_MODES = ('sample', 'cprofile')
+
+thread_profiler = None
+
+
+def parse_profile_setting(argv=None, environ=None):
+    """讀取 --profile 模式[:秒數] 或 ALLINONE_PROFILE，回傳 (模式, 秒數或 None)；未啟用回傳 (None, None)"""
+    argv = sys.argv if argv is None else argv
+    environ = os.environ if environ is None else environ
+    value = environ.get('ALLINONE_PROFILE', '')
+    for index, arg in enumerate(argv):
+        if arg == '--profile':
+            value = argv[index + 1] if index + 1 < len(argv) and not argv[index + 1].startswith('--') else 'sample'
+        elif arg.startswith('--profile='):
+            value = arg.split('=', 1)[1]
+    mode, _, seconds = value.strip().lower().partition(':')
+    if not mode:
+        return None, None
+    if mode not in PROFILE_MODES:
+        log(f"[剖析] 未知模式 {mode}，可用: {', '.join(PROFILE_MODES)}")
+        return None, None
+    if not seconds:
+        return mode, None
+    try:
+        duration = float(seconds)
+    except ValueError:
+        duration = 0
+    if not 0 < duration < float('inf'):
+        log(f"[剖析] 無效的秒數 {seconds!r}，改用 profile_seconds")
+        return mode, None
+    return mode, duration
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ThreadProfiler:
+    """工作線程剖析: sample 模式由取樣線程記錄堆疊；cprofile 模式各線程在共同窗口內啟用 cProfile
+
+    窗口自第一個工作線程啟動起算 seconds 秒，兩種模式相同；之後才啟動的線程只剖析窗口剩餘部分。
+    """
+
+    def __init__(self, mode, seconds=None, output_dir=None):
+        if mode == 'cprofile' and sys.version_info >= (3, 12):
+            log("[剖析] Python 3.12 起同時只能有一個 cProfile，無法逐線程剖析，改用 sample 模式")
+            mode = 'sample'
+        self.mode = mode
+        self.seconds = seconds or params.get('profile_seconds', 300)
+        self.output_dir = output_dir or f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.deadline = None
+        self.stop_event = threading.Event()
+        self.sampler = None
+        # sample 模式的累計（僅取樣線程寫入）
+        self.stacks = {}          # "線程;外層;...;內層" -> 樣本數
+        self.thread_samples = {}  # 線程 -> 樣本數
+        self.self_counts = {}     # 線程 -> {最內層函數: 樣本數}
+        self.total_counts = {}    # 線程 -> {堆疊中任一層的函數: 樣本數}
+
+    def wrap(self, target, name):
+        """包裝線程目標: 設定線程名稱；第一個工作線程啟動時開始剖析窗口"""
+        def run(*args, **kwargs):
+            threading.current_thread().name = name
+            self._start_window()
+            if self.mode != 'cprofile' or time.time() >= self.deadline:
+                return target(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # 已有其他剖析工具啟用: 線程照常執行，只是不剖析
+                log(f"[剖析] {name}: 無法啟用 cProfile（{e}），不剖析此線程")
+                return target(*args, **kwargs)
+            self.local.profile = profile
+            try:
+                return target(*args, **kwargs)
+            finally:
+                self._finish_thread_profile()
+        return run
+
+    def _start_window(self):
+        with self.lock:
+            if self.deadline is not None:
+                return
+            self.deadline = time.time() + self.seconds
+            os.makedirs(self.output_dir, exist_ok=True)
+            log(f"[剖析] {self.mode} 模式 {self.seconds:.0f} 秒，結果寫入 {os.path.abspath(self.output_dir)}")
+            if self.mode == 'sample':
+                self.sampler = threading.Thread(target=self._sample_worker, name='profile_sampler', daemon=True)
+                self.sampler.start()
+
+    def checkpoint(self):
+        """cprofile 模式: 由線程自己在等待點檢查窗口是否結束（cProfile 只能由所屬線程停止）"""
+        if getattr(self.local, 'profile', None) is not None and time.time() >= self.deadline:
+            self._finish_thread_profile()
+
+    def _finish_thread_profile(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self.local.profile = None
+        thread = threading.current_thread()
+        base = os.path.join(self.output_dir, f"{thread.name}_{thread.ident}")
+        try:
+            profile.dump_stats(base + '.prof')
+            with open(base + '.txt', 'w', encoding='utf-8') as f:
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(40)
+                stats.sort_stats('tottime').print_stats(20)
+            log(f"[剖析] {thread.name}: 已寫入 {base}.prof")
+        except OSError as e:
+            log(f"[剖析] 寫入 {base} 失敗: {e}")
+
+    def _sample_worker(self):
+        own = threading.get_ident()
+        while not self.stop_event.is_set() and time.time() < self.deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, str(ident))
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.reverse()
+                key = ';'.join([name] + labels)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.thread_samples[name] = self.thread_samples.get(name, 0) + 1
+                if labels:
+                    self_counts = self.self_counts.setdefault(name, {})
+                    self_counts[labels[-1]] = self_counts.get(labels[-1], 0) + 1
+                    total_counts = self.total_counts.setdefault(name, {})
+                    for label in set(labels):
+                        total_counts[label] = total_counts.get(label, 0) + 1
+            self.stop_event.wait(PROFILE_SAMPLE_INTERVAL)
+        self._dump_samples()
+
+    def _dump_samples(self):
+        try:
+            with open(os.path.join(self.output_dir, 'collapsed_stacks.txt'), 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            with open(os.path.join(self.output_dir, 'thread_stats.txt'), 'w', encoding='utf-8') as f:
+                for name, samples in sorted(self.thread_samples.items(), key=lambda item: -item[1]):
+                    f.write(f"=== {name}: {samples} 樣本（約 {samples * PROFILE_SAMPLE_INTERVAL:.1f} 秒）\n")
+                    for title, counts in (('自身', self.self_counts.get(name, {})),
+                                          ('含子呼叫', self.total_counts.get(name, {}))):
+                        f.write(f"  -- {title}\n")
+                        for label, count in sorted(counts.items(), key=lambda item: -item[1])[:15]:
+                            f.write(f"  {count / samples * 100:6.1f}%  {label}\n")
+                    f.write("\n")
+            log(f"[剖析] 取樣結束: {sum(self.thread_samples.values())} 個樣本，"
+                f"已寫入 {os.path.join(self.output_dir, 'collapsed_stacks.txt')}")
+        except OSError as e:
+            log(f"[剖析] 寫入取樣結果失敗: {e}")
+
+    def stop(self):
+        """程式結束: 提早結束取樣窗口並寫出結果"""
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join(timeout=5)
+
+
+def profiled(target, name):
+    """工作線程目標: 啟用剖析時包裝，否則原樣回傳"""
+    return thread_profiler.wrap(target, name) if thread_profiler is not None else target
 
 
 # /////////////////////////////////////////////////////////////////////////////
@@ -149,8 +430,9 @@ class UIStateManager:
                 return False, f"請等待 {min_interval:.1f} 秒後再試"
 
             # 檢查狀態衝突
+            # 掃描為串流寫入，掃描中允許開始傳輸
             if action == 'start_transfer':
-                if self.current_state in ['processing', 'scanning']:
+                if self.current_state == 'processing':
                     return False, f"當前狀態 '{self.current_state}' 不允許開始傳輸"
 
             elif action == 'scan_folder':
@@ -173,6 +455,10 @@ class UIStateManager:
             log(f"[狀態變更] {old_state} -> {new_state}")
             self.update_ui_for_state()
 
+    def set_idle_state(self):
+        """處理結束後恢復狀態（掃描仍在進行則回到 scanning）"""
+        self.set_state('scanning' if scan_in_progress.is_set() else 'idle')
+
     def get_state(self):
         """獲取當前狀態"""
         with self.state_lock:
@@ -194,7 +480,7 @@ class UIStateManager:
                 'refresh_button': {'color': 'lightgray', 'enabled': False}
             },
             'scanning': {
-                'start_button': {'text': '開始傳輸', 'color': 'lightgray', 'enabled': False},
+                'start_button': {'text': '開始傳輸', 'color': 'lightgreen', 'enabled': True},
                 'scan_button': {'text': '掃描中...', 'color': 'orange', 'enabled': False},
                 'stop_button': {'text': '停止傳輸', 'color': 'lightgray', 'enabled': False},
                 'refresh_button': {'color': 'lightgray', 'enabled': False}
@@ -256,6 +542,12 @@ def fix_existing_database():
         conn = sqlite3.connect(DB_PATH)
         cur = conn.cursor()
 
+        # 緊湊路徑結構的 files 是視圖，欄位由 file_entries 保證
+        if get_files_object_type(cur) != 'table':
+            conn.close()
+            log("[修復] 數據庫已使用緊湊路徑結構，無需修復")
+            return
+
         # 添加缺失的列
         columns_to_add = ['push_time', 'completed_time', 'file_hash']
 
@@ -276,36 +568,205 @@ def fix_existing_database():
         log(f"[錯誤] 數據庫修復失敗: {e}")
 
 
+# /////////////////////////////////////////////////////////////////////////////
+# 緊湊路徑結構
+# 目錄前綴只在 dirs 表存一次（含結尾分隔符），file_entries 只存 (dir_id, name)。
+# files 視圖重組完整路徑並以 INSTEAD OF 觸發器轉寫，保持既有查詢可用；
+# 熱路徑（掃描、推送狀態更新）直接操作 file_entries。
+
+def _dir_prefix_sql(path_expr):
+    """SQL 表達式: 取路徑最後一個分隔符（/ 或 \\）之前的前綴（含分隔符）"""
+    return f"rtrim({path_expr}, replace(replace({path_expr}, '/', ''), '\\', ''))"
+
+
+COMPACT_PATH_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS dirs (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS file_entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dir_id INTEGER NOT NULL REFERENCES dirs(id),
+        name TEXT NOT NULL,
+        size INTEGER,
+        mtime INTEGER,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'pushed', 'completed', 'failed')),
+        file_hash TEXT NULL,
+        push_time TEXT NULL,
+        completed_time TEXT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        media_type TEXT NULL,
+        attempts INTEGER DEFAULT 0,
+        retry_after REAL NULL,
+        UNIQUE(dir_id, name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS excluded_files (
+        dir_id INTEGER NOT NULL REFERENCES dirs(id),
+        name TEXT NOT NULL,
+        size INTEGER,
+        mtime INTEGER,
+        reason TEXT,
+        detected_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (dir_id, name)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE VIEW IF NOT EXISTS files AS
+    SELECT e.id, d.path || e.name AS path, e.size, e.mtime, e.status, e.file_hash,
+           e.push_time, e.completed_time, e.created_at, e.updated_at
+    FROM file_entries e JOIN dirs d ON d.id = e.dir_id
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_files_view_insert
+    INSTEAD OF INSERT ON files
+    BEGIN
+        INSERT OR IGNORE INTO dirs (path) VALUES ({_dir_prefix_sql('NEW.path')});
+        INSERT INTO file_entries (dir_id, name, size, mtime, status, file_hash,
+                                  push_time, completed_time, created_at, updated_at)
+        VALUES ((SELECT id FROM dirs WHERE path = {_dir_prefix_sql('NEW.path')}),
+                substr(NEW.path, length({_dir_prefix_sql('NEW.path')}) + 1),
+                NEW.size, NEW.mtime, COALESCE(NEW.status, 'pending'), NEW.file_hash,
+                NEW.push_time, NEW.completed_time,
+                COALESCE(NEW.created_at, CURRENT_TIMESTAMP), COALESCE(NEW.updated_at, CURRENT_TIMESTAMP));
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_files_view_update
+    INSTEAD OF UPDATE ON files
+    BEGIN
+        INSERT OR IGNORE INTO dirs (path)
+        SELECT {_dir_prefix_sql('NEW.path')} WHERE NEW.path IS NOT OLD.path;
+        UPDATE file_entries SET
+            dir_id = CASE WHEN NEW.path IS NOT OLD.path
+                          THEN (SELECT id FROM dirs WHERE path = {_dir_prefix_sql('NEW.path')})
+                          ELSE dir_id END,
+            name = CASE WHEN NEW.path IS NOT OLD.path
+                        THEN substr(NEW.path, length({_dir_prefix_sql('NEW.path')}) + 1)
+                        ELSE name END,
+            size = NEW.size, mtime = NEW.mtime, status = NEW.status, file_hash = NEW.file_hash,
+            push_time = NEW.push_time, completed_time = NEW.completed_time,
+            created_at = NEW.created_at, updated_at = NEW.updated_at
+        WHERE id = OLD.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_files_view_delete
+    INSTEAD OF DELETE ON files
+    BEGIN
+        DELETE FROM file_entries WHERE id = OLD.id;
+    END
+    """,
+]
+
+
+def get_files_object_type(cur):
+    """回傳 files 在數據庫中的類型: 'table'（舊版）、'view'（緊湊結構）或 None"""
+    cur.execute("SELECT type FROM sqlite_master WHERE name='files'")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def create_compact_path_schema(conn):
+    """建立 dirs / file_entries 表、files 視圖與轉寫觸發器"""
+    cur = conn.cursor()
+    for statement in COMPACT_PATH_SCHEMA:
+        cur.execute(statement)
+    conn.commit()
+
+
+def resolve_dir_id(cur, dir_prefix, cache=None, create=True):
+    """取得目錄前綴的 dir_id，可選擇建立；cache 為呼叫端持有的字典"""
+    if cache is not None and dir_prefix in cache:
+        return cache[dir_prefix]
+    if create:
+        cur.execute("INSERT OR IGNORE INTO dirs (path) VALUES (?)", (dir_prefix,))
+    cur.execute("SELECT id FROM dirs WHERE path=?", (dir_prefix,))
+    row = cur.fetchone()
+    dir_id = row[0] if row else None
+    if cache is not None and dir_id is not None:
+        cache[dir_prefix] = dir_id
+    return dir_id
+
+
+def lookup_file_id(conn, path):
+    """以完整路徑查詢文件 id（走 dirs.path 與 (dir_id, name) 索引）"""
+    dir_prefix, name = split_file_path(path)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT e.id FROM file_entries e JOIN dirs d ON d.id = e.dir_id
+        WHERE d.path = ? AND e.name = ?
+    """, (dir_prefix, name))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def migrate_to_compact_paths(conn):
+    """將舊版 files(path TEXT UNIQUE) 表遷移為 dirs + file_entries，保留文件 id"""
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM files")
+    total = cur.fetchone()[0]
+    log(f"[數據庫遷移] 開始遷移 {total:,} 筆文件到緊湊路徑結構...")
+
+    try:
+        conn.executescript(f"""
+            BEGIN;
+            {COMPACT_PATH_SCHEMA[0]};
+            {COMPACT_PATH_SCHEMA[1]};
+            INSERT OR IGNORE INTO dirs (path)
+            SELECT DISTINCT {_dir_prefix_sql('path')} FROM files WHERE path IS NOT NULL;
+            INSERT INTO file_entries (id, dir_id, name, size, mtime, status, file_hash,
+                                      push_time, completed_time, created_at, updated_at)
+            SELECT f.id, d.id, substr(f.path, length(d.path) + 1), f.size, f.mtime,
+                   COALESCE(f.status, 'pending'), f.file_hash, f.push_time, f.completed_time,
+                   f.created_at, f.updated_at
+            FROM files f JOIN dirs d ON d.path = {_dir_prefix_sql('f.path')};
+            DROP TABLE files;
+            {';'.join(COMPACT_PATH_SCHEMA[2:])};
+            COMMIT;
+        """)
+    except Exception:
+        conn.rollback()
+        raise
+
+    # 舊表的計數觸發器已隨表刪除，重建後對齊計數
+    ensure_status_counters(conn)
+    rebuild_status_counters(conn)
+
+    log("[數據庫遷移] 遷移完成，正在 VACUUM 回收空間...")
+    conn.execute("VACUUM")
+    log("[數據庫遷移] 完成")
+
+
 # /////////////////////////////////////////////////////////////////////////////
 # SQLite 操作
 def init_db(db_path=DB_PATH):
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
 
-    # 檢查並升級現有的 files 表
+    # WAL 模式: 掃描寫入時，傳輸線程仍可讀取新提交的文件
     try:
-        # 先檢查現有表結構
-        cur.execute("PRAGMA table_info(files)")
-        existing_columns = {row[1] for row in cur.fetchall()}
+        cur.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.OperationalError as e:
+        log(f"[警告] 無法啟用 WAL 模式: {e}")
 
-        # 如果表不存在，創建新表
-        if not existing_columns:
-            cur.execute("""
-                CREATE TABLE files (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    path TEXT UNIQUE,
-                    size INTEGER,
-                    mtime INTEGER,
-                    status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'pushed', 'completed', 'failed')),
-                    file_hash TEXT NULL,
-                    push_time TEXT NULL,
-                    completed_time TEXT NULL,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            log("[數據庫] 創建新的 files 表")
-        else:
+    # 檢查並升級現有的 files 表
+    try:
+        files_type = get_files_object_type(cur)
+
+        # 如果表不存在，直接創建緊湊路徑結構
+        if files_type is None:
+            create_compact_path_schema(conn)
+            log("[數據庫] 創建新的 dirs / file_entries 表與 files 視圖")
+        elif files_type == 'table':
+            # 先檢查現有表結構
+            cur.execute("PRAGMA table_info(files)")
+            existing_columns = {row[1] for row in cur.fetchall()}
             log(f"[數據庫] 現有列: {existing_columns}")
 
             # 添加缺失的列
@@ -323,6 +784,21 @@ def init_db(db_path=DB_PATH):
                         log(f"[數據庫升級] 添加列: {column}")
                     except sqlite3.OperationalError as e:
                         log(f"[警告] 添加列 {column} 失敗: {e}")
+            conn.commit()
+
+            # 舊版完整路徑表遷移為緊湊結構
+            migrate_to_compact_paths(conn)
+
+        # 緊湊結構的新增欄位與表（舊數據庫升級）
+        cur.execute("PRAGMA table_info(file_entries)")
+        entry_columns = {row[1] for row in cur.fetchall()}
+        for column, definition in (('media_type', 'TEXT NULL'),
+                                   ('attempts', 'INTEGER DEFAULT 0'),
+                                   ('retry_after', 'REAL NULL')):
+            if column not in entry_columns:
+                cur.execute(f"ALTER TABLE file_entries ADD COLUMN {column} {definition}")
+                log(f"[數據庫升級] 添加列: {column}")
+        create_compact_path_schema(conn)
 
         conn.commit()
 
@@ -341,31 +817,514 @@ def init_db(db_path=DB_PATH):
             total_size INTEGER,
             success_count INTEGER DEFAULT 0,
             status TEXT DEFAULT 'processing' CHECK(status IN ('processing', 'completed', 'failed', 'interrupted')),
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            push_seconds REAL NULL,
+            process_seconds REAL NULL
+        )
+    """)
+    cur.execute("PRAGMA table_info(batch_history)")
+    history_columns = {row[1] for row in cur.fetchall()}
+    for column in ('push_seconds', 'process_seconds'):
+        if column not in history_columns:
+            cur.execute(f"ALTER TABLE batch_history ADD COLUMN {column} REAL NULL")
+            log(f"[數據庫升級] 添加列: batch_history.{column}")
+
+    # 批次成員表（建立批次時寫入，批次對帳以集合語句完成）
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS batch_files (
+            batch_id TEXT NOT NULL,
+            file_id INTEGER NOT NULL,
+            PRIMARY KEY (batch_id, file_id)
+        ) WITHOUT ROWID
+    """)
+
+    # 批次內各媒體類型的檔數與大小（成本模型的學習樣本）
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS batch_composition (
+            batch_id TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            file_count INTEGER,
+            total_bytes INTEGER,
+            PRIMARY KEY (batch_id, media_type)
+        ) WITHOUT ROWID
+    """)
+
+    # 監看中的來源根目錄（last_seen 之前的變動皆已匯入，重啟後據此補回）
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS watch_roots (
+            path TEXT PRIMARY KEY,
+            added_at TEXT,
+            last_seen REAL NULL
         )
     """)
 
+    # 狀態計數表（由觸發器維護）
+    ensure_status_counters(conn)
+
     # 創建索引
     try:
-        cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_files_status ON files(status)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files(path)")
+        # 路徑查找由 dirs.path 與 file_entries(dir_id, name) 的唯一索引負責
         cur.execute(
             "CREATE INDEX IF NOT EXISTS idx_batch_history_status ON batch_history(status)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_entries_hash ON file_entries(file_hash)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_batch_files_file ON batch_files(file_id)")
 
-        # 檢查 file_hash 列是否存在後再創建索引
-        cur.execute("PRAGMA table_info(files)")
-        columns = {row[1] for row in cur.fetchall()}
-        if 'file_hash' in columns:
-            cur.execute(
-                "CREATE INDEX IF NOT EXISTS idx_file_hash ON files(file_hash)")
+        # 低基數的 status 索引由各狀態的部分覆蓋索引取代
+        cur.execute("DROP INDEX IF EXISTS idx_entries_status")
+        for index_sql in STATUS_INDEXES.values():
+            cur.execute(index_sql)
     except Exception as e:
         log(f"[警告] 創建索引失敗: {e}")
 
     conn.commit()
+
+    for problem in check_status_query_plans(conn):
+        log(f"[警告] 查詢計劃退化: {problem}")
+
     log("[數據庫] 初始化完成")
     return conn
 
+
+# /////////////////////////////////////////////////////////////////////////////
+# 狀態選取查詢與部分覆蓋索引
+# 每個待處理狀態各有一個只含該狀態行的索引，鍵以 id 開頭（符合 ORDER BY id），
+# 並包含查詢需要的全部欄位（status 也列入，讓 SQLite 判定為覆蓋索引），
+# 即使 95% 的行已 completed，選取也只讀取該狀態的索引項。
+SELECTABLE_STATUSES = ('pending', 'failed', 'pushed')
+
+STATUS_INDEXES = {
+    status: f"""
+        CREATE INDEX IF NOT EXISTS idx_entries_{status}
+        ON file_entries(id, size, dir_id, name, status)
+        WHERE status = '{status}'
+    """
+    for status in SELECTABLE_STATUSES
+}
+
+# 狀態以字面值寫入 SQL，部分索引才會被採用
+STATUS_SELECT_SQL = {
+    status: f"""
+        SELECT e.id, d.path || e.name, e.size
+        FROM file_entries e JOIN dirs d ON d.id = e.dir_id
+        WHERE e.status = '{status}'
+        ORDER BY e.id
+        LIMIT ?
+    """
+    for status in SELECTABLE_STATUSES
+}
+
+
+def select_files_with_status(conn, status, limit):
+    """依 id 順序選取指定狀態的文件 [(id, path, size)]"""
+    cur = conn.cursor()
+    cur.execute(STATUS_SELECT_SQL[status], (limit,))
+    return cur.fetchall()
+
+
+def check_status_query_plans(conn):
+    """以 EXPLAIN QUERY PLAN 確認各狀態選取都走對應的部分覆蓋索引，回傳問題列表"""
+    problems = []
+    cur = conn.cursor()
+    for status, sql in STATUS_SELECT_SQL.items():
+        cur.execute("EXPLAIN QUERY PLAN " + sql, (1,))
+        details = [row[3] for row in cur.fetchall()]
+        expected = f"COVERING INDEX idx_entries_{status}"
+        if not any(expected in detail for detail in details):
+            problems.append(f"{status}: 未使用 {expected} -> {' | '.join(details)}")
+
+    # 狀態計數（allinone / allinonecmd 共用）只能讀計數表，不可退化為掃描 file_entries
+    try:
+        cur.execute("EXPLAIN QUERY PLAN " + STATUS_COUNTS_SQL)
+        details = [row[3] for row in cur.fetchall()]
+        if any('file_entries' in detail for detail in details):
+            problems.append(f"狀態計數: 掃描了 file_entries -> {' | '.join(details)}")
+    except sqlite3.OperationalError:
+        problems.append("狀態計數: 缺少 file_status_counts 表，計數會退化為全表掃描")
+    return problems
+
+
+# /////////////////////////////////////////////////////////////////////////////
+# 狀態計數器 - 由 SQLite 觸發器維護，避免反覆 COUNT(*) 掃描 files 表
+STATUS_COUNTER_TRIGGERS = {
+    'trg_files_status_insert': """
+        CREATE TRIGGER IF NOT EXISTS trg_files_status_insert
+        AFTER INSERT ON file_entries
+        BEGIN
+            INSERT INTO file_status_counts (status, file_count, total_bytes)
+            VALUES (NEW.status, 1, COALESCE(NEW.size, 0))
+            ON CONFLICT(status) DO UPDATE SET
+                file_count = file_count + 1,
+                total_bytes = total_bytes + COALESCE(NEW.size, 0);
+        END
+    """,
+    'trg_files_status_delete': """
+        CREATE TRIGGER IF NOT EXISTS trg_files_status_delete
+        AFTER DELETE ON file_entries
+        BEGIN
+            UPDATE file_status_counts
+            SET file_count = file_count - 1,
+                total_bytes = total_bytes - COALESCE(OLD.size, 0)
+            WHERE status = OLD.status;
+        END
+    """,
+    'trg_files_status_update': """
+        CREATE TRIGGER IF NOT EXISTS trg_files_status_update
+        AFTER UPDATE OF status, size ON file_entries
+        WHEN OLD.status IS NOT NEW.status OR OLD.size IS NOT NEW.size
+        BEGIN
+            UPDATE file_status_counts
+            SET file_count = file_count - 1,
+                total_bytes = total_bytes - COALESCE(OLD.size, 0)
+            WHERE status = OLD.status;
+            INSERT INTO file_status_counts (status, file_count, total_bytes)
+            VALUES (NEW.status, 1, COALESCE(NEW.size, 0))
+            ON CONFLICT(status) DO UPDATE SET
+                file_count = file_count + 1,
+                total_bytes = total_bytes + COALESCE(NEW.size, 0);
+        END
+    """,
+}
+
+
+def ensure_status_counters(conn):
+    """建立狀態計數表與觸發器，首次建立時從 file_entries 表重建計數"""
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='file_status_counts'")
+    is_new = cur.fetchone() is None
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS file_status_counts (
+            status TEXT PRIMARY KEY,
+            file_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    for trigger_sql in STATUS_COUNTER_TRIGGERS.values():
+        cur.execute(trigger_sql)
+
+    if is_new:
+        rebuild_status_counters(conn)
+        log("[數據庫] 已建立狀態計數表")
+    conn.commit()
+
+
+def rebuild_status_counters(conn):
+    """從 file_entries 表完整重建狀態計數（僅在初始化或修復時使用）"""
+    cur = conn.cursor()
+    # 'archived' 計數不在 file_entries 中，由歸檔流程維護
+    cur.execute("DELETE FROM file_status_counts WHERE status != 'archived'")
+    cur.execute("""
+        INSERT INTO file_status_counts (status, file_count, total_bytes)
+        SELECT status, COUNT(*), COALESCE(SUM(size), 0)
+        FROM file_entries
+        GROUP BY status
+    """)
+    conn.commit()
+
+
+def count_files_with_status(conn, statuses):
+    """O(1) 取得指定狀態的文件總數"""
+    counts = get_status_counts(conn)
+    return sum(counts.get(status, (0, 0))[0] for status in statuses)
+
+# /////////////////////////////////////////////////////////////////////////////
+# 冷熱分離: 已完成文件與已結束批次移入歸檔數據庫
+# 熱數據庫只保留尚待處理的工作；歸檔庫另存精簡的路徑指紋集合
+# (archived_keys)，重新掃描時據此判定已完成的文件。
+ARCHIVE_CHUNK = 50000
+
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive.archived_files (
+        id INTEGER PRIMARY KEY,
+        path TEXT,
+        size INTEGER,
+        mtime INTEGER,
+        file_hash TEXT NULL,
+        push_time TEXT NULL,
+        completed_time TEXT NULL,
+        created_at TEXT,
+        archived_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        media_type TEXT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.archived_keys (
+        path_key INTEGER PRIMARY KEY,
+        size INTEGER,
+        mtime INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.batch_history (
+        id INTEGER PRIMARY KEY,
+        virtual_batch_id TEXT,
+        start_time TEXT,
+        end_time TEXT NULL,
+        file_count INTEGER,
+        total_size INTEGER,
+        success_count INTEGER DEFAULT 0,
+        status TEXT,
+        created_at TEXT,
+        push_seconds REAL NULL,
+        process_seconds REAL NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.batch_composition (
+        batch_id TEXT NOT NULL,
+        media_type TEXT NOT NULL,
+        file_count INTEGER,
+        total_bytes INTEGER,
+        PRIMARY KEY (batch_id, media_type)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.batch_files (
+        batch_id TEXT NOT NULL,
+        file_id INTEGER NOT NULL,
+        PRIMARY KEY (batch_id, file_id)
+    ) WITHOUT ROWID
+    """,
+]
+
+
+def path_key(path):
+    """路徑的 64 位元指紋（歸檔去重用）"""
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def get_archive_db_path(db_path):
+    """歸檔數據庫路徑: 與主數據庫同目錄的 <名稱>_archive.db"""
+    return os.path.splitext(db_path)[0] + "_archive.db"
+
+
+def attach_archive(conn, create=False):
+    """附加歸檔數據庫為 archive；不存在且 create=False 時回傳 False"""
+    cur = conn.cursor()
+    cur.execute("PRAGMA database_list")
+    databases = {row[1]: row[2] for row in cur.fetchall()}
+    if 'archive' in databases:
+        return True
+
+    archive_path = get_archive_db_path(databases['main'])
+    if not create and not os.path.exists(archive_path):
+        return False
+
+    conn.create_function("path_key", 1, path_key, deterministic=True)
+    cur.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    for statement in ARCHIVE_SCHEMA:
+        cur.execute(statement)
+    cur.execute("PRAGMA archive.table_info(archived_files)")
+    if 'media_type' not in {row[1] for row in cur.fetchall()}:
+        cur.execute("ALTER TABLE archive.archived_files ADD COLUMN media_type TEXT NULL")
+    cur.execute("PRAGMA archive.table_info(batch_history)")
+    history_columns = {row[1] for row in cur.fetchall()}
+    for column in ('push_seconds', 'process_seconds'):
+        if column not in history_columns:
+            cur.execute(f"ALTER TABLE archive.batch_history ADD COLUMN {column} REAL NULL")
+    conn.commit()
+    return True
+
+
+def filter_archived_paths(conn, paths):
+    """回傳 paths 中已歸檔（曾完成）的路徑集合"""
+    if not paths:
+        return set()
+    keys = {path_key(p): p for p in paths}
+    cur = conn.cursor()
+    placeholders = ','.join('?' * len(keys))
+    cur.execute(
+        f"SELECT path_key FROM archive.archived_keys WHERE path_key IN ({placeholders})", list(keys))
+    return {keys[row[0]] for row in cur.fetchall()}
+
+
+def archive_completed_files(conn):
+    """將 completed 文件與已結束的舊批次歷史移入歸檔數據庫，回傳歸檔文件數"""
+    attach_archive(conn, create=True)
+    cur = conn.cursor()
+    archived_total = 0
+
+    while True:
+        # 每塊獨立提交：先寫歸檔再刪熱表，中斷後重跑亦冪等
+        cur.execute("DROP TABLE IF EXISTS temp.archive_ids")
+        cur.execute("""
+            CREATE TEMP TABLE archive_ids AS
+            SELECT id, size FROM file_entries WHERE status='completed' LIMIT ?
+        """, (ARCHIVE_CHUNK,))
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM temp.archive_ids")
+        chunk_count, chunk_bytes = cur.fetchone()
+        if chunk_count == 0:
+            break
+
+        cur.execute("""
+            INSERT OR REPLACE INTO archive.archived_files
+                (id, path, size, mtime, file_hash, push_time, completed_time, created_at, media_type)
+            SELECT e.id, d.path || e.name, e.size, e.mtime, e.file_hash,
+                   e.push_time, e.completed_time, e.created_at, e.media_type
+            FROM file_entries e JOIN dirs d ON d.id = e.dir_id
+            WHERE e.id IN (SELECT id FROM temp.archive_ids)
+        """)
+        cur.execute("""
+            INSERT OR REPLACE INTO archive.archived_keys (path_key, size, mtime)
+            SELECT path_key(d.path || e.name), e.size, e.mtime
+            FROM file_entries e JOIN dirs d ON d.id = e.dir_id
+            WHERE e.id IN (SELECT id FROM temp.archive_ids)
+        """)
+        cur.execute("DELETE FROM file_entries WHERE id IN (SELECT id FROM temp.archive_ids)")
+        cur.execute("""
+            INSERT INTO file_status_counts (status, file_count, total_bytes)
+            VALUES ('archived', ?, ?)
+            ON CONFLICT(status) DO UPDATE SET
+                file_count = file_count + excluded.file_count,
+                total_bytes = total_bytes + excluded.total_bytes
+        """, (chunk_count, chunk_bytes))
+        conn.commit()
+        archived_total += chunk_count
+
+    cur.execute("DROP TABLE IF EXISTS temp.archive_ids")
+
+    # 已無文件（含排除記錄）的目錄
+    cur.execute("""
+        DELETE FROM dirs WHERE NOT EXISTS (
+            SELECT 1 FROM file_entries e WHERE e.dir_id = dirs.id)
+        AND NOT EXISTS (
+            SELECT 1 FROM excluded_files x WHERE x.dir_id = dirs.id)
+    """)
+
+    # 已結束且超過保留天數的批次歷史
+    cutoff = datetime.fromtimestamp(
+        time.time() - params.get('archive_batch_days', 7) * 86400).strftime('%Y-%m-%d %H:%M:%S')
+    cur.execute("""
+        INSERT OR REPLACE INTO archive.batch_history
+            (id, virtual_batch_id, start_time, end_time, file_count, total_size,
+             success_count, status, created_at, push_seconds, process_seconds)
+        SELECT id, virtual_batch_id, start_time, end_time, file_count, total_size,
+               success_count, status, created_at, push_seconds, process_seconds
+        FROM main.batch_history
+        WHERE status != 'processing' AND end_time IS NOT NULL AND end_time < ?
+    """, (cutoff,))
+    for table, columns in (('batch_files', 'b.batch_id, b.file_id'),
+                           ('batch_composition', 'b.batch_id, b.media_type, b.file_count, b.total_bytes')):
+        cur.execute(f"""
+            INSERT OR IGNORE INTO archive.{table}
+            SELECT {columns} FROM main.{table} b
+            JOIN main.batch_history h ON h.virtual_batch_id = b.batch_id
+            WHERE h.status != 'processing' AND h.end_time IS NOT NULL AND h.end_time < ?
+        """, (cutoff,))
+    for table in ('batch_files', 'batch_composition'):
+        cur.execute(f"""
+            DELETE FROM main.{table} WHERE batch_id IN (
+                SELECT virtual_batch_id FROM main.batch_history
+                WHERE status != 'processing' AND end_time IS NOT NULL AND end_time < ?)
+        """, (cutoff,))
+    cur.execute("""
+        DELETE FROM main.batch_history
+        WHERE status != 'processing' AND end_time IS NOT NULL AND end_time < ?
+    """, (cutoff,))
+    conn.commit()
+
+    log(f"[歸檔] 已移出 {archived_total:,} 個已完成文件")
+    return archived_total
+
+
+def get_archived_batch_stats(db_path=None):
+    """歸檔數據庫中的批次狀態統計"""
+    archive_path = get_archive_db_path(db_path or DB_PATH)
+    if not os.path.exists(archive_path):
+        return {}
+    try:
+        archive_conn = sqlite3.connect(archive_path)
+        cur = archive_conn.cursor()
+        cur.execute("SELECT status, COUNT(*) FROM batch_history GROUP BY status")
+        stats = dict(cur.fetchall())
+        archive_conn.close()
+        return stats
+    except sqlite3.Error:
+        return {}
+
+
+def _get_db_meta(conn, key, default=None):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value TEXT)")
+    cur.execute("SELECT value FROM db_meta WHERE key=?", (key,))
+    row = cur.fetchone()
+    return row[0] if row else default
+
+
+def _set_db_meta(conn, key, value):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value TEXT)")
+    cur.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES (?, ?)", (key, str(value)))
+    conn.commit()
+
+
+# 維護全程持有；開始傳輸與掃描在同一把鎖下設定狀態，維護中則拒絕，
+# 維護開始前也在鎖內確認沒有傳輸或掃描，兩者不會同時爭用寫鎖
+maintenance_lock = threading.Lock()
+
+
+def run_db_maintenance(db_path=None, force=False):
+    """排程維護: 歸檔、ANALYZE、必要時 VACUUM（僅在未傳輸、未掃描、未監看資料夾時執行）"""
+    if not maintenance_lock.acquire(blocking=False):
+        return False
+    try:
+        if batch_processing or scan_in_progress.is_set() or ui_state.get_state() == 'scanning':
+            return False
+        if folder_watcher.active:
+            # 監看線程持續寫入，VACUUM 會與其爭用寫鎖；停止監看後的下一次傳輸結束時再維護
+            log("[維護] 資料夾監看中，延後數據庫維護")
+            return False
+        return _run_db_maintenance(db_path, force)
+    finally:
+        maintenance_lock.release()
+
+
+def _run_db_maintenance(db_path, force):
+    conn = sqlite3.connect(db_path or DB_PATH)
+    try:
+        last_run = float(_get_db_meta(conn, 'last_maintenance', 0))
+        interval = params.get('maintenance_interval_hours', 24) * 3600
+        if not force and time.time() - last_run < interval:
+            return False
+
+        log("[維護] 開始數據庫維護")
+        completed = count_files_with_status(conn, ('completed',))
+        if force or completed >= params.get('archive_min_completed', 10000):
+            archive_completed_files(conn)
+
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        for problem in check_status_query_plans(conn):
+            log(f"[警告] 查詢計劃退化: {problem}")
+
+        # 空閒頁超過兩成才 VACUUM
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if page_count and freelist / page_count > 0.2:
+            log(f"[維護] VACUUM（空閒頁 {freelist}/{page_count}）")
+            conn.execute("VACUUM")
+            if attach_archive(conn):
+                conn.execute("VACUUM archive")
+
+        _set_db_meta(conn, 'last_maintenance', time.time())
+        log("[維護] 數據庫維護完成")
+        return True
+    except Exception as e:
+        log(f"[維護] 數據庫維護失敗: {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def schedule_db_maintenance():
+    """在背景線程中執行到期的數據庫維護"""
+    threading.Thread(target=run_db_maintenance, daemon=True).start()
+
+
 def run_remote_shell_script(script_path):
     """執行遠端 shell 腳本"""
     try:
@@ -396,88 +1355,344 @@ def calculate_file_hash(file_path, chunk_size=8192):
         return None
 
 
-def scan_and_add_files(conn, source_root):
-    """極簡版文件掃描 - 純單行進度顯示"""
+# /////////////////////////////////////////////////////////////////////////////
+# 串流掃描管線: walk (含 stat) -> fingerprint -> DB writer
+# 走訪使用共用的 fastwalk（線程池 scandir，網路磁碟上不再逐一 stat）。
+# 各階段以有界佇列相連，記憶體用量與目錄樹大小無關；寫入端分塊提交，
+# 批次排程器可在掃描進行中即取用新的 pending 文件。
+SCAN_QUEUE_SIZE = 2000
+SCAN_COMMIT_CHUNK = 500
+_SCAN_DONE = object()
 
-    stats = {'new_files': 0, 'updated_files': 0,
-        'duplicate_files': 0, 'error_files': 0}
+# 掃描進行中旗標（完成檢查需等待掃描結束）
+scan_in_progress = threading.Event()
+
+
+def _scan_queue_put(queue, item, stop_event):
+    """放入有界佇列；下游已停止時放棄"""
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=0.5)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _scan_walk_stage(walker, out_queue, stop_event):
+    """階段一: 多線程 scandir 走訪目錄樹，文件大小與修改時間直接取自目錄項"""
+    try:
+        for info in walker:
+            record = {
+                'full_path': info.path,
+                'filename': info.name,
+                'size': info.size,
+                'mtime': int(info.mtime),
+            }
+            if not _scan_queue_put(out_queue, record, stop_event):
+                walker.stop()
+                return
+    except Exception as e:
+        log(f"[掃描] 目錄走訪錯誤: {e}")
+    finally:
+        _scan_queue_put(out_queue, _SCAN_DONE, stop_event)
+
+
+# 媒體類型判定: 讀取文件開頭的魔術位元組，而非信任副檔名
+MEDIA_SNIFF_BYTES = 256
+# ISO BMFF (ftyp) 主品牌 -> 類型；其餘品牌視為 MP4 影片
+FTYP_BRANDS = {
+    b'heic': 'image/heic', b'heix': 'image/heic', b'hevc': 'image/heic', b'hevx': 'image/heic',
+    b'heim': 'image/heic', b'heis': 'image/heic', b'hevm': 'image/heic', b'hevs': 'image/heic',
+    b'mif1': 'image/heic', b'msf1': 'image/heic',
+    b'avif': 'image/avif', b'avis': 'image/avif',
+    b'crx ': 'image/x-canon-cr3',
+    b'qt  ': 'video/quicktime',
+    b'M4A ': None, b'M4B ': None, b'M4P ': None, b'F4A ': None,   # 純音訊
+}
+# 魔術位元組前綴 -> 類型（依序比對）
+MEDIA_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'FUJIFILMCCD-RAW', 'image/x-raw'),
+    (b'IIRO', 'image/x-raw'),
+    (b'IIU\x00', 'image/x-raw'),
+    (b'II*\x00', 'image/tiff'),        # 含 DNG/CR2/NEF/ARW 等 TIFF 架構 RAW
+    (b'MM\x00*', 'image/tiff'),
+    (b'\x1a\x45\xdf\xa3', 'video/x-matroska'),
+    (b'\x00\x00\x01\xba', 'video/mpeg'),
+    (b'\x30\x26\xb2\x75\x8e\x66\xcf\x11', 'video/x-ms-wmv'),
+    (b'FLV', 'video/x-flv'),
+]
+# 以副檔名排除: 下載中的暫存檔與伴隨檔（.thm 為 JPEG 縮圖、.lrv 為低解析度預覽影片）
+PARTIAL_EXTENSIONS = {'.part', '.partial', '.crdownload', '.download', '.tmp', '.!qb', '.opdownload'}
+SIDECAR_EXTENSIONS = {'.thm', '.lrv', '.aae', '.xmp'}
+# BMP 的 DIB 標頭長度（BITMAPCOREHEADER / INFOHEADER / V2-V5 / OS2 v2）
+BMP_DIB_HEADER_SIZES = {12, 16, 40, 52, 56, 64, 108, 124}
+
+
+def _is_bmp(header, size):
+    """'BM' 只有兩個位元組，另需檔頭記錄的大小與 DIB 標頭長度合理，避免把 BM 開頭的文字檔當成圖片"""
+    if len(header) < 18 or not header.startswith(b'BM'):
+        return False
+    declared_size, dib_size = struct.unpack_from('<I', header, 2)[0], struct.unpack_from('<I', header, 14)[0]
+    return dib_size in BMP_DIB_HEADER_SIZES and 14 + dib_size <= declared_size <= size
+
+
+def sniff_media_type(full_path, size):
+    """判定媒體類型，回傳 (media_type, 排除原因)；二者恰有一個為 None
+
+    讀取失敗（鎖定、網路磁碟暫時錯誤）回傳 (None, None)，視為錯誤而非非媒體文件。
+    """
+    ext = os.path.splitext(full_path)[1].lower()
+    if ext in PARTIAL_EXTENSIONS:
+        return None, 'partial'
+    if ext in SIDECAR_EXTENSIONS:
+        return None, 'sidecar'
+    if size == 0:
+        return None, 'empty'
+
+    try:
+        with open(full_path, 'rb') as f:
+            header = f.read(MEDIA_SNIFF_BYTES)
+    except OSError:
+        return None, None
+
+    if header[4:8] == b'ftyp':
+        media_type = FTYP_BRANDS.get(header[8:12], 'video/mp4')
+        return (media_type, None) if media_type else (None, 'audio')
+    if header[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'):
+        return 'video/quicktime', None
+    if header[:4] == b'RIFF':
+        if header[8:12] == b'WEBP':
+            return 'image/webp', None
+        if header[8:12] == b'AVI ':
+            return 'video/x-msvideo', None
+        return None, 'not_media'
+    # MPEG-TS（188 位元組封包）與 M2TS/MTS（192 位元組封包）
+    if len(header) > 196 and header[0] == 0x47 and header[188] == 0x47:
+        return 'video/mp2t', None
+    if len(header) > 196 and header[4] == 0x47 and header[196] == 0x47:
+        return 'video/mp2t', None
+    if _is_bmp(header, size):
+        return 'image/bmp', None
+    for signature, media_type in MEDIA_SIGNATURES:
+        if header.startswith(signature):
+            if media_type == 'video/x-matroska' and b'webm' in header:
+                return 'video/webm', None
+            return media_type, None
+    return None, 'not_media'
+
+
+def fingerprint_record(record, threshold):
+    """判定媒體類型並為小媒體文件計算哈希；讀取失敗時標記 error，寫入時不動既有記錄"""
+    record['media_type'], record['excluded'] = sniff_media_type(record['full_path'], record['size'])
+    if record['media_type'] is None and record['excluded'] is None:
+        record['error'] = True
+        return
+    if record['media_type'] and record['size'] < threshold:
+        record['file_hash'] = calculate_file_hash(record['full_path'])
+    else:
+        record['file_hash'] = None
+
+
+def _scan_fingerprint_stage(in_queue, out_queue, stop_event):
+    """階段二: 判定媒體類型，為小媒體文件計算哈希"""
+    threshold = params.get('small_file_threshold', 50 * 1024 * 1024)
+    try:
+        while True:
+            record = in_queue.get()
+            if record is _SCAN_DONE:
+                break
+            if not record.get('error'):
+                fingerprint_record(record, threshold)
+            if not _scan_queue_put(out_queue, record, stop_event):
+                return
+    finally:
+        _scan_queue_put(out_queue, _SCAN_DONE, stop_event)
+
+
+def _write_scan_chunk(conn, records, stats, dir_ids, check_archive=False):
+    """階段三: 將一塊掃描結果寫入數據庫並提交（dir_ids 為本次掃描的目錄快取）
+
+    寫入失敗的記錄標記 error，資料夾監看據此留待重試。
+    """
     cur = conn.cursor()
 
-    # 收集文件
-    all_files = []
-    for dirpath, _, filenames in os.walk(source_root):
-        for filename in filenames:
-            full_path = os.path.join(dirpath, filename)
-            if os.path.exists(full_path):
-                stat_info = os.stat(full_path)
-                all_files.append({
-                    'full_path': full_path,
-                    'filename': filename,
-                    'size': stat_info.st_size,
-                    'mtime': int(stat_info.st_mtime),
-                    'file_hash': calculate_file_hash(full_path) if stat_info.st_size < params.get('small_file_threshold', 50*1024*1024) else None
-                })
-
-    if not all_files:
-        console.print("[yellow]沒有找到任何文件[/yellow]")
-        return stats
+    # 依目錄分組，一個目錄一次查詢既有文件
+    by_dir = {}
+    for record in records:
+        if record.get('error'):
+            stats['error_files'] += 1
+            continue
+        dir_prefix, name = split_file_path(record['full_path'])
+        by_dir.setdefault(dir_prefix, []).append((name, record))
 
-    # 處理文件 - 只顯示一行進度
-    if RICH_AVAILABLE:
+    for dir_prefix, entries in by_dir.items():
+        try:
+            dir_id = resolve_dir_id(cur, dir_prefix, dir_ids)
+            names = [name for name, _ in entries]
+            placeholders = ','.join('?' * len(names))
+            cur.execute(
+                f"SELECT name, id, status, media_type FROM file_entries WHERE dir_id=? AND name IN ({placeholders})",
+                [dir_id] + names)
+            existing = {name: (file_id, status, media_type) for name, file_id, status, media_type in cur.fetchall()}
+            cur.execute(
+                f"SELECT name FROM excluded_files WHERE dir_id=? AND name IN ({placeholders})",
+                [dir_id] + names)
+            previously_excluded = {row[0] for row in cur.fetchall()}
+
+            # 熱表沒有的文件再查歸檔指紋集合
+            archived = set()
+            if check_archive:
+                archived = filter_archived_paths(
+                    conn, [r['full_path'] for name, r in entries if name not in existing])
+        except Exception:
+            stats['error_files'] += len(entries)
+            for _, record in entries:
+                record['error'] = True
+            continue
+
+        for name, record in entries:
+            try:
+                file_id, status, media_type = existing.get(name, (None, None, None))
+                if record['media_type'] is None:
+                    # 非媒體文件不進入批次；尚未推送的舊記錄一併移除
+                    cur.execute("""
+                        INSERT OR REPLACE INTO excluded_files (dir_id, name, size, mtime, reason)
+                        VALUES (?, ?, ?, ?, ?)
+                    """, (dir_id, name, record['size'], record['mtime'], record['excluded']))
+                    if file_id is not None and status in ('pending', 'failed'):
+                        cur.execute("DELETE FROM file_entries WHERE id=?", (file_id,))
+                    stats['excluded_files'] += 1
+                    ext = os.path.splitext(name)[1].lower() or '(無副檔名)'
+                    stats['excluded_types'][ext] = stats['excluded_types'].get(ext, 0) + 1
+                    continue
+
+                stats['media_types'][record['media_type']] = stats['media_types'].get(record['media_type'], 0) + 1
+                if name in previously_excluded:
+                    cur.execute("DELETE FROM excluded_files WHERE dir_id=? AND name=?", (dir_id, name))
+
+                if record['full_path'] in archived:
+                    stats['duplicate_files'] += 1
+                elif file_id is None:
+                    # 新文件
+                    cur.execute("""
+                        INSERT INTO file_entries (dir_id, name, size, mtime, file_hash, status, media_type)
+                        VALUES (?, ?, ?, ?, ?, 'pending', ?)
+                    """, (dir_id, name, record['size'], record['mtime'], record['file_hash'],
+                          record['media_type']))
+                    stats['new_files'] += 1
+                elif status != 'completed':
+                    # 更新現有文件為待處理
+                    cur.execute("""
+                        UPDATE file_entries SET status='pending', media_type=?, attempts=0, retry_after=NULL
+                        WHERE id=?
+                    """, (record['media_type'], file_id))
+                    stats['updated_files'] += 1
+                else:
+                    if media_type is None:
+                        cur.execute("UPDATE file_entries SET media_type=? WHERE id=?",
+                                    (record['media_type'], file_id))
+                    stats['duplicate_files'] += 1
+            except Exception:
+                stats['error_files'] += 1
+                record['error'] = True
+
+    conn.commit()
+
+
+def scan_and_add_files(conn, source_root):
+    """串流文件掃描 - 分塊提交，掃描中即可開始傳輸（source_root 可為單一路徑或路徑列表）"""
+
+    stats = {'new_files': 0, 'updated_files': 0,
+        'duplicate_files': 0, 'error_files': 0, 'excluded_files': 0,
+        'media_types': {}, 'excluded_types': {}}
+
+    walker = FastWalker(source_root)
+    stat_queue = Queue(maxsize=SCAN_QUEUE_SIZE)
+    record_queue = Queue(maxsize=SCAN_QUEUE_SIZE)
+    stop_event = threading.Event()
+    dir_ids = {}
+    check_archive = attach_archive(conn)
+
+    stages = [
+        threading.Thread(target=_scan_walk_stage, args=(walker, stat_queue, stop_event), daemon=True),
+        threading.Thread(target=_scan_fingerprint_stage, args=(stat_queue, record_queue, stop_event), daemon=True),
+    ]
+
+    scan_in_progress.set()
+    try:
+        for stage in stages:
+            stage.start()
+
+        # 處理文件 - 只顯示一行進度（總數未知）
         with Progress(
             TextColumn("掃描: {task.fields[current_file]}"),
             BarColumn(bar_width=40),
-            "[progress.percentage]{task.percentage:>3.0f}%",
-            "({task.completed}/{task.total})",
+            "{task.completed} 個文件",
             TimeElapsedColumn(),
             console=console,
             transient=False,
         ) as progress:
 
-            task = progress.add_task("掃描文件", total=len(
-                all_files), current_file="準備中...")
-
-            for i, file_info in enumerate(all_files):
-                filename = file_info['filename']
-
-                # 更新當前文件名
-                progress.update(task, current_file=filename[:50])
-
-                # 處理文件邏輯（簡化版）
-                try:
-                    cur.execute(
-                        "SELECT id, status FROM files WHERE path=?", (file_info['full_path'],))
-                    existing = cur.fetchone()
-
-                    if not existing:
-                        # 新文件
-                        cur.execute("""
-                            INSERT INTO files (path, size, mtime, file_hash, status)
-                            VALUES (?, ?, ?, ?, 'pending')
-                        """, (file_info['full_path'], file_info['size'], file_info['mtime'], file_info['file_hash']))
-                        stats['new_files'] += 1
-                    elif existing[1] != 'completed':
-                        # 更新現有文件為待處理
-                        cur.execute(
-                            "UPDATE files SET status='pending' WHERE path=?", (file_info['full_path'],))
-                        stats['updated_files'] += 1
-                    else:
-                        stats['duplicate_files'] += 1
+            task = progress.add_task("掃描文件", total=None, current_file="準備中...")
 
-                    progress.update(task, advance=1)
+            done = False
+            while not done:
+                # 等待第一筆，再盡量取滿一塊
+                chunk = []
+                item = record_queue.get()
+                while True:
+                    if item is _SCAN_DONE:
+                        done = True
+                        break
+                    chunk.append(item)
+                    if len(chunk) >= SCAN_COMMIT_CHUNK:
+                        break
+                    try:
+                        item = record_queue.get_nowait()
+                    except Empty:
+                        break
 
-                except Exception as e:
-                    stats['error_files'] += 1
-                    progress.update(task, advance=1)
+                if chunk:
+                    _write_scan_chunk(conn, chunk, stats, dir_ids, check_archive)
+                    notify_pipeline()
+                    progress.update(task, advance=len(chunk),
+                                    current_file=os.path.basename(chunk[-1]['full_path'])[:50])
 
             # 最終顯示
             progress.update(task, current_file=f"完成! {stats['new_files']} 新增")
+    finally:
+        stop_event.set()
+        walker.stop()
+        scan_in_progress.clear()
+        notify_pipeline()
+
+    # 無法列出的資料夾與讀不到屬性的文件
+    stats['error_files'] += sum(root_stats['errors'] for root_stats in walker.stats.values())
+    if not any(stats.values()):
+        console.print("[yellow]沒有找到任何文件[/yellow]")
+        return stats
 
-    conn.commit()
-
-    # 只顯示一行總結
+    # 只顯示一行總結，另列各類型數量
     console.print(
-        f"[bold green]📁 掃描完成: {stats['new_files']} 新增, {stats['updated_files']} 更新, {stats['duplicate_files']} 重複[/bold green]")
+        f"[bold green]📁 掃描完成: {stats['new_files']} 新增, {stats['updated_files']} 更新, "
+        f"{stats['duplicate_files']} 重複, {stats['excluded_files']} 排除[/bold green]")
+    if stats['media_types']:
+        console.print("   媒體: " + ", ".join(
+            f"{t} {n}" for t, n in sorted(stats['media_types'].items(), key=lambda x: -x[1])))
+    if stats['excluded_types']:
+        console.print("[yellow]   排除: " + ", ".join(
+            f"{t} {n}" for t, n in sorted(stats['excluded_types'].items(), key=lambda x: -x[1])) + "[/yellow]")
+    for root, root_stats in walker.stats.items():
+        console.print(
+            f"   {root}: {root_stats['files']} 個文件, {root_stats['dirs']} 個資料夾, "
+            f"{root_stats['bytes'] / 1024 ** 3:.2f}GB, 走訪 {root_stats['seconds']:.1f} 秒"
+            + (f", [red]{root_stats['errors']} 錯誤[/red]" if root_stats['errors'] else ""))
+    stats['roots'] = walker.stats
 
     return stats
 
@@ -485,11 +1700,9 @@ def scan_and_add_files(conn, source_root):
 def query_pending_files_count():
     try:
         conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
 
         # Include both 'pending' and 'failed' files in the count
-        cur.execute("SELECT COUNT(*) FROM files WHERE status IN ('pending', 'failed')")
-        pending_count = cur.fetchone()[0]
+        pending_count = count_files_with_status(conn, ('pending', 'failed'))
 
         conn.close()
         return pending_count
@@ -499,103 +1712,394 @@ def query_pending_files_count():
 
 
 # /////////////////////////////////////////////////////////////////////////////
-# 動態批次管理器
-class DynamicBatchManager:
-    """動態批次管理器"""
-
-    def __init__(self, conn):
-        self.conn = conn
-        self.current_batch_id = None
-        self.batch_start_time = None
-        self.batch_files = []
-        self.batch_total_size = 0
-        self.successful_pushes = 0
+# 資料夾監看（持續匯入）
+# 登記在 watch_roots 的來源根目錄有新增或變更的文件時，只對這些文件做判定與寫入，不再整棵重新掃描。
+# 有 watchdog 時使用系統事件（inotify / ReadDirectoryChangesW / FSEvents），否則定期輪詢比對快照。
+# 寫入中的文件需大小與修改時間維持不變 watch_settle_seconds 秒（防抖）才匯入，匯入後喚醒排程線程。
+
+class FolderWatcher:
+    """監看已登記的來源根目錄，將防抖後的新增/變更文件增量寫入數據庫"""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.candidates = {}     # path -> (size, mtime, 最後變動時間)；size 為 None 表示待重新 stat
+        self.snapshot = {}       # 輪詢模式: path -> (size, mtime)
+        self.new_roots = []      # 待開始監看的 (根目錄, last_seen)；last_seen 為 None 表示首次完整掃描
+        self.roots = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.observer = None
+        self.ingested = 0
+
+    @property
+    def active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @staticmethod
+    def registered_roots(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT path, last_seen FROM watch_roots ORDER BY added_at")
+        return cur.fetchall()
 
-    def start_new_batch(self):
-        """開始新的動態批次"""
-        self.current_batch_id = f"batch_{int(time.time())}_{os.getpid()}"
-        self.batch_start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.batch_files = []
-        self.batch_total_size = 0
+    def add_root(self, path):
+        """登記根目錄（首次會完整掃描一次），執行中則立即開始監看"""
+        path = os.path.abspath(path)
+        conn = sqlite3.connect(self.db_path or DB_PATH)
+        try:
+            conn.execute("INSERT OR IGNORE INTO watch_roots (path, added_at, last_seen) VALUES (?, ?, NULL)",
+                         (path, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+        finally:
+            conn.close()
+        with self.lock:
+            self.new_roots.append((path, None))
+        log(f"[資料夾監看] 登記根目錄: {path}")
+
+    def touch(self, path):
+        """事件通知: 文件新增或變更，等待防抖後匯入"""
+        with self.lock:
+            self.candidates[path] = (None, None, time.time())
+
+    def _requeue(self, records):
+        """匯入失敗或暫時無法讀取的文件放回候選，下個循環重試（期間有新事件則以新事件為準）"""
+        now = time.time()
+        with self.lock:
+            for record in records:
+                self.candidates.setdefault(record['full_path'], (None, None, now))
+
+    def touch_tree(self, root):
+        """整個資料夾移入時只有一個事件，逐一登記其中的文件"""
+        for info in FastWalker(root):
+            self.touch(info.path)
+
+    def _catch_up(self, root, since):
+        """補回未監看期間的變動: 修改或建立時間晚於 since 的文件（複製保留 mtime 時以 ctime 判定）"""
+        for info in FastWalker(root):
+            if self.observer is None:
+                self.snapshot[info.path] = (info.size, int(info.mtime))
+            if max(info.mtime, info.ctime) >= since:
+                self.touch(info.path)
+
+    def _poll(self):
+        """輪詢模式: 所有根目錄一起走訪，與上次快照比對，大小或修改時間不同、或新出現的文件列為候選"""
+        seen = {}
+        for info in FastWalker(self.roots):
+            seen[info.path] = (info.size, int(info.mtime))
+            if self.snapshot.get(info.path) != seen[info.path]:
+                self.touch(info.path)
+        self.snapshot = seen
+
+    def _settle(self):
+        """回傳已維持不變 watch_settle_seconds 的文件記錄，其餘留待下次檢查"""
+        settle_seconds = params.get('watch_settle_seconds', 10)
+        now = time.time()
+        ready = []
+        with self.lock:
+            candidates = list(self.candidates.items())
+        for full_path, (size, mtime, changed_at) in candidates:
+            try:
+                stat_info = os.stat(full_path)
+            except OSError:
+                # 已刪除或改名（新名稱另有事件）
+                with self.lock:
+                    self.candidates.pop(full_path, None)
+                continue
+            current = (stat_info.st_size, int(stat_info.st_mtime))
+            with self.lock:
+                if self.candidates.get(full_path, (None, None, None))[2] != changed_at:
+                    continue   # 檢查期間又有新事件
+                if current != (size, mtime):
+                    self.candidates[full_path] = current + (now,)
+                elif now - changed_at >= settle_seconds:
+                    del self.candidates[full_path]
+                    ready.append({
+                        'full_path': full_path,
+                        'filename': os.path.basename(full_path),
+                        'size': current[0],
+                        'mtime': current[1],
+                    })
+        return ready
+
+    def _ingest(self, conn, ready, dir_ids, check_archive):
+        """判定媒體類型並寫入數據庫（與掃描相同的寫入邏輯），有變動時喚醒排程線程"""
+        threshold = params.get('small_file_threshold', 50 * 1024 * 1024)
+        stats = {'new_files': 0, 'updated_files': 0,
+                 'duplicate_files': 0, 'error_files': 0, 'excluded_files': 0,
+                 'media_types': {}, 'excluded_types': {}}
+        for start in range(0, len(ready), SCAN_COMMIT_CHUNK):
+            chunk = ready[start:start + SCAN_COMMIT_CHUNK]
+            try:
+                for record in chunk:
+                    fingerprint_record(record, threshold)
+                _write_scan_chunk(conn, chunk, stats, dir_ids, check_archive)
+            except Exception:
+                # 例如 database is locked: 本塊與其後尚未寫入的文件留待下個循環
+                conn.rollback()
+                dir_ids.clear()
+                self._requeue(ready[start:])
+                raise
+            self._requeue([record for record in chunk if record.get('error')])
+
+        if stats['new_files'] or stats['updated_files']:
+            self.ingested += stats['new_files'] + stats['updated_files']
+            log(f"[資料夾監看] 匯入 {stats['new_files']} 新增, {stats['updated_files']} 更新, "
+                f"{stats['excluded_files']} 排除")
+            notify_pipeline()
+            update_pending_count_text()
+        return stats
+
+    def _save_progress(self, conn, cycle_start):
+        """last_seen 推進到仍在防抖的最早變動之前"""
+        with self.lock:
+            pending = [changed_at for _, _, changed_at in self.candidates.values()]
+        last_seen = min(pending + [cycle_start])
+        conn.executemany("UPDATE watch_roots SET last_seen=? WHERE path=?",
+                         [(last_seen, root) for root in self.roots])
+        conn.commit()
+
+    def _add_observed_root(self, conn, root, last_seen):
+        if not os.path.isdir(root):
+            log(f"[資料夾監看] 根目錄不存在，略過: {root}")
+            return
+        cycle_start = time.time()
+        # 先開始監看再補回，期間的變動不會遺漏（重複匯入無害）
+        if self.observer is not None:
+            self.observer.schedule(_WatchEventHandler(self), root, recursive=True)
+        if last_seen is None:
+            # 首次登記: 記下快照後以完整掃描匯入既有文件
+            if self.observer is None:
+                self._catch_up(root, float('inf'))
+            scan_and_add_files(conn, root)
+        else:
+            self._catch_up(root, last_seen)
+        self.roots.append(root)
+        conn.execute("UPDATE watch_roots SET last_seen=? WHERE path=?", (cycle_start, root))
+        conn.commit()
+
+    def start(self):
+        if self.active:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _worker(self):
+        conn = sqlite3.connect(self.db_path or DB_PATH)
+        dir_ids = {}
+        check_archive = attach_archive(conn)
+        self.roots = []
+        self.snapshot = {}
+        if WATCHDOG_AVAILABLE:
+            self.observer = Observer()
+            self.observer.start()
+        log(f"[資料夾監看] 線程啟動（{'系統事件' if self.observer else '輪詢'}模式）")
+        try:
+            with self.lock:
+                # 已登記的根目錄與執行中新增的一起排入，失敗的根目錄下個循環重試
+                self.new_roots = [(root, last_seen) for root, last_seen in self.registered_roots(conn)]
+            last_poll = last_save = time.time()
+
+            while not self.stop_event.is_set():
+                cycle_start = time.time()
+                # 單一循環的錯誤（如維護期間 database is locked）只記錄，不結束監看
+                try:
+                    with self.lock:
+                        new_roots, self.new_roots = self.new_roots, []
+                    for index, (root, last_seen) in enumerate(new_roots):
+                        if root in self.roots:
+                            continue
+                        try:
+                            self._add_observed_root(conn, root, last_seen)
+                        except Exception:
+                            with self.lock:
+                                self.new_roots.extend(new_roots[index:])
+                            raise
+
+                    if self.observer is None and cycle_start - last_poll >= params.get('watch_poll_interval', 30):
+                        self._poll()
+                        last_poll = cycle_start
+
+                    ready = self._settle()
+                    if ready:
+                        self._ingest(conn, ready, dir_ids, check_archive)
+                    if ready or cycle_start - last_save >= 60:
+                        self._save_progress(conn, cycle_start)
+                        last_save = cycle_start
+                except Exception as e:
+                    conn.rollback()
+                    log(f"[資料夾監看] 本次循環錯誤，稍後重試: {e}")
+
+                with self.lock:
+                    waiting = bool(self.candidates) or bool(self.new_roots)
+                self.stop_event.wait(1 if waiting or self.observer else 5)
+        except Exception as e:
+            log(f"[資料夾監看] 錯誤: {e}")
+        finally:
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join(timeout=5)
+                self.observer = None
+            conn.close()
+            notify_pipeline()
+            update_watch_button(False)
+            log(f"[資料夾監看] 線程結束（共匯入 {self.ingested} 個文件）")
+
+
+if WATCHDOG_AVAILABLE:
+    class _WatchEventHandler(FileSystemEventHandler):
+        """watchdog 事件轉為 FolderWatcher 候選文件"""
+
+        def __init__(self, watcher):
+            super().__init__()
+            self.watcher = watcher
+
+        def _touch(self, path, is_directory):
+            if is_directory:
+                self.watcher.touch_tree(path)
+            else:
+                self.watcher.touch(path)
+
+        def on_created(self, event):
+            self._touch(event.src_path, event.is_directory)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                self.watcher.touch(event.src_path)
+
+        def on_moved(self, event):
+            self._touch(event.dest_path, event.is_directory)
+
+
+folder_watcher = FolderWatcher()
+
+
+# /////////////////////////////////////////////////////////////////////////////
+# 動態批次管理器
+class DynamicBatchManager:
+    """動態批次管理器"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.current_batch_id = None
+        self.batch_start_time = None
+        self.batch_files = []
+        self.batch_total_size = 0
+        self.successful_pushes = 0
+
+    # 同一秒內建立的批次以序號區分
+    _batch_sequence = itertools.count(1)
+
+    def start_new_batch(self):
+        """開始新的動態批次"""
+        self.current_batch_id = f"batch_{int(time.time())}_{os.getpid()}_{next(self._batch_sequence)}"
+        self.batch_start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.batch_files = []
+        self.batch_total_size = 0
         self.successful_pushes = 0
         log(f"[動態批次] 開始批次: {self.current_batch_id}")
         return self.current_batch_id
 
-    def get_next_file_batch(self, max_files=None, max_size_gb=None):
-        """獲取下一批待處理文件 (always use latest params)"""
+    def select_pending_files(self, max_files=None, max_size_gb=None):
+        """依檔數與大小上限組合待處理文件（不建立批次），回傳 (文件列表, 總大小)"""
         # Always use the latest values from params if not explicitly provided
         max_files = params.get('batch_size', 1000) if max_files is None else max_files
         max_size_gb = params.get('batch_size_gb', 90) if max_size_gb is None else max_size_gb
 
         max_size_bytes = max_size_gb * 1024 * 1024 * 1024
 
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT id, path, size
-            FROM files
-            WHERE status='pending'
-            ORDER BY id ASC
-            LIMIT ?
-        """, (max_files * 2,))
-
-        pending_files = cur.fetchall()
+        pending_files = select_files_with_status(self.conn, 'pending', max_files * 2)
 
-        if not pending_files:
-            return []
+        # 成本感知: 預估 Photos 處理時間不超過目標（至少選一個文件）
+        process_budget = None
+        media_types = {}
+        if pending_files and params.get('cost_aware_batching', True):
+            cost_model.refresh(self.conn)
+            process_budget = cost_model.process_budget_seconds(max_files, max_size_bytes)
+            media_types = self.lookup_media_types([row[0] for row in pending_files])
 
         # 動態組合批次
         selected_files = []
         current_size = 0
+        predicted_seconds = 0.0
 
         for file_id, path, size in pending_files:
             if (len(selected_files) >= max_files or
                     current_size + size > max_size_bytes):
                 break
 
+            media_type = media_types.get(file_id)
+            if process_budget is not None:
+                file_seconds = cost_model.file_process_seconds(media_type, size)
+                if selected_files and predicted_seconds + file_seconds > process_budget:
+                    break
+                predicted_seconds += file_seconds
+
             selected_files.append({
                 'id': file_id,
                 'path': path,
-                'size': size
+                'size': size,
+                'media_type': media_type
             })
             current_size += size
 
+        if process_budget is not None and selected_files:
+            log(f"[成本模型] 預估處理 {(predicted_seconds + cost_model.overhead) / 60:.1f} 分鐘"
+                f"（上限 {(process_budget + cost_model.overhead) / 60:.1f} 分鐘）")
+        return selected_files, current_size
+
+    def lookup_media_types(self, file_ids):
+        """{file_id: media_type}（以主鍵查詢，不影響狀態選取的覆蓋索引）"""
+        cur = self.conn.cursor()
+        placeholders = ','.join('?' * len(file_ids))
+        cur.execute(f"SELECT id, media_type FROM file_entries WHERE id IN ({placeholders})", file_ids)
+        return dict(cur.fetchall())
+
+    def get_next_file_batch(self, max_files=None, max_size_gb=None):
+        """獲取下一批待處理文件 (always use latest params)"""
+        # 退避時間已到的失敗文件先回到待處理（每批一次；預讀查詢不觸發寫入）
+        requeue_due_retries(self.conn)
+        selected_files, current_size = self.select_pending_files(max_files, max_size_gb)
+
+        if not selected_files:
+            return []
+
+        # 選到文件才建立批次，批次歷史與成員表使用同一個新批次 id
+        self.start_new_batch()
+        try:
+            record_batch(self.conn, self.current_batch_id, self.batch_start_time, selected_files)
+        except Exception as e:
+            log(f"[記錄錯誤] 無法記錄批次歷史: {e}")
+
         self.batch_files = selected_files
         self.batch_total_size = current_size
-
-        # 記錄批次歷史
-        if selected_files:
-            try:
-                cur.execute("""
-                    INSERT INTO batch_history (virtual_batch_id, start_time, file_count, total_size)
-                    VALUES (?, ?, ?, ?)
-                """, (self.current_batch_id, self.batch_start_time,
-                      len(selected_files), current_size))
-                self.conn.commit()
-            except Exception as e:
-                log(f"[記錄錯誤] 無法記錄批次歷史: {e}")
         log(f"[動態批次] 選擇 {len(selected_files)} 個文件，總大小 {current_size/1024/1024:.1f}MB")
+
+        # 批次內預讀：推送從頭開始消耗，暫存線程在前方複製
+        staging_cache.prefetch(selected_files)
         return selected_files
 
-    def mark_file_pushed(self, file_path):
+    def prefetch_next_batch(self):
+        """推送完成後預讀下一批（在等待備份/處理期間複製到本地暫存）"""
+        upcoming, _ = self.select_pending_files()
+        staging_cache.prefetch(upcoming)
+
+    def mark_file_pushed(self, file_path, file_id=None):
         """標記文件為已推送 - 靜默版本"""
         cur = self.conn.cursor()
         push_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         try:
-            # 檢查 push_time 列是否存在
-            cur.execute("PRAGMA table_info(files)")
-            columns = {row[1] for row in cur.fetchall()}
+            if file_id is None:
+                file_id = lookup_file_id(self.conn, file_path)
 
-            if 'push_time' in columns:
-                cur.execute("""
-                    UPDATE files SET status='pushed', push_time=?, updated_at=CURRENT_TIMESTAMP
-                    WHERE path=?
-                """, (push_time, file_path))
-            else:
-                cur.execute("""
-                    UPDATE files SET status='pushed', updated_at=CURRENT_TIMESTAMP
-                    WHERE path=?
-                """, (file_path,))
+            cur.execute("""
+                UPDATE file_entries SET status='pushed', push_time=?, updated_at=CURRENT_TIMESTAMP
+                WHERE id=?
+            """, (push_time, file_id))
 
             if cur.rowcount > 0:
                 self.successful_pushes += 1
@@ -609,47 +2113,23 @@ class DynamicBatchManager:
             console.print(f"[red]數據庫錯誤: {e}[/red]")
             return False
 
-    def mark_file_failed(self, file_path, error_msg=None):
-        """標記文件推送失敗 - 靜默版本"""
+    def mark_file_failed(self, file_path, error_msg=None, file_id=None):
+        """標記文件推送失敗並排入重試通道 - 靜默版本"""
         try:
-            cur = self.conn.cursor()
-            cur.execute("""
-                UPDATE files SET status='failed', updated_at=CURRENT_TIMESTAMP
-                WHERE path=?
-            """, (file_path,))
-            self.conn.commit()
+            if file_id is None:
+                file_id = lookup_file_id(self.conn, file_path)
+            schedule_file_retry(self.conn, file_id)
             # 錯誤信息由調用方的 rich console 處理
         except Exception as e:
             console.print(f"[red]數據庫錯誤: {e}[/red]")
 
     def complete_batch(self, batch_status='completed'):
-        """完成當前批次 - 修復版 (guard against zero-file batch)"""
+        """完成當前批次（成功數由批次成員表統計，臨時管理器亦適用）"""
         if not self.current_batch_id:
             return
 
-        total_files = len(self.batch_files)
-        if total_files == 0:
-            log(f"[批次完成] {self.current_batch_id}: 無文件，批次略過 (成功推送: {self.successful_pushes})")
-            # Optionally reset successful_pushes to zero for safety
-            self.successful_pushes = 0
-            self.current_batch_id = None
-            self.batch_files = []
-            return
-
         try:
-            end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-            cur = self.conn.cursor()
-            cur.execute("""
-                UPDATE batch_history
-                SET end_time=?, success_count=?, status=?
-                WHERE virtual_batch_id=?
-            """, (end_time, self.successful_pushes, batch_status, self.current_batch_id))
-            self.conn.commit()
-
-            success_rate = (self.successful_pushes / total_files) * 100
-            log(f"[批次完成] {self.current_batch_id}: {self.successful_pushes}/{total_files} ({success_rate:.1f}%)")
-
+            finalize_batch(self.conn, self.current_batch_id, batch_status)
         except Exception as e:
             log(f"[批次記錄錯誤] 無法更新批次狀態: {e}")
         finally:
@@ -696,16 +2176,305 @@ def move_remote_folder_safe(src_folder, dst_folder):
         return False
 
 
-def cleanup_camera_folder(camera_folder):
-    """清理Camera目錄中的批次資料夾"""
+class RemoteCleanupQueue:
+    """背景刪除已備份的批次資料夾
+
+    rm -rf 在獨立線程執行，與下一批次的搬移/備份等待並行。刪除成功後釋放該批次的
+    存儲預留；失敗則以指數退避重試，超過次數後記入 failed 供下次啟動時重試。
+    佇列清空時才觸發一次媒體掃描，避免每個資料夾各掃一次。
+    """
+
+    def __init__(self, max_attempts=5, base_delay=5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.pending = {}   # folder -> batch_id（排隊、執行或等待重試中）
+        self.failed = {}    # folder -> batch_id（超過重試次數）
+        self.thread = None
+
+    def submit(self, folder, batch_id=None):
+        """排入刪除；同一資料夾重複提交會被忽略"""
+        with self.lock:
+            if folder in self.pending:
+                return
+            self.pending[folder] = batch_id
+            self.failed.pop(folder, None)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+        log(f"[清理] 排入背景刪除: {folder}")
+        self.queue.put((folder, batch_id, 1))
+
+    def retry_failed(self):
+        """重新排入先前失敗的資料夾"""
+        with self.lock:
+            failed = list(self.failed.items())
+        for folder, batch_id in failed:
+            self.submit(folder, batch_id)
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def _schedule_retry(self, folder, batch_id, attempt):
+        delay = self.base_delay * 2 ** (attempt - 1)
+        timer = threading.Timer(delay, self.queue.put, args=((folder, batch_id, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+        return delay
+
+    def _worker(self):
+        scan_needed = False
+        while True:
+            try:
+                folder, batch_id, attempt = self.queue.get(timeout=1)
+            except Empty:
+                # 佇列清空後合併觸發一次媒體掃描
+                if scan_needed:
+                    try:
+                        adb_trigger_media_scan(CAMERA_ROOT)
+                    except Exception as e:
+                        log(f"[清理] 媒體掃描失敗: {e}")
+                    scan_needed = False
+                continue
+
+            try:
+                adb_remove_remote_folder(folder)
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    delay = self._schedule_retry(folder, batch_id, attempt)
+                    log(f"[清理失敗] {folder} (第 {attempt} 次): {e}，{delay} 秒後重試")
+                else:
+                    with self.lock:
+                        self.pending.pop(folder, None)
+                        self.failed[folder] = batch_id
+                    log(f"[清理失敗] {folder}: 已重試 {attempt} 次，放棄: {e}")
+                    # 文件仍在手機上，改由 df 反映實際占用
+                    if batch_id:
+                        storage_ledger.release(batch_id)
+                continue
+
+            with self.lock:
+                self.pending.pop(folder, None)
+            if batch_id:
+                storage_ledger.release(batch_id)
+            scan_needed = True
+            log(f"[清理成功] {folder}")
+
+
+remote_cleanup = RemoteCleanupQueue()
+
+
+# /////////////////////////////////////////////////////////////////////////////
+# 本地暫存快取（NAS 來源預讀）
+# 來源在網路磁碟時，adb push 同時等待網路讀取與 USB 寫入。暫存線程把即將推送的文件
+# 先複製到本地 SSD，推送改讀本地副本，網路 I/O 與設備傳輸因此重疊進行。
+
+NETWORK_FS_TYPES = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', '9p', 'afpfs'}
+_network_root_cache = {}
+
+
+def _posix_mount_fstype(path):
+    """path 所在掛載點的檔案系統類型（讀取 /proc/mounts）"""
+    best_mount, best_type = '', ''
     try:
-        log(f"[清理] 刪除Camera資料夾: {camera_folder}")
-        adb_remove_remote_folder(camera_folder)
-        # 觸發媒體掃描
-        adb_trigger_media_scan(CAMERA_ROOT)
-        log(f"[清理成功] {camera_folder}")
-    except Exception as e:
-        log(f"[清理失敗] {camera_folder}: {e}")
+        with open('/proc/mounts', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount_point = parts[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > len(best_mount):
+                    best_mount, best_type = mount_point, parts[2]
+    except OSError:
+        pass
+    return best_mount, best_type
+
+
+def is_network_path(path):
+    """UNC 路徑、Windows 網路磁碟機或 NFS/SMB 掛載"""
+    if path.startswith('\\\\') or path.startswith('//'):
+        return True
+
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        if drive not in _network_root_cache:
+            try:
+                import ctypes
+                # DRIVE_REMOTE = 4
+                _network_root_cache[drive] = ctypes.windll.kernel32.GetDriveTypeW(drive + '\\') == 4
+            except (ImportError, AttributeError, OSError):
+                _network_root_cache[drive] = False
+        return _network_root_cache[drive]
+
+    mount_point, fstype = _posix_mount_fstype(os.path.abspath(path))
+    if mount_point not in _network_root_cache:
+        _network_root_cache[mount_point] = fstype in NETWORK_FS_TYPES
+    return _network_root_cache[mount_point]
+
+
+class StagingCache:
+    """有上限的本地暫存目錄（LRU）與背景預讀線程
+
+    最近一次 prefetch() 要求的文件在被 take() 取用前保持鎖定；已取用但未 discard()（推送失敗、
+    中途停止）的副本依最近使用順序先淘汰，其次是不在最近一次要求內、未取用的副本（之後被選入
+    其他批次、標記失敗或上限不同而落選），由舊到新。空間不足且無可淘汰副本時，預讀等待推送釋放空間。
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.root = None
+        self.max_bytes = 0
+        self.mode = 'off'
+        self.entries = OrderedDict()   # 來源路徑 -> (暫存路徑, 大小, 是否已取用)
+        self.total_bytes = 0
+        self.queued = set()
+        self.wanted = set()            # 最近一次 prefetch() 要求的來源路徑
+        self.copying = set()
+        self.queue = Queue()
+        self.thread = None
+
+    def configure(self):
+        """依 params 設定並清空暫存目錄（每次開始處理時呼叫）"""
+        self.clear()
+        with self.cond:
+            self.mode = params.get('staging_mode', 'network')
+            self.max_bytes = int(params.get('staging_max_gb', 20) * 1024 ** 3)
+            self.root = params.get('staging_dir') or os.path.join(tempfile.gettempdir(), 'filetransfer_staging')
+        if self.mode != 'off':
+            os.makedirs(self.root, exist_ok=True)
+
+    def _wants(self, file_info):
+        if self.mode == 'off' or not self.root:
+            return False
+        if file_info['size'] > self.max_bytes:
+            return False
+        return self.mode == 'all' or is_network_path(file_info['path'])
+
+    def prefetch(self, file_batch):
+        """排入背景複製（已暫存或已排隊的文件略過）；不在本次要求內的副本解除鎖定、排隊取消"""
+        wanted = [f for f in file_batch if self._wants(f)]
+        with self.cond:
+            self.wanted = {f['path'] for f in wanted}
+            self.queued &= self.wanted
+            self.cond.notify_all()
+            if not wanted:
+                return
+            for file_info in wanted:
+                path = file_info['path']
+                if path in self.entries or path in self.queued or path in self.copying:
+                    continue
+                self.queued.add(path)
+                self.queue.put(file_info)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+
+    def take(self, path):
+        """回傳推送應讀取的路徑：已暫存則為本地副本，否則為來源（並取消其預讀）"""
+        with self.cond:
+            self.queued.discard(path)
+            while path in self.copying and batch_processing:
+                self.cond.wait(1)
+            entry = self.entries.get(path)
+            if not entry:
+                return path
+            staged_path, size, _ = entry
+            if not os.path.exists(staged_path) or os.path.getsize(staged_path) != size:
+                self._remove(path)
+                return path
+            self.entries[path] = (staged_path, size, True)
+            self.entries.move_to_end(path)
+            return staged_path
+
+    def discard(self, path):
+        """推送成功後刪除本地副本"""
+        with self.cond:
+            self._remove(path)
+            self.cond.notify_all()
+
+    def cancel(self):
+        """取消尚未開始的預讀"""
+        with self.cond:
+            self.queued.clear()
+            self.cond.notify_all()
+
+    def clear(self):
+        """取消預讀並刪除全部暫存副本"""
+        with self.cond:
+            self.queued.clear()
+            self.wanted.clear()
+            while self.copying:
+                self.cond.wait(1)
+            self.entries.clear()
+            self.total_bytes = 0
+            root = self.root
+            self.cond.notify_all()
+        if root and os.path.isdir(root):
+            shutil.rmtree(root, ignore_errors=True)
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.total_bytes -= entry[1]
+            try:
+                os.remove(entry[0])
+                os.rmdir(os.path.dirname(entry[0]))
+            except OSError:
+                pass
+
+    def _make_room(self, size):
+        """依序淘汰已取用、再淘汰已不需要的最舊副本直到放得下；仍不足時回傳 False"""
+        if self.total_bytes + size <= self.max_bytes:
+            return True
+        taken = [p for p, (_, _, is_taken) in self.entries.items() if is_taken]
+        stale = [p for p, (_, _, is_taken) in self.entries.items() if not is_taken and p not in self.wanted]
+        for path in taken + stale:
+            self._remove(path)
+            if self.total_bytes + size <= self.max_bytes:
+                return True
+        return False
+
+    def _worker(self):
+        while True:
+            file_info = self.queue.get()
+            path, size = file_info['path'], file_info['size']
+
+            with self.cond:
+                # 等待空間；期間被取用或取消則放棄
+                while path in self.queued and not self._make_room(size):
+                    self.cond.wait(1)
+                if path not in self.queued:
+                    continue
+                self.queued.discard(path)
+                self.copying.add(path)
+                key = path_key(path) & 0xFFFFFFFFFFFFFFFF
+                staged_path = os.path.join(self.root, f"{key:016x}", os.path.basename(path))
+                self.total_bytes += size
+
+            ok = False
+            try:
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                temp_path = staged_path + '.part'
+                shutil.copyfile(path, temp_path)
+                os.replace(temp_path, staged_path)
+                ok = os.path.getsize(staged_path) == size
+            except OSError as e:
+                log(f"[暫存] 複製失敗 {os.path.basename(path)}: {e}")
+
+            with self.cond:
+                self.copying.discard(path)
+                if ok:
+                    self.entries[path] = (staged_path, size, False)
+                else:
+                    self.total_bytes -= size
+                    shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
+                self.cond.notify_all()
+
+
+staging_cache = StagingCache()
 
 
 # /////////////////////////////////////////////////////////////////////////////
@@ -722,26 +2491,691 @@ def get_pid():
 
 def get_cpu_usage():
     try:
+        cpu = 0.0
         pid = get_pid()
-        if not pid:
-            return 0.0
-
-        output = run_adb_command(['shell', 'top', '-n', '1'])
-        for line in output.splitlines():
-            if pid in line and 'grep' not in line:
-                parts = line.split()
-                if len(parts) > 8:
-                    cpu_str = parts[8]
-                    try:
-                        return float(cpu_str.strip('%'))
-                    except Exception:
-                        return 0.0
-        return 0.0
+        if pid:
+            output = run_adb_command(['shell', 'top', '-n', '1'])
+            for line in output.splitlines():
+                if pid in line and 'grep' not in line:
+                    parts = line.split()
+                    if len(parts) > 8:
+                        cpu_str = parts[8]
+                        try:
+                            cpu = float(cpu_str.strip('%'))
+                        except Exception:
+                            cpu = 0.0
+                        break
+        return cpu
     except Exception as e:
         log(f"取得 CPU 使用率錯誤: {e}")
         return 0.0
 
 
+# /////////////////////////////////////////////////////////////////////////////
+# 遙測時間序列儲存
+# 固定寬度記錄的環形檔（mmap），分 1 秒 / 1 分 / 1 小時三層；每層獨立環形覆寫，
+# 較粗的層由同一樣本流聚合而成，可查詢數小時到數月的歷史而不需常駐 Python 物件。
+
+TELEMETRY_MAGIC = b'GPTM'
+TELEMETRY_VERSION = 1
+# 每層: (解析度秒數, 容量) - 1 秒保留 6 小時、1 分保留 7 天、1 小時保留 1 年
+TELEMETRY_LEVELS = ((1, 6 * 3600), (60, 7 * 24 * 60), (3600, 366 * 24))
+TELEMETRY_HEADER = struct.Struct('<4sII')          # magic, version, 層數
+TELEMETRY_LEVEL_HEADER = struct.Struct('<III')     # 解析度, 容量, 已寫入總數
+# 區間起點, CPU 平均, CPU 最大, 手機可用 GB, 推送 MB/s, 樣本數
+TELEMETRY_RECORD = struct.Struct('<dffffI')
+TELEMETRY_FIELDS = ('time', 'cpu_avg', 'cpu_max', 'storage_free_gb', 'throughput_mbps', 'samples')
+
+
+class TelemetryStore:
+    """多解析度遙測環形檔
+
+    append() 寫入單一樣本，各層以區間起點聚合；區間結束時才寫成一筆記錄，
+    尚未結束的區間保留在記憶體，查詢時一併回傳。重開檔案時若最後一筆與新樣本屬同一區間，
+    會把它讀回繼續累積。
+    """
+
+    def __init__(self, path, levels=TELEMETRY_LEVELS):
+        self.path = path
+        self.levels = levels
+        self.lock = threading.Lock()
+        self.mm = None
+        self.file = None
+        self.level_offsets = []
+        self.written = [0] * len(levels)
+        self.pending = [None] * len(levels)
+
+    def _file_size(self):
+        size = TELEMETRY_HEADER.size + TELEMETRY_LEVEL_HEADER.size * len(self.levels)
+        return size + sum(capacity for _, capacity in self.levels) * TELEMETRY_RECORD.size
+
+    def open(self):
+        """開啟或建立環形檔；格式不符（版本或層設定改變）時重新建立"""
+        if self.mm is not None:
+            return
+        size = self._file_size()
+        mode = 'r+b' if os.path.exists(self.path) else 'w+b'
+        self.file = open(self.path, mode)
+        if os.fstat(self.file.fileno()).st_size != size:
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+
+        magic, version, level_count = TELEMETRY_HEADER.unpack_from(self.mm, 0)
+        offset = TELEMETRY_HEADER.size
+        valid = magic == TELEMETRY_MAGIC and version == TELEMETRY_VERSION and level_count == len(self.levels)
+        for index, (resolution, capacity) in enumerate(self.levels):
+            stored = TELEMETRY_LEVEL_HEADER.unpack_from(self.mm, offset + index * TELEMETRY_LEVEL_HEADER.size)
+            valid = valid and stored[:2] == (resolution, capacity)
+            self.written[index] = stored[2]
+        if not valid:
+            if magic != b'\0\0\0\0':
+                log(f"[遙測] {self.path} 格式不符，重新建立")
+            self.mm[:] = bytes(size)
+            TELEMETRY_HEADER.pack_into(self.mm, 0, TELEMETRY_MAGIC, TELEMETRY_VERSION, len(self.levels))
+            self.written = [0] * len(self.levels)
+            for index in range(len(self.levels)):
+                self._write_level_header(index)
+
+        offset += TELEMETRY_LEVEL_HEADER.size * len(self.levels)
+        self.level_offsets = []
+        for _, capacity in self.levels:
+            self.level_offsets.append(offset)
+            offset += capacity * TELEMETRY_RECORD.size
+
+    def _write_level_header(self, index):
+        resolution, capacity = self.levels[index]
+        TELEMETRY_LEVEL_HEADER.pack_into(
+            self.mm, TELEMETRY_HEADER.size + index * TELEMETRY_LEVEL_HEADER.size,
+            resolution, capacity, self.written[index])
+
+    def _slot_offset(self, index, sequence):
+        return self.level_offsets[index] + (sequence % self.levels[index][1]) * TELEMETRY_RECORD.size
+
+    def _read(self, index, sequence):
+        return TELEMETRY_RECORD.unpack_from(self.mm, self._slot_offset(index, sequence))
+
+    def _flush_pending(self, index):
+        pending = self.pending[index]
+        if pending is None:
+            return
+        TELEMETRY_RECORD.pack_into(self.mm, self._slot_offset(index, self.written[index]),
+                                   *self._pending_record(pending))
+        self.written[index] += 1
+        self._write_level_header(index)
+        self.pending[index] = None
+
+    @staticmethod
+    def _pending_record(pending):
+        samples = pending['samples']
+        return (pending['time'], pending['cpu_sum'] / samples, pending['cpu_max'],
+                pending['storage'], pending['throughput_sum'] / samples, samples)
+
+    def _resume_pending(self, index, bucket):
+        """重開檔案後，最後一筆記錄若與新樣本同區間則讀回繼續累積"""
+        if not self.written[index]:
+            return None
+        record = self._read(index, self.written[index] - 1)
+        if record[0] != bucket or record[5] == 0:
+            return None
+        self.written[index] -= 1
+        t, cpu_avg, cpu_max, storage, throughput, samples = record
+        return {'time': t, 'cpu_sum': cpu_avg * samples, 'cpu_max': cpu_max,
+                'storage': storage, 'throughput_sum': throughput * samples, 'samples': samples}
+
+    def append(self, cpu, storage_free_gb=None, throughput_mbps=0.0, now=None):
+        """寫入一個樣本（storage_free_gb 未知時記為 NaN）"""
+        now = time.time() if now is None else now
+        storage = float('nan') if storage_free_gb is None else float(storage_free_gb)
+        with self.lock:
+            self.open()
+            for index, (resolution, _) in enumerate(self.levels):
+                bucket = float(int(now // resolution) * resolution)
+                pending = self.pending[index]
+                if pending is not None and pending['time'] != bucket:
+                    self._flush_pending(index)
+                    pending = None
+                if pending is None:
+                    pending = self._resume_pending(index, bucket) or {
+                        'time': bucket, 'cpu_sum': 0.0, 'cpu_max': 0.0,
+                        'storage': float('nan'), 'throughput_sum': 0.0, 'samples': 0}
+                    self.pending[index] = pending
+                pending['cpu_sum'] += cpu
+                pending['cpu_max'] = max(pending['cpu_max'], cpu)
+                if not math.isnan(storage):
+                    pending['storage'] = storage
+                pending['throughput_sum'] += throughput_mbps
+                pending['samples'] += 1
+
+    def _choose_level(self, start, end, max_points):
+        """最細且能涵蓋起點、點數不超過 max_points 的層"""
+        for index, (resolution, capacity) in enumerate(self.levels):
+            oldest = None
+            if self.written[index] > capacity:
+                oldest = self._read(index, self.written[index] - capacity)[0]
+            covers = oldest is None or oldest <= start
+            if covers and (end - start) / resolution <= max_points:
+                return index
+        return len(self.levels) - 1
+
+    def query(self, start, end=None, max_points=600, resolution=None):
+        """查詢 [start, end) 的記錄，回傳 {'resolution', 欄位名: list}
+
+        未指定 resolution 時自動選層；只解碼區間內的記錄。
+        """
+        end = time.time() if end is None else end
+        result = {'resolution': None}
+        result.update({field: [] for field in TELEMETRY_FIELDS})
+        with self.lock:
+            if self.mm is None:
+                if not os.path.exists(self.path):
+                    return result
+                self.open()
+            if resolution is None:
+                index = self._choose_level(start, end, max_points)
+            else:
+                index = min(range(len(self.levels)), key=lambda i: abs(self.levels[i][0] - resolution))
+            result['resolution'] = self.levels[index][0]
+
+            written, capacity = self.written[index], self.levels[index][1]
+            first = max(0, written - capacity)
+            # 記錄依時間遞增寫入，二分搜尋區間起點
+            low, high = first, written
+            while low < high:
+                middle = (low + high) // 2
+                if self._read(index, middle)[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            records = []
+            for sequence in range(low, written):
+                record = self._read(index, sequence)
+                if record[0] >= end:
+                    break
+                records.append(record)
+            pending = self.pending[index]
+            if pending is not None and start <= pending['time'] < end:
+                records.append(self._pending_record(pending))
+
+        for record in records:
+            for field, value in zip(TELEMETRY_FIELDS, record):
+                result[field].append(value)
+        return result
+
+    def summary(self, seconds):
+        """最近 seconds 秒的 CPU 平均/最大與平均推送速率"""
+        data = self.query(time.time() - seconds, max_points=2000)
+        samples = sum(data['samples'])
+        if not samples:
+            return None
+        weighted = lambda values: sum(v * n for v, n in zip(values, data['samples'])) / samples
+        return {
+            'cpu_avg': weighted(data['cpu_avg']),
+            'cpu_max': max(data['cpu_max']),
+            'throughput_mbps': weighted(data['throughput_mbps']),
+            'samples': samples,
+        }
+
+    def close(self):
+        """寫出未結束的區間並關閉檔案"""
+        with self.lock:
+            if self.mm is None:
+                return
+            for index in range(len(self.levels)):
+                self._flush_pending(index)
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+            self.file = None
+
+
+def telemetry_path():
+    return params.get('telemetry_path') or f"{os.path.splitext(DB_PATH)[0]}.telemetry"
+
+
+telemetry = TelemetryStore(telemetry_path())
+
+class ThroughputMeter:
+    """推送位元組計量: 累計總量與滑動窗口速率（續傳推送逐塊計入，一般推送完成時計入）"""
+
+    def __init__(self, window=30):
+        self.window = window
+        self.lock = threading.Lock()
+        self.total = 0
+        self.started = None
+        self.events = deque()   # (時間, 位元組)
+
+    def add(self, size, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.total += size
+            if self.started is None:
+                self.started = now
+            self.events.append((now, size))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+
+    def total_bytes(self):
+        with self.lock:
+            return self.total
+
+    def rate(self, now=None):
+        """最近 window 秒的平均位元組/秒（剛開始推送時以實際經過時間計算）"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self._trim(now)
+            if self.started is None or not self.events:
+                return 0.0
+            span = min(self.window, now - self.started)
+            return sum(size for _, size in self.events) / span if span > 0 else 0.0
+
+
+# 推送位元組累計（遙測以相鄰樣本的差值計算推送速率，進度與 ETA 讀取滑動速率）
+transfer_meter = ThroughputMeter()
+
+
+def make_telemetry_sampler():
+    """回傳 sample(cpu)，以推送位元組差值計算速率並寫入遙測；可用空間取存儲帳本的快取快照"""
+    last = {'time': time.time(), 'bytes': transfer_meter.total_bytes()}
+
+    def sample(cpu):
+        now = time.time()
+        total = transfer_meter.total_bytes()
+        elapsed = now - last['time']
+        throughput = (total - last['bytes']) / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+        last['time'], last['bytes'] = now, total
+        snapshot = storage_ledger.snapshot
+        storage_gb = snapshot['available_bytes'] / (1024 ** 3) if snapshot else None
+        try:
+            telemetry.append(cpu, storage_gb, throughput, now)
+        except (OSError, ValueError) as e:
+            log(f"[遙測] 寫入失敗: {e}")
+
+    return sample
+
+
+# /////////////////////////////////////////////////////////////////////////////
+# 閒置偵測
+# 單一 CPU 尖峰不應讓備份等待歸零，持續下降也應及早辨識。IdleDetector 以 EWMA 加遲滯
+# 判定活躍/閒置狀態，並以 CUSUM（活躍均值 門檻+δ 與閒置均值 門檻-δ 的對數似然比累積）
+# 偵測「轉為閒置」的變點；判定門檻 ln(1/(1-信心)) 對應單側序貫檢定的誤報率。
+
+class IdleDetector:
+    """EWMA + 遲滯 + CUSUM 變點偵測的 CPU 閒置判定"""
+
+    def __init__(self, threshold=None, alpha=None, hysteresis=None, confidence=None,
+                 min_idle_seconds=None, active=True):
+        self.threshold = float(params['cpu_threshold'] if threshold is None else threshold)
+        self.alpha = params.get('idle_ewma_alpha', 0.2) if alpha is None else alpha
+        self.hysteresis = params.get('idle_hysteresis', 0.2) if hysteresis is None else hysteresis
+        confidence = params.get('idle_confidence', 0.95) if confidence is None else confidence
+        self.decision = math.log(1.0 / max(1e-6, 1.0 - confidence))
+        self.min_idle_seconds = (params.get('idle_min_seconds', 30)
+                                 if min_idle_seconds is None else min_idle_seconds)
+        self.active = active
+        self.ewma = None
+        self.variance = (self.threshold * 0.25) ** 2
+        self.cusum = 0.0
+        self.busy_run = 0
+        self.idle_since = None   # 閒置計時起點（變點估計）
+
+    def update(self, cpu, now=None):
+        now = time.time() if now is None else now
+        if self.ewma is None:
+            self.ewma = cpu
+        else:
+            diff = cpu - self.ewma
+            self.ewma += self.alpha * diff
+            self.variance = (1 - self.alpha) * (self.variance + self.alpha * diff * diff)
+
+        # 遲滯: 低於下緣才轉閒置，高於上緣才轉活躍
+        if self.active and self.ewma < self.threshold * (1 - self.hysteresis):
+            self.active = False
+        elif not self.active and self.ewma > self.threshold * (1 + self.hysteresis):
+            self.active = True
+
+        # 孤立尖峰不中斷閒置計時；連續兩個以上高負載樣本視為處理恢復，重新計時
+        self.busy_run = self.busy_run + 1 if cpu >= self.threshold else 0
+        if self.active or self.busy_run >= 2:
+            self.idle_since = None
+        elif self.idle_since is None and self.busy_run == 0:
+            self.idle_since = now
+
+        # CUSUM: 尖峰截尾，單一尖峰只扣回部分證據；累積量上限 3 倍門檻，持續活躍才會歸零
+        # σ 下限取門檻的一半，避免閒置時變異數收斂後單一樣本就越過判定值
+        sigma = max(math.sqrt(self.variance), self.threshold * 0.5, 1.0)
+        delta = self.threshold / 2
+        sample = min(cpu, self.threshold + 2 * sigma)
+        self.cusum += 2 * delta * (self.threshold - sample) / (sigma * sigma)
+        self.cusum = min(max(self.cusum, 0.0), 3 * self.decision)
+
+    def idle_seconds(self, now=None):
+        now = time.time() if now is None else now
+        return 0.0 if self.idle_since is None else now - self.idle_since
+
+    def backup_complete(self, now=None):
+        """EWMA 在閒置帶內、CUSUM 證據達判定值，且閒置計時已維持 min_idle_seconds"""
+        return (not self.active and self.idle_since is not None and self.cusum >= self.decision
+                and self.idle_seconds(now) >= self.min_idle_seconds)
+
+    def progress(self, now=None):
+        return min(self.idle_seconds(now), self.min_idle_seconds), self.min_idle_seconds
+
+    def describe(self, cpu):
+        return (f"CPU {cpu:.1f}% EWMA {self.ewma or 0:.1f}% "
+                f"證據 {min(self.cusum / self.decision, 1.0):.0%}")
+
+
+class StableWindowDetector:
+    """舊版規則: 連續 required_stable 秒低於門檻，任一高於門檻的樣本即歸零"""
+
+    def __init__(self, required_stable, threshold=None, interval=None):
+        self.required_stable = required_stable
+        self.threshold = params['cpu_threshold'] if threshold is None else threshold
+        self.interval = params['monitor_interval'] if interval is None else interval
+        self.stable_seconds = 0
+        self.last_time = None
+
+    def update(self, cpu, now=None):
+        now = time.time() if now is None else now
+        elapsed = self.interval if self.last_time is None else now - self.last_time
+        self.last_time = now
+        if cpu < self.threshold:
+            self.stable_seconds += elapsed
+        else:
+            self.stable_seconds = 0
+
+    def backup_complete(self, now=None):
+        return self.stable_seconds >= self.required_stable
+
+    def progress(self, now=None):
+        return min(self.stable_seconds, self.required_stable), self.required_stable
+
+    def describe(self, cpu):
+        return f"{self.stable_seconds:.0f}/{self.required_stable} 秒 (CPU: {cpu:.1f}%)"
+
+
+def create_backup_detector(required_stable):
+    if params.get('idle_detector', 'cusum') == 'legacy':
+        return StableWindowDetector(required_stable)
+    # 小批次快速模式縮短的等待時間同樣適用
+    return IdleDetector(min_idle_seconds=min(params.get('idle_min_seconds', 30), required_stable),
+                        active=True)
+
+
+# CPU 追蹤記錄（用於以實際負載回放驗證偵測器）
+# 每行 "時間,cpu"；每次備份等待開始時寫入 "時間,wait" 標記，回放以標記切分各批次。
+# 只記錄備份等待迴圈餵給偵測器的樣本（CPU 監控線程另有取樣，混入會使回放的取樣頻率與實際不同）。
+cpu_trace_lock = threading.Lock()
+
+
+def _append_cpu_trace(value):
+    trace_path = params.get('cpu_trace_path')
+    if not trace_path:
+        return
+    try:
+        with cpu_trace_lock, open(trace_path, 'a', encoding='utf-8') as f:
+            f.write(f"{time.time():.3f},{value}\n")
+    except OSError as e:
+        log(f"[CPU追蹤] 寫入失敗: {e}")
+
+
+def record_cpu_sample(cpu):
+    _append_cpu_trace(f"{cpu:.1f}")
+
+
+def record_wait_marker():
+    _append_cpu_trace("wait")
+
+
+def load_cpu_trace(trace_path):
+    """讀取追蹤檔，回傳 (樣本 [(秒數, cpu)], 等待開始時間 [秒數])，時間相對第一行"""
+    samples, markers = [], []
+    with open(trace_path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split(',')
+            try:
+                t = float(parts[0])
+            except (ValueError, IndexError):
+                continue   # 標題列或損壞行
+            if len(parts) > 1 and parts[1] == 'wait':
+                markers.append(t)
+                continue
+            try:
+                samples.append((t, float(parts[1])))
+            except (ValueError, IndexError):
+                continue
+    samples.sort()
+    markers.sort()
+    start = min(samples[0][0] if samples else 0, markers[0] if markers else float('inf'))
+    return [(t - start, cpu) for t, cpu in samples], [t - start for t in markers]
+
+
+def replay_cpu_trace(samples, markers, make_detector, threshold=None):
+    """以追蹤樣本重演每次備份等待
+
+    每個等待區段從標記開始、到下一個標記為止（無標記時整段視為一次等待）。
+    判定完成後、同一區段內再出現連續 3 個高於門檻的樣本，即計為誤判（Photos 仍在處理）。
+    回傳 {'waits', 'completions', 'false_completions', 'mean_wait', 'mean_handoff'}；
+    mean_wait 為正確判定的平均等待秒數，mean_handoff 為最後一個高負載樣本到判定完成的平均延遲。
+    """
+    threshold = params['cpu_threshold'] if threshold is None else threshold
+    bounds = markers or [samples[0][0] if samples else 0]
+    segments = [(start, bounds[i + 1] if i + 1 < len(bounds) else float('inf'))
+                for i, start in enumerate(bounds)]
+    completions, false_completions, waits, handoffs = 0, 0, [], []
+
+    for start, end in segments:
+        segment = [(t, cpu) for t, cpu in samples if start <= t < end]
+        detector = make_detector()
+        for index, (t, cpu) in enumerate(segment):
+            detector.update(cpu, t)
+            if not detector.backup_complete(t):
+                continue
+            completions += 1
+            run = 0
+            for _, later_cpu in segment[index + 1:]:
+                run = run + 1 if later_cpu >= threshold else 0
+                if run >= 3:
+                    false_completions += 1
+                    break
+            else:
+                waits.append(t - start)
+                last_busy = max((bt for bt, bcpu in segment[:index + 1] if bcpu >= threshold),
+                                default=start)
+                handoffs.append(t - last_busy)
+            break
+
+    return {
+        'waits': len(segments),
+        'completions': completions,
+        'false_completions': false_completions,
+        'mean_wait': sum(waits) / len(waits) if waits else None,
+        'mean_handoff': sum(handoffs) / len(handoffs) if handoffs else None,
+    }
+
+
+def print_cpu_trace_replay(trace_path):
+    """比較舊版穩定窗口與變點偵測器在追蹤檔上的表現"""
+    samples, markers = load_cpu_trace(trace_path)
+    duration = samples[-1][0] if samples else 0
+    print(f"[CPU回放] {trace_path}: {len(samples)} 個樣本，{len(markers)} 次等待，{duration:.0f} 秒")
+    detectors = {
+        'legacy': lambda: StableWindowDetector(params.get('backup_stable_time', 30)),
+        'cusum': lambda: IdleDetector(active=True),
+    }
+    for name, make_detector in detectors.items():
+        result = replay_cpu_trace(samples, markers, make_detector)
+        mean_wait = f"{result['mean_wait']:.1f} 秒" if result['mean_wait'] is not None else "-"
+        handoff = f"{result['mean_handoff']:.1f} 秒" if result['mean_handoff'] is not None else "-"
+        print(f"[CPU回放] {name:6s}: 判定完成 {result['completions']}/{result['waits']}，"
+              f"誤判 {result['false_completions']}，平均等待 {mean_wait}，平均交接延遲 {handoff}")
+
+
+# /////////////////////////////////////////////////////////////////////////////
+# 裝置健康監控與斷路器
+# USB 斷線時每個 adb push 都會失敗；推送前先確認裝置在線，離線即暫停流水線等待重新連線，
+# 而不是把整批文件逐一標記為失敗。裝置在線仍連續失敗時由斷路器暫停推送一段時間。
+
+class DeviceHealthMonitor:
+    """以 adb get-state 輪詢裝置連線狀態，online 為在線事件"""
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.online = threading.Event()
+        self.online.set()   # 首次輪詢前假設在線
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.disconnects = 0
+        self.offline_since = None
+
+    @staticmethod
+    def probe():
+        """裝置處於 device 狀態才算在線（offline / unauthorized / 無裝置皆為離線）"""
+        try:
+            result = subprocess.run(["adb", "get-state"], capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return result.returncode == 0 and result.stdout.strip() == 'device'
+
+    def check(self):
+        """立即探測一次並更新狀態，回傳是否在線"""
+        online = self.probe()
+        self._set_online(online)
+        return online
+
+    def _set_online(self, online):
+        if online == self.online.is_set():
+            return
+        if online:
+            offline_seconds = time.time() - (self.offline_since or time.time())
+            self.offline_since = None
+            self.online.set()
+            log(f"[裝置監控] 裝置重新連線（離線 {offline_seconds:.0f} 秒），恢復推送")
+            # 斷線期間的 df 快照與失敗計數已不可信
+            storage_ledger.invalidate()
+            push_breaker.reset()
+        else:
+            self.offline_since = time.time()
+            self.disconnects += 1
+            self.online.clear()
+            log("[裝置監控] 裝置離線，暫停推送等待重新連線")
+            # 中止卡在斷線連線上的推送，由推送循環在重新連線後重試
+            terminate_active_adb_processes()
+        notify_pipeline()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _worker(self):
+        log("[裝置監控] 線程啟動")
+        while not self.stop_event.is_set():
+            self.check()
+            self.stop_event.wait(self.interval or params.get('device_poll_interval', 3))
+        log("[裝置監控] 線程結束")
+
+
+class CircuitBreaker:
+    """推送斷路器: closed 正常放行；連續失敗達門檻轉 open 暫停；冷卻後 half_open 放行一次試探"""
+
+    def __init__(self, failure_threshold=None, reset_seconds=None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def _threshold(self):
+        return self.failure_threshold or params.get('breaker_failure_threshold', 5)
+
+    def _cooldown(self):
+        return self.reset_seconds or params.get('breaker_reset_seconds', 60)
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'open' if time.time() - self.opened_at < self._cooldown() else 'half_open'
+
+    def retry_in(self):
+        """距離可再嘗試推送的秒數，0 表示可推送"""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self._cooldown() - time.time())
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log("[斷路器] 試探推送成功，恢復正常")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            half_open = self.opened_at is not None
+            if half_open or self.failures >= self._threshold():
+                # 試探失敗重新計時
+                self.opened_at = time.time()
+                log(f"[斷路器] 連續 {self.failures} 次推送失敗，暫停推送 {self._cooldown()} 秒")
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+        notify_pipeline()
+
+
+device_health = DeviceHealthMonitor()
+push_breaker = CircuitBreaker()
+
+
+def wait_until_device_online():
+    """等待裝置重新連線，回傳是否仍在處理（停止請求時為 False）"""
+    if not device_health.online.is_set() and batch_processing:
+        console.print("[yellow]🔌 裝置離線，等待重新連線...[/yellow]")
+        device_health.start()
+        while not device_health.online.is_set() and batch_processing:
+            wait_pipeline(device_health.online.is_set, params.get('device_poll_interval', 3) * 2)
+    return batch_processing
+
+
+def run_when_online(action):
+    """裝置在線時執行 action()；因斷線失敗時等待重新連線後再試，回傳 action 是否成功"""
+    while wait_until_device_online():
+        if action():
+            return True
+        if device_health.check():
+            return False
+    return False
+
+
+def wait_until_transfer_ready():
+    """等待裝置在線且斷路器允許推送，回傳是否仍在處理（停止請求時為 False）"""
+    while batch_processing:
+        if not device_health.online.is_set():
+            wait_until_device_online()
+            continue
+        delay = push_breaker.retry_in()
+        if delay <= 0:
+            return True
+        console.print(f"[yellow]⛔ 斷路器開啟，{delay:.0f} 秒後試探推送[/yellow]")
+        wait_pipeline(lambda: push_breaker.retry_in() <= 0 or not device_health.online.is_set(), delay)
+    return False
+
+
 # /////////////////////////////////////////////////////////////////////////////
 # 批次推送及管理流程
 def clean_camera_batch():
@@ -759,6 +3193,18 @@ def clean_camera_batch():
         log(f"[清理] 失敗: {e}")
 
 
+def _release_unpushed(batch_manager, files):
+    """未推送即離開批次的文件（斷路器截斷、停止請求）移出本批成員與存儲預留，每個文件只屬於一個批次"""
+    if not files:
+        return
+    try:
+        release_batch_members(batch_manager.conn, batch_manager.current_batch_id,
+                              [f['id'] for f in files if f.get('id') is not None])
+    except Exception as e:
+        log(f"[批次成員] 移出未推送文件失敗: {e}")
+    storage_ledger.release_files(batch_manager.current_batch_id, [f['path'] for f in files])
+
+
 def push_files_individually(batch_manager, file_batch, remote_folder):
     """逐個推送文件 - 使用 rich.progress 清潔日誌版本"""
     try:
@@ -770,167 +3216,934 @@ def push_files_individually(batch_manager, file_batch, remote_folder):
     success_count = 0
     total_files = len(file_batch)
 
-    if total_files == 0:
-        return 0
+    if total_files == 0:
+        return 0
+
+    total_bytes = sum(f['size'] for f in file_batch)
+    done_files = 0
+
+    # 使用 rich.progress 顯示推送進度（以位元組計算，照片與大影片混合時速率與剩餘時間才有意義）
+    with Progress(
+        TextColumn("[bold blue]{task.description}"),
+        BarColumn(bar_width=40),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TextColumn("{task.fields[files]}"),
+        TimeElapsedColumn(),
+        TimeRemainingColumn(),
+        console=console,
+        transient=False,  # 保持進度條可見
+    ) as progress:
+
+        # 創建推送任務
+        task = progress.add_task(
+            f"[cyan]推送批次文件 ({total_files} 個)",
+            total=total_bytes,
+            files=f"0/{total_files} 檔"
+        )
+
+        for i, file_info in enumerate(file_batch):
+            file_path = file_info['path']
+            filename = os.path.basename(file_path)
+            file_advanced = 0
+            file_done = False   # 已推送或已記為失敗（仍屬本批）
+
+            def advance(size):
+                # 斷線重試時續傳會重送部分位元組，單一文件的進度不超過其大小
+                nonlocal file_advanced
+                size = min(size, file_info['size'] - file_advanced)
+                if size > 0:
+                    file_advanced += size
+                    progress.update(task, advance=size)
+
+            # 更新任務描述顯示當前文件
+            progress.update(
+                task,
+                description=f"[cyan]推送: {filename[:40]}{'...' if len(filename) > 40 else ''}"
+            )
+
+            # 裝置離線時暫停，重新連線後重試同一文件（不計入失敗）
+            while True:
+                if not wait_until_transfer_ready():
+                    break
+                try:
+                    # 推送單個文件 (靜默版本，不打印ADB日誌)，已預讀的文件改讀本地暫存
+                    read_path = staging_cache.take(file_path)
+                    adb_push_file_silent(file_path, remote_folder, read_path, advance)
+                    staging_cache.discard(file_path)
+                    push_breaker.record_success()
+
+                    # 立即標記為已推送
+                    if batch_manager.mark_file_pushed(file_path, file_info.get('id')):
+                        success_count += 1
+                    file_done = True
+                    break
+
+                except Exception as e:
+                    if not batch_processing:
+                        break
+                    if not device_health.check():
+                        console.print(f"[yellow]🔌 {filename}: 裝置離線，重新連線後重試[/yellow]")
+                        continue
+                    # 使用 rich 顯示錯誤，但不破壞進度條
+                    console.print(f"[red]✗ {filename}: {str(e)[:50]}[/red]")
+                    push_breaker.record_failure()
+                    batch_manager.mark_file_failed(file_path, str(e), file_info.get('id'))
+                    file_done = True
+                    break
+
+            if not batch_processing:
+                # 停止請求: 未推送的文件保持 pending，並移出本批（之後由其他批次接手）
+                log("[UI] 停止請求已收到，終止推送循環")
+                _release_unpushed(batch_manager, file_batch[i + 1:] + ([] if file_done else [file_info]))
+                break
+
+            # 更新進度: 失敗或續傳中斷的文件補足其剩餘位元組
+            done_files += 1
+            progress.update(task, advance=max(0, file_info['size'] - file_advanced),
+                            files=f"{done_files}/{total_files} 檔")
+
+            if push_breaker.retry_in() > 0:
+                # 斷路器開啟: 結束本批，其餘文件保持 pending，由下一批在冷卻後接手
+                console.print(f"[yellow]⛔ 斷路器開啟，本批其餘 {total_files - i - 1} 個文件保持待處理[/yellow]")
+                # 其餘文件會加入下一批，先移出本批成員，避免同時屬於兩個批次
+                _release_unpushed(batch_manager, file_batch[i + 1:])
+                break
+
+            # 每推送5個文件更新一次UI（避免過於頻繁）
+            if (i + 1) % 5 == 0 or (i + 1) == total_files:
+                update_pending_count_text()
+
+        # 完成後顯示摘要
+        progress.update(
+            task,
+            description=f"[green]✓ 批次推送完成: {success_count}/{total_files} 成功[/green]"
+        )
+
+    # 推送完成後最終更新
+    update_pending_count_text()
+
+    success_rate = (success_count / total_files) * 100
+
+    # 使用 rich 顯示最終結果
+    if success_rate >= 90:
+        console.print(
+            f"[green]✓ 推送完成: {success_count}/{total_files} ({success_rate:.1f}%)[/green]")
+    else:
+        console.print(
+            f"[yellow]⚠ 推送完成: {success_count}/{total_files} ({success_rate:.1f}%) - 成功率偏低[/yellow]")
+
+    return success_count
+
+
+def adb_push_file_silent(local_path, remote_folder, read_path=None, on_progress=None):
+    """靜默版本的文件推送，不打印詳細日誌（read_path 為實際讀取的本地暫存副本）
+
+    on_progress(位元組) 回報推送進度: 續傳推送逐塊回報，一般推送在完成時回報整個文件。
+    """
+    filename = os.path.basename(local_path)
+    remote_path = f"{remote_folder}/{filename}"
+    read_path = read_path or local_path
+    size = os.path.getsize(read_path)
+
+    if size >= params.get('resumable_push_threshold', 256 * 1024 * 1024):
+        transferred = 0
+
+        def on_chunk(chunk_size):
+            nonlocal transferred
+            transferred += chunk_size
+            transfer_meter.add(chunk_size)
+            if on_progress:
+                on_progress(chunk_size)
+
+        adb_push_file_resumable(local_path, remote_path, read_path, on_chunk)
+        # 先前中斷時已在遠端的部分只計入進度，不計入速率
+        if on_progress and size > transferred:
+            on_progress(size - transferred)
+        return
+
+    try:
+        # 執行推送，等待進程結束（停止請求會直接終止進程）
+        process = subprocess.Popen(["adb", "push", read_path, remote_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        with active_adb_lock:
+            active_adb_processes.add(process)
+        try:
+            if not batch_processing:
+                process.terminate()
+            _, stderr = process.communicate()
+        finally:
+            with active_adb_lock:
+                active_adb_processes.discard(process)
+    except Exception as e:
+        raise Exception(f"ADB推送失敗: {e}")
+
+    if not batch_processing:
+        log("[UI] 停止請求已收到，終止ADB推送進程")
+        raise Exception("推送被用戶中斷")
+
+    if process.returncode != 0:
+        # 檢查文件是否實際存在（有時推送成功但返回錯誤）
+        error = Exception(f"ADB推送失敗: {stderr}")
+        try:
+            output = run_adb_command(["shell", "ls", remote_path])
+        except Exception:
+            raise error
+        if filename not in output:
+            raise error
+        # 文件存在，視為成功
+    transfer_meter.add(size)
+    if on_progress:
+        on_progress(size)
+
+
+RESUMABLE_CHUNK = 1024 * 1024
+
+
+def get_remote_file_size(remote_path):
+    """遠端文件大小，不存在時回傳 0"""
+    output = run_adb_command(["shell", f"stat -c %s {shlex.quote(remote_path)} 2>/dev/null || echo 0"])
+    try:
+        return int(output.split()[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+def _local_md5(local_path):
+    md5 = hashlib.md5()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(RESUMABLE_CHUNK), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def adb_push_file_resumable(local_path, remote_path, read_path=None, on_chunk=None):
+    """大文件可續傳推送
+
+    先追加寫入 PARTIAL_ROOT 下以路徑/大小/修改時間命名的暫存檔，中斷或失敗後下次
+    從遠端已有的位元組數繼續（adb exec-in + cat >>），大小（可選 md5）驗證後再移入批次資料夾。
+    暫存檔名取自來源路徑，改讀本地暫存副本（read_path）時仍可續傳。
+    on_chunk(位元組) 在每塊寫入 adb 後呼叫。
+    """
+    filename = os.path.basename(local_path)
+    read_path = read_path or local_path
+    stat = os.stat(local_path)
+    size = stat.st_size
+    key = path_key(local_path) & 0xFFFFFFFFFFFFFFFF
+    partial_path = f"{PARTIAL_ROOT}/{key:016x}_{size}_{int(stat.st_mtime)}"
+    quoted_partial = shlex.quote(partial_path)
+
+    partial_root = shlex.quote(PARTIAL_ROOT)
+    run_adb_command(["shell", f"mkdir -p {partial_root} && touch {partial_root}/.nomedia"])
+
+    offset = get_remote_file_size(partial_path)
+    if offset > size:
+        run_adb_command(["shell", f"rm -f {quoted_partial}"])
+        offset = 0
+    if offset:
+        log(f"[續傳] {filename}: 從 {offset / 1024 ** 2:.1f}MB 繼續，剩餘 {(size - offset) / 1024 ** 2:.1f}MB")
+
+    if offset < size:
+        # cat 只追加完整收到的位元組，中途終止後暫存檔仍是本地文件的前綴
+        process = subprocess.Popen(["adb", "exec-in", f"cat >> {quoted_partial}"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        with active_adb_lock:
+            active_adb_processes.add(process)
+        try:
+            # 本地讀取錯誤（NAS 讀取失敗、暫存副本消失）照常拋出，由呼叫端走重試
+            with open(read_path, 'rb') as f:
+                f.seek(offset)
+                while batch_processing:
+                    chunk = f.read(RESUMABLE_CHUNK)
+                    if not chunk:
+                        break
+                    try:
+                        process.stdin.write(chunk)
+                    except OSError:
+                        # 進程已被終止或 adb 中斷，保留暫存檔供下次續傳
+                        break
+                    if on_chunk:
+                        on_chunk(len(chunk))
+        finally:
+            # 先關閉 stdin，cat 收到 EOF 才會結束，否則下面讀 stderr / wait 會永遠卡住
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            stderr = process.stderr.read().decode('utf-8', errors='replace')
+            process.wait()
+            with active_adb_lock:
+                active_adb_processes.discard(process)
+
+        if not batch_processing:
+            log(f"[UI] 停止請求已收到，保留續傳暫存: {filename}")
+            raise Exception("推送被用戶中斷")
+        if process.returncode != 0:
+            raise Exception(f"ADB續傳失敗: {stderr.strip()}")
+
+    remote_size = get_remote_file_size(partial_path)
+    if remote_size != size:
+        if remote_size > size:
+            run_adb_command(["shell", f"rm -f {quoted_partial}"])
+        raise Exception(f"續傳大小不符: {remote_size}/{size}")
+
+    if params.get('resumable_verify_md5', False):
+        output = run_adb_command(["shell", f"md5sum {quoted_partial}"])
+        if output.split()[0].lower() != _local_md5(read_path):
+            run_adb_command(["shell", f"rm -f {quoted_partial}"])
+            raise Exception("續傳 md5 不符，已刪除暫存檔")
+
+    run_adb_command(["shell", f"mv {quoted_partial} {shlex.quote(remote_path)}"])
+
+
+# /////////////////////////////////////////////////////////////////////////////
+# 批次成員表
+# batch_files(batch_id, file_id) 在建立批次時寫入；完成、重試、失敗分析與
+# 崩潰恢復都以批次 id 做單一集合語句，不再逐檔 UPDATE。
+
+BATCH_MEMBERS_SQL = "SELECT file_id FROM batch_files WHERE batch_id=?"
+
+
+def record_batch(conn, batch_id, start_time, file_batch):
+    """在同一交易內寫入批次歷史與成員"""
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO batch_history (virtual_batch_id, start_time, file_count, total_size)
+        VALUES (?, ?, ?, ?)
+    """, (batch_id, start_time, len(file_batch), sum(f['size'] for f in file_batch)))
+    cur.executemany("INSERT OR IGNORE INTO batch_files (batch_id, file_id) VALUES (?, ?)",
+                    [(batch_id, f['id']) for f in file_batch])
+    cur.execute(f"""
+        INSERT OR REPLACE INTO batch_composition (batch_id, media_type, file_count, total_bytes)
+        SELECT ?, COALESCE(media_type, 'unknown'), COUNT(*), COALESCE(SUM(size), 0)
+        FROM file_entries WHERE id IN ({BATCH_MEMBERS_SQL})
+        GROUP BY 2
+    """, (batch_id, batch_id))
+    conn.commit()
+
+
+def record_batch_timing(conn, batch_id, push_seconds=None, process_seconds=None):
+    """記錄批次推送耗時與 Photos 處理（備份等待）耗時"""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE batch_history
+        SET push_seconds = COALESCE(?, push_seconds),
+            process_seconds = COALESCE(?, process_seconds)
+        WHERE virtual_batch_id=?
+    """, (push_seconds, process_seconds, batch_id))
+    conn.commit()
+
+
+def mark_pushed_files_completed(conn, batch_id):
+    """將批次內已推送的文件標記為完成"""
+    cur = conn.cursor()
+    completed_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    try:
+        cur.execute(f"""
+            UPDATE file_entries SET status='completed', completed_time=?, updated_at=CURRENT_TIMESTAMP
+            WHERE status='pushed' AND id IN ({BATCH_MEMBERS_SQL})
+        """, (completed_time, batch_id))
+        completed_count = max(cur.rowcount, 0)
+
+        conn.commit()
+        print(f"[狀態更新] {completed_count} 個已推送文件標記為完成")
+        return completed_count
+
+    except Exception as e:
+        print(f"[狀態更新錯誤] {e}")
+        return 0
+
+
+def requeue_batch_files(conn, batch_id, statuses=('pushed', 'failed')):
+    """將批次內指定狀態的文件退回 pending 以便重試，回傳退回數"""
+    cur = conn.cursor()
+    placeholders = ','.join('?' * len(statuses))
+    cur.execute(f"""
+        UPDATE file_entries SET status='pending', updated_at=CURRENT_TIMESTAMP
+        WHERE status IN ({placeholders}) AND id IN ({BATCH_MEMBERS_SQL})
+    """, (*statuses, batch_id))
+    requeued = max(cur.rowcount, 0)
+    conn.commit()
+    if requeued:
+        log(f"[批次重試] {batch_id}: {requeued} 個文件退回待處理")
+    return requeued
+
+
+def schedule_file_retry(conn, file_id):
+    """標記推送失敗並排入重試通道: 第 n 次失敗後等待 base * 2^(n-1) 秒（上限 retry_max_delay）"""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE file_entries
+        SET status='failed', attempts=attempts + 1,
+            retry_after=? + MIN(?, ? * (1 << MIN(attempts, 20))),
+            updated_at=CURRENT_TIMESTAMP
+        WHERE id=?
+    """, (time.time(), params.get('retry_max_delay', 1800), params.get('retry_base_delay', 30), file_id))
+    conn.commit()
+
 
-    # 使用 rich.progress 顯示推送進度
-    with Progress(
-        TextColumn("[bold blue]{task.description}"),
-        BarColumn(bar_width=40),
-        "[progress.percentage]{task.percentage:>3.0f}%",
-        "({task.completed}/{task.total})",
-        TimeElapsedColumn(),
-        TimeRemainingColumn(),
-        console=console,
-        transient=False,  # 保持進度條可見
-    ) as progress:
+def requeue_due_retries(conn, now=None):
+    """重試時間已到、未超過重試上限的失敗文件退回 pending，回傳退回數
 
-        # 創建推送任務
-        task = progress.add_task(
-            f"[cyan]推送批次文件 ({total_files} 個)",
-            total=total_files
-        )
+    升級前留下的失敗文件沒有 retry_after，視為立即可重試。
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE file_entries SET status='pending', updated_at=CURRENT_TIMESTAMP
+        WHERE status='failed' AND attempts < ? AND COALESCE(retry_after, 0) <= ?
+    """, (params.get('retry_max_attempts', 6), time.time() if now is None else now))
+    requeued = max(cur.rowcount, 0)
+    conn.commit()
+    if requeued:
+        log(f"[重試通道] {requeued} 個失敗文件退回待處理")
+    return requeued
 
-        for i, file_info in enumerate(file_batch):
-            if not batch_processing:
-                log("[UI] 停止請求已收到，終止推送循環")
-                break
-            file_path = file_info['path']
-            filename = os.path.basename(file_path)
 
-            # 更新任務描述顯示當前文件
-            progress.update(
-                task,
-                description=f"[cyan]推送: {filename[:40]}{'...' if len(filename) > 40 else ''}"
-            )
+def next_retry_time(conn):
+    """重試通道中最早的重試時間，沒有可重試文件時回傳 None"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT MIN(COALESCE(retry_after, 0)) FROM file_entries
+        WHERE status='failed' AND attempts < ?
+    """, (params.get('retry_max_attempts', 6),))
+    return cur.fetchone()[0]
 
-            try:
-                # 推送單個文件 (靜默版本，不打印ADB日誌)
-                adb_push_file_silent(file_path, remote_folder)
 
-                # 立即標記為已推送
-                if batch_manager.mark_file_pushed(file_path):
-                    success_count += 1
+def discard_batch(conn, batch_id):
+    """刪除未開始推送的批次（歷史與成員），其文件仍為 pending"""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM batch_files WHERE batch_id=?", (batch_id,))
+    cur.execute("DELETE FROM batch_history WHERE virtual_batch_id=?", (batch_id,))
+    conn.commit()
 
-                # 更新進度
-                progress.update(task, advance=1)
 
-                # 每推送5個文件更新一次UI（避免過於頻繁）
-                if (i + 1) % 5 == 0 or (i + 1) == total_files:
-                    update_pending_count_text()
+def release_batch_members(conn, batch_id, file_ids):
+    """未推送即離開批次的文件（斷路器截斷）移出成員表，並更新批次歷史與組成"""
+    if not file_ids:
+        return
+    cur = conn.cursor()
+    cur.executemany("DELETE FROM batch_files WHERE batch_id=? AND file_id=?",
+                    [(batch_id, file_id) for file_id in file_ids])
+    cur.execute(f"""
+        UPDATE batch_history SET
+            file_count = (SELECT COUNT(*) FROM batch_files WHERE batch_id=?),
+            total_size = (SELECT COALESCE(SUM(size), 0) FROM file_entries WHERE id IN ({BATCH_MEMBERS_SQL}))
+        WHERE virtual_batch_id=?
+    """, (batch_id, batch_id, batch_id))
+    cur.execute("DELETE FROM batch_composition WHERE batch_id=?", (batch_id,))
+    cur.execute(f"""
+        INSERT INTO batch_composition (batch_id, media_type, file_count, total_bytes)
+        SELECT ?, COALESCE(media_type, 'unknown'), COUNT(*), COALESCE(SUM(size), 0)
+        FROM file_entries WHERE id IN ({BATCH_MEMBERS_SQL})
+        GROUP BY 2
+    """, (batch_id, batch_id))
+    conn.commit()
 
-            except Exception as e:
-                # 使用 rich 顯示錯誤，但不破壞進度條
-                console.print(f"[red]✗ {filename}: {str(e)[:50]}[/red]")
-                batch_manager.mark_file_failed(file_path, str(e))
-                # 仍然推進進度條
-                progress.update(task, advance=1)
 
-        # 完成後顯示摘要
-        progress.update(
-            task,
-            description=f"[green]✓ 批次推送完成: {success_count}/{total_files} 成功[/green]"
-        )
+def finalize_batch(conn, batch_id, batch_status):
+    """以成員表統計成功數並結束批次歷史，回傳 (成功數, 總數)"""
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(status IN ('pushed', 'completed')), 0)
+        FROM file_entries WHERE id IN ({BATCH_MEMBERS_SQL})
+    """, (batch_id,))
+    total_files, success_count = cur.fetchone()
+    if total_files == 0:
+        log(f"[批次完成] {batch_id}: 無文件，批次略過")
+        return 0, 0
 
-    # 推送完成後最終更新
-    update_pending_count_text()
+    end_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cur.execute("""
+        UPDATE batch_history
+        SET end_time=?, success_count=?, status=?
+        WHERE virtual_batch_id=?
+    """, (end_time, success_count, batch_status, batch_id))
+    conn.commit()
 
     success_rate = (success_count / total_files) * 100
+    log(f"[批次完成] {batch_id}: {success_count}/{total_files} ({success_rate:.1f}%)")
+    return success_count, total_files
 
-    # 使用 rich 顯示最終結果
-    if success_rate >= 90:
-        console.print(
-            f"[green]✓ 推送完成: {success_count}/{total_files} ({success_rate:.1f}%)[/green]")
-    else:
-        console.print(
-            f"[yellow]⚠ 推送完成: {success_count}/{total_files} ({success_rate:.1f}%) - 成功率偏低[/yellow]")
-
-    return success_count
 
+def get_batch_failure_summary(conn, limit=10):
+    """失敗文件最多的批次: [(batch_id, 批次狀態, 文件數, 失敗數, 失敗位元組)]"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT b.batch_id, h.status, COUNT(*),
+               SUM(e.status = 'failed'),
+               SUM(CASE WHEN e.status = 'failed' THEN e.size ELSE 0 END)
+        FROM batch_files b
+        JOIN file_entries e ON e.id = b.file_id
+        LEFT JOIN batch_history h ON h.virtual_batch_id = b.batch_id
+        GROUP BY b.batch_id
+        HAVING SUM(e.status = 'failed') > 0
+        ORDER BY 4 DESC
+        LIMIT ?
+    """, (limit,))
+    return cur.fetchall()
+
+
+def recover_interrupted_batches(conn):
+    """啟動時恢復上次崩潰遺留的 processing 批次，回傳 (批次數, 退回文件數)"""
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE file_entries SET status='pending', updated_at=CURRENT_TIMESTAMP
+        WHERE status='pushed' AND id IN (
+            SELECT b.file_id FROM batch_files b
+            JOIN batch_history h ON h.virtual_batch_id = b.batch_id
+            WHERE h.status = 'processing')
+    """)
+    requeued = max(cur.rowcount, 0)
+    cur.execute("""
+        UPDATE batch_history SET status='interrupted', end_time=?
+        WHERE status='processing'
+    """, (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+    batches = max(cur.rowcount, 0)
+    conn.commit()
+    if batches:
+        log(f"[崩潰恢復] {batches} 個未結束批次標記為中斷，{requeued} 個已推送文件退回待處理")
+    return batches, requeued
 
-def adb_push_file_silent(local_path, remote_folder):
-    """靜默版本的文件推送，不打印詳細日誌"""
-    filename = os.path.basename(local_path)
-    remote_path = f"{remote_folder}/{filename}"
 
-    import subprocess
-    try:
-        # 執行推送，但不打印過程信息
-        process = subprocess.Popen(["adb", "push", local_path, remote_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        while True:
-            if not batch_processing:
-                log("[UI] 停止請求已收到，終止ADB推送進程")
-                process.terminate()
-                process.wait()
-                raise Exception("推送被用戶中斷")
-            retcode = process.poll()
-            if retcode is not None:
-                break
-            time.sleep(0.2)
-        if process.returncode != 0:
-            stderr = process.stderr.read()
-            raise Exception(f"ADB推送失敗: {stderr}")
-    except Exception as e:
-        # 檢查文件是否實際存在（有時推送成功但返回錯誤）
-        try:
-            output = run_adb_command(["shell", "ls", remote_path])
-            if filename in output:
-                # 文件存在，視為成功
+# /////////////////////////////////////////////////////////////////////////////
+# 處理成本模型
+# Photos 處理一個 4K 影片與同大小 JPEG 的 CPU 時間差異很大。以已完成批次的實測耗時
+# 學習各媒體類型的「每檔秒數」與「每 GB 秒數」（加上每批固定開銷），
+# 以脊回歸向先驗值收斂：樣本少時沿用先驗，未出現過的類型保持先驗。
+
+# 先驗: (每檔秒數, 每 GB 秒數)，依類型大類
+COST_PRIORS = {
+    'image': (0.3, 2.0),
+    'video': (3.0, 45.0),
+    'unknown': (0.5, 5.0),
+}
+PUSH_PRIOR = (0.1, 25.0)        # 每檔 adb 開銷、約 40MB/s
+COST_RIDGE = 1.0
+COST_SAMPLE_BATCHES = 300
+
+
+def _solve_linear(matrix, vector):
+    """高斯消去法（部分選主元）解小型線性方程組"""
+    n = len(vector)
+    a = [row[:] + [vector[i]] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-12:
+            continue
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(n):
+            if r != col and a[r][col]:
+                factor = a[r][col] / a[col][col]
+                for c in range(col, n + 1):
+                    a[r][c] -= factor * a[col][c]
+    return [a[i][n] / a[i][i] if abs(a[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+def _ridge_fit(rows, targets, prior):
+    """最小化 ||Xθ - y||² + λ||θ - θ0||²，係數截為非負"""
+    n = len(prior)
+    xtx = [[COST_RIDGE if i == j else 0.0 for j in range(n)] for i in range(n)]
+    xty = [COST_RIDGE * p for p in prior]
+    for row, y in zip(rows, targets):
+        nonzero = [(i, v) for i, v in enumerate(row) if v]
+        for i, vi in nonzero:
+            xty[i] += vi * y
+            for j, vj in nonzero:
+                xtx[i][j] += vi * vj
+    return [max(0.0, theta) for theta in _solve_linear(xtx, xty)]
+
+
+def _cost_class(media_type):
+    return media_type.split('/')[0] if media_type.split('/')[0] in COST_PRIORS else 'unknown'
+
+
+class ProcessingCostModel:
+    """依批次歷史學習的處理/推送耗時模型（定期重新學習）"""
+
+    def __init__(self, refresh_interval=600):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.learned_at = 0
+        self.sample_count = 0
+        self.overhead = float(params.get('backup_stable_time', 30))
+        self.per_type = {}          # media_type -> (每檔秒數, 每 GB 秒數)
+        self.push = PUSH_PRIOR + (0.0,)
+
+    def _coefficients(self, media_type):
+        return self.per_type.get(media_type) or COST_PRIORS[_cost_class(media_type)]
+
+    def _load_samples(self, conn):
+        """[(process_seconds, push_seconds, {media_type: (檔數, 位元組)})]，含歸檔批次"""
+        cur = conn.cursor()
+        schemas = ['main'] + (['archive'] if attach_archive(conn) else [])
+        batches = {}
+        for schema in schemas:
+            cur.execute(f"""
+                SELECT h.virtual_batch_id, h.process_seconds, h.push_seconds,
+                       c.media_type, c.file_count, c.total_bytes
+                FROM (SELECT virtual_batch_id, process_seconds, push_seconds
+                      FROM {schema}.batch_history
+                      WHERE status='completed' AND process_seconds IS NOT NULL
+                      ORDER BY id DESC LIMIT ?) h
+                JOIN {schema}.batch_composition c ON c.batch_id = h.virtual_batch_id
+            """, (COST_SAMPLE_BATCHES,))
+            for batch_id, process_seconds, push_seconds, media_type, count, total in cur.fetchall():
+                entry = batches.setdefault(batch_id, (process_seconds, push_seconds, {}))
+                entry[2][media_type] = (count, total)
+        return list(batches.values())
+
+    def refresh(self, conn, force=False):
+        """重新學習係數（間隔內重複呼叫直接返回）"""
+        with self.lock:
+            if not force and time.time() - self.learned_at < self.refresh_interval:
                 return
-            else:
-                raise e
-        except Exception:
-            raise e
+            self.learned_at = time.time()
+        try:
+            samples = self._load_samples(conn)
+        except sqlite3.Error as e:
+            log(f"[成本模型] 讀取批次歷史失敗: {e}")
+            return
 
+        types = sorted({t for _, _, comp in samples for t in comp})
+        # 處理耗時: 每類型 (檔數, GB) 兩個係數 + 每批固定開銷
+        prior = []
+        for t in types:
+            prior.extend(COST_PRIORS[_cost_class(t)])
+        prior.append(float(params.get('backup_stable_time', 30)))
+        rows, targets = [], []
+        for process_seconds, _, comp in samples:
+            row = []
+            for t in types:
+                count, total = comp.get(t, (0, 0))
+                row.extend((count, total / 1024 ** 3))
+            row.append(1.0)
+            rows.append(row)
+            targets.append(process_seconds)
+        theta = _ridge_fit(rows, targets, prior)
+
+        # 推送耗時: 總檔數、總 GB、固定開銷
+        push_rows, push_targets = [], []
+        for _, push_seconds, comp in samples:
+            if push_seconds is None:
+                continue
+            push_rows.append([sum(c for c, _ in comp.values()),
+                              sum(b for _, b in comp.values()) / 1024 ** 3, 1.0])
+            push_targets.append(push_seconds)
+        push_theta = _ridge_fit(push_rows, push_targets, list(PUSH_PRIOR) + [0.0])
+
+        with self.lock:
+            self.per_type = {t: (theta[2 * i], theta[2 * i + 1]) for i, t in enumerate(types)}
+            self.overhead = theta[-1]
+            self.push = tuple(push_theta)
+            self.sample_count = len(samples)
+        if samples:
+            log(f"[成本模型] 以 {len(samples)} 個批次學習: " + self.describe())
+
+    def describe(self):
+        with self.lock:
+            parts = [f"{t} {per_file:.1f}s/檔+{per_gb:.0f}s/GB"
+                     for t, (per_file, per_gb) in sorted(self.per_type.items())]
+            return ", ".join(parts + [f"固定 {self.overhead:.0f}s"])
+
+    def file_process_seconds(self, media_type, size):
+        """單一文件的預估處理秒數（不含每批固定開銷）"""
+        per_file, per_gb = self._coefficients(media_type or 'unknown')
+        return per_file + per_gb * size / 1024 ** 3
+
+    def predict_process_seconds(self, files):
+        """files: [{'media_type', 'size'}]"""
+        return self.overhead + sum(self.file_process_seconds(f.get('media_type'), f['size']) for f in files)
+
+    def type_process_seconds(self, media_type, file_count, total_bytes):
+        """同類型一組文件的預估處理秒數（不含每批固定開銷）"""
+        per_file, per_gb = self._coefficients(media_type or 'unknown')
+        return per_file * file_count + per_gb * total_bytes / 1024 ** 3
+
+    def predict_push_seconds(self, file_count, total_bytes):
+        per_file, per_gb, fixed = self.push
+        return fixed + per_file * file_count + per_gb * total_bytes / 1024 ** 3
+
+    def process_target_seconds(self, max_files, max_size_bytes):
+        """每批處理時間上限: 手動設定，否則為推送一個滿批次的預估時間（兩階段互相覆蓋）"""
+        target_minutes = params.get('batch_process_target_minutes', 0)
+        if target_minutes:
+            return target_minutes * 60
+        return self.predict_push_seconds(max_files, max_size_bytes)
+
+    def process_budget_seconds(self, max_files, max_size_bytes):
+        """成本感知批次: 每批文件的預估處理時間（不含固定開銷）上限"""
+        return self.process_target_seconds(max_files, max_size_bytes) - self.overhead
+
+
+cost_model = ProcessingCostModel()
+
+# 最近一次積壓預估（秒），待處理文件數顯示沿用，避免每次刷新都做分組統計
+backlog_eta_seconds = None
+
+
+# 積壓的類型組成需要分組掃描，每次執行開始（及每 BACKLOG_COMPOSITION_TTL 秒）才重新統計；
+# 其間以觸發器維護的 pending+failed 計數縮放，每批推送後的預估不再掃描全表
+BACKLOG_COMPOSITION_TTL = 600
+_backlog_cache = None   # (統計時間, [(media_type, 檔數, 位元組)], 統計時 pending+failed 的 (檔數, 位元組))
+
+
+def _queued_totals(conn):
+    counts = get_status_counts(conn)
+    return tuple(sum(counts.get(status, (0, 0))[i] for status in ('pending', 'failed')) for i in (0, 1))
+
+
+def backlog_composition(conn, refresh=False):
+    """積壓（pending 與可重試的失敗文件）各類型的 (media_type, 檔數, 位元組)"""
+    global _backlog_cache
+    now = time.time()
+    if refresh or _backlog_cache is None or now - _backlog_cache[0] >= BACKLOG_COMPOSITION_TTL:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT media_type, COUNT(*), COALESCE(SUM(size), 0) FROM file_entries
+            WHERE status = 'pending' OR (status = 'failed' AND attempts < ?)
+            GROUP BY media_type
+        """, (params.get('retry_max_attempts', 6),))
+        _backlog_cache = (now, cur.fetchall(), _queued_totals(conn))
+        return _backlog_cache[1]
+
+    _, composition, (base_files, base_bytes) = _backlog_cache
+    files_now, bytes_now = _queued_totals(conn)
+    file_scale = files_now / base_files if base_files else 0.0
+    byte_scale = bytes_now / base_bytes if base_bytes else 0.0
+    return [(media_type, count * file_scale, size * byte_scale) for media_type, count, size in composition]
+
+
+def estimate_backlog(conn, parallel=True, refresh=False):
+    """整個待處理積壓（含可重試的失敗文件）的剩餘時間預估
+
+    推送以實測滑動速率估算（尚無速率時用成本模型），Photos 處理以成本模型逐類型估算並加上
+    每批固定開銷。並行流水線推送與處理重疊，取兩者較大值；循序模式兩者相加。
+    類型組成取自 backlog_composition 的快取，refresh 時重新統計。
+    """
+    composition = backlog_composition(conn, refresh)
+    file_count = round(sum(count for _, count, _ in composition))
+    total_bytes = round(sum(size for _, _, size in composition))
+    if not file_count:
+        return None
 
-def mark_pushed_files_completed(conn, file_batch):
-    """將已推送的文件標記為完成"""
-    cur = conn.cursor()
-    completed_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cost_model.refresh(conn)
+    batch_files = max(1, params.get('batch_size', 1000))
+    batch_bytes = max(1, params.get('batch_size_gb', 90) * 1024 ** 3)
+    batches = max(math.ceil(file_count / batch_files), math.ceil(total_bytes / batch_bytes))
 
-    # 檢查 completed_time 列是否存在
+    rate = transfer_meter.rate()
+    if rate > 0:
+        push_seconds = total_bytes / rate
+    else:
+        push_seconds = cost_model.predict_push_seconds(file_count, total_bytes)
+    process_seconds = batches * cost_model.overhead + sum(
+        cost_model.type_process_seconds(media_type, count, size) for media_type, count, size in composition)
+
+    return {
+        'files': file_count,
+        'bytes': total_bytes,
+        'batches': batches,
+        'rate_bps': rate,
+        'push_seconds': push_seconds,
+        'process_seconds': process_seconds,
+        'eta_seconds': max(push_seconds, process_seconds) if parallel else push_seconds + process_seconds,
+    }
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} 小時 {seconds % 3600 // 60} 分"
+    return f"{seconds // 60} 分 {seconds % 60} 秒"
+
+
+def report_backlog_eta(conn, parallel=True, refresh=False):
+    """輸出積壓預估並更新待處理文件數顯示（refresh: 重新統計積壓組成，每次執行開始時使用）"""
+    global backlog_eta_seconds
     try:
-        cur.execute("PRAGMA table_info(files)")
-        columns = {row[1] for row in cur.fetchall()}
+        estimate = estimate_backlog(conn, parallel, refresh)
+    except sqlite3.Error as e:
+        log(f"[積壓預估] 失敗: {e}")
+        return None
+    backlog_eta_seconds = estimate['eta_seconds'] if estimate else None
+    if estimate:
+        rate = f"{estimate['rate_bps'] / 1024 ** 2:.1f} MB/s" if estimate['rate_bps'] else "模型估算"
+        console.print(f"[blue]📊 積壓: {estimate['files']:,} 檔 {estimate['bytes'] / 1024 ** 3:.1f}GB，"
+                      f"推送 {rate}，推送 {format_duration(estimate['push_seconds'])} / "
+                      f"處理 {format_duration(estimate['process_seconds'])}，"
+                      f"預估剩餘 {format_duration(estimate['eta_seconds'])}[/blue]")
+    update_pending_count_text()
+    return estimate
 
-        completed_count = 0
-        for file_info in file_batch:
-            file_path = file_info['path']
 
-            if 'completed_time' in columns:
-                cur.execute("""
-                    UPDATE files SET status='completed', completed_time=?, updated_at=CURRENT_TIMESTAMP 
-                    WHERE path=? AND status='pushed'
-                """, (completed_time, file_path))
-            else:
-                cur.execute("""
-                    UPDATE files SET status='completed', updated_at=CURRENT_TIMESTAMP 
-                    WHERE path=? AND status='pushed'
-                """, (file_path,))
+# /////////////////////////////////////////////////////////////////////////////
+# 容量規劃
+# 多日傳輸前比較參數: 以成本模型（批次歷史學到的推送速率與各類型處理耗時）、手機可用空間
+# 與 CPU 追蹤檔的回放結果，預估清空整個待處理積壓所需時間，並列出不同參數組合的結果。
 
-            if cur.rowcount > 0:
-                completed_count += 1
+STORAGE_BUFFER_GB = 10      # 手機至少保留的空間
+PARALLEL_SLOTS = 2          # 並行時同時佔用空間的批次數（推送中 + Camera 處理中）
 
-        conn.commit()
-        print(f"[狀態更新] {completed_count} 個已推送文件標記為完成")
-        return completed_count
+PLAN_GRID = {
+    'batch_size': (250, 500, 1000, 2000),
+    'batch_size_gb': (20, 45, 90),
+    'cpu_threshold': (30.0, 50.0, 70.0),
+}
 
-    except Exception as e:
-        print(f"[狀態更新錯誤] {e}")
-        return 0
+
+def replay_thresholds(trace, thresholds):
+    """以 CPU 追蹤檔回放各門檻的備份等待，回傳 {門檻: replay_cpu_trace 結果}"""
+    samples, markers = trace
+    return {
+        threshold: replay_cpu_trace(samples, markers, lambda: IdleDetector(threshold=threshold), threshold)
+        for threshold in thresholds
+    }
+
+
+def plan_backlog(conn, configs, storage_gb=None, trace=None):
+    """預估各參數組合清空積壓的時間
+
+    configs: [{'batch_size', 'batch_size_gb', 'cpu_threshold'}]；storage_gb 為手機可用空間（None 表示不限制）。
+    批次數以檔數/位元組上限估算，成本感知批次啟用時另受排程的處理時間上限約束；每批推送與處理時間取平均組成。空間可容納兩批加保留空間時推送與處理
+    重疊（總時間約為 批次數 × 較慢階段 + 一次較快階段），否則循序。
+    trace 為 load_cpu_trace 的結果: 處理時間依回放的平均等待相對目前門檻縮放，並附上誤判數；
+    沒有追蹤檔時 cpu_threshold 不影響預估。
+    """
+    # 規劃需要確切的組成，重新統計並順便更新 backlog_composition 的快取
+    composition = backlog_composition(conn, refresh=True)
+    file_count = sum(count for _, count, _ in composition)
+    total_bytes = sum(size for _, _, size in composition)
+    if not file_count:
+        return []
+
+    cost_model.refresh(conn)
+    gb = 1024 ** 3
+    type_seconds = sum(cost_model.type_process_seconds(t, count, size) for t, count, size in composition)
+    replays = {}
+    if trace and trace[0]:
+        replays = replay_thresholds(trace, {params['cpu_threshold']} | {c['cpu_threshold'] for c in configs})
+    base_wait = replays.get(params['cpu_threshold'], {}).get('mean_wait')
+
+    results = []
+    for config in configs:
+        batch_gb = config['batch_size_gb']
+        notes = []
+        if storage_gb is not None:
+            usable_gb = storage_gb - STORAGE_BUFFER_GB
+            if usable_gb <= 0:
+                results.append(dict(config, feasible=False, notes=['可用空間不足保留量']))
+                continue
+            if batch_gb > usable_gb:
+                batch_gb = usable_gb
+                notes.append(f'批次受空間限制為 {batch_gb:.0f}GB')
+
+        batches = max(math.ceil(file_count / config['batch_size']),
+                      math.ceil(total_bytes / (batch_gb * gb)), 1)
+        if params.get('cost_aware_batching', True):
+            # 與排程相同的處理時間上限（每批至少一個文件）
+            budget = cost_model.process_budget_seconds(config['batch_size'], batch_gb * gb)
+            cost_batches = min(math.ceil(type_seconds / budget), file_count) if budget > 0 else file_count
+            if cost_batches > batches:
+                batches = cost_batches
+                notes.append('批次受處理時間上限限制')
+        push_batch = cost_model.predict_push_seconds(file_count / batches, total_bytes / batches)
+
+        scale = 1.0
+        replay = replays.get(config['cpu_threshold'])
+        if replay:
+            if replay['mean_wait'] and base_wait:
+                scale = replay['mean_wait'] / base_wait
+            if replay['false_completions'] or replay['completions'] < replay['waits']:
+                notes.append(f"回放誤判 {replay['false_completions']}、未完成 "
+                             f"{replay['waits'] - replay['completions']}（共 {replay['waits']} 次等待）")
+        process_batch = (cost_model.overhead + type_seconds / batches) * scale
+
+        parallel = storage_gb is None or PARALLEL_SLOTS * total_bytes / batches / gb + STORAGE_BUFFER_GB <= storage_gb
+        if parallel:
+            total_seconds = batches * max(push_batch, process_batch) + min(push_batch, process_batch)
+        else:
+            total_seconds = batches * (push_batch + process_batch)
+            notes.append('空間不足並行，循序執行')
+
+        results.append(dict(config, feasible=True, batches=batches, parallel=parallel,
+                            push_batch=push_batch, process_batch=process_batch,
+                            total_seconds=total_seconds, notes=notes))
+    return results
+
+
+def parse_plan_grid(argv):
+    """--plan 之後的 name=v1,v2 參數覆蓋預設網格，另可指定 storage_gb= 與 trace=，回傳 (網格, 選項)"""
+    grid = {name: list(values) for name, values in PLAN_GRID.items()}
+    options = {'storage_gb': None, 'trace_path': None}
+    for arg in argv[argv.index('--plan') + 1:]:
+        name, _, values = arg.partition('=')
+        if name in grid and values:
+            cast = int if name == 'batch_size' else float
+            grid[name] = [cast(v) for v in values.split(',') if v]
+        elif name == 'storage_gb' and values:
+            options['storage_gb'] = float(values)
+        elif name == 'trace' and values:
+            options['trace_path'] = values
+    # 目前參數一定列入比較
+    for name in grid:
+        if params[name] not in grid[name]:
+            grid[name].append(params[name])
+    return grid, options
+
+
+def print_capacity_plan(conn, grid, storage_gb=None, trace_path=None):
+    """輸出容量規劃表（依預估時間排序，* 為目前參數）"""
+    if storage_gb is None:
+        snapshot = query_phone_storage()
+        storage_gb = snapshot['available_bytes'] / 1024 ** 3 if snapshot else None
+    trace_path = trace_path or params.get('cpu_trace_path')
+    trace = load_cpu_trace(trace_path) if trace_path and os.path.exists(trace_path) else None
+
+    configs = [{'batch_size': bs, 'batch_size_gb': bgb, 'cpu_threshold': th}
+               for bs in grid['batch_size'] for bgb in grid['batch_size_gb'] for th in grid['cpu_threshold']]
+    results = plan_backlog(conn, configs, storage_gb, trace)
+    if not results:
+        print("[容量規劃] 沒有待處理文件")
+        return results
+
+    per_file, per_gb, fixed = cost_model.push
+    push_rate = f"{1024 / per_gb:.1f} MB/s" if per_gb else "-"
+    print(f"[容量規劃] 學習樣本 {cost_model.sample_count} 個批次；推送 {push_rate} + {per_file:.2f}s/檔；"
+          f"處理 {cost_model.describe()}")
+    storage_note = f"{storage_gb:.1f}GB" if storage_gb is not None else "未知（不限制）"
+    cpu_note = f"回放 {trace_path}（{len(trace[1])} 次等待）" if trace else "無 CPU 追蹤檔，門檻不影響預估"
+    print(f"[容量規劃] 手機可用空間: {storage_note}；CPU 門檻: {cpu_note}")
+    print(f"{'':2}{'batch_size':>10} {'GB':>6} {'CPU%':>6} {'批次':>6} {'推送/批':>9} {'處理/批':>9} {'總時間':>12}  備註")
+
+    current = (params['batch_size'], params['batch_size_gb'], params['cpu_threshold'])
+    feasible = sorted((r for r in results if r['feasible']), key=lambda r: r['total_seconds'])
+    for r in feasible + [r for r in results if not r['feasible']]:
+        mark = '*' if (r['batch_size'], r['batch_size_gb'], r['cpu_threshold']) == current else ' '
+        if not r['feasible']:
+            print(f"{mark} {r['batch_size']:>10} {r['batch_size_gb']:>6g} {r['cpu_threshold']:>6g} {'-':>6} "
+                  f"{'-':>9} {'-':>9} {'-':>12}  {'；'.join(r['notes'])}")
+            continue
+        print(f"{mark} {r['batch_size']:>10} {r['batch_size_gb']:>6g} {r['cpu_threshold']:>6g} {r['batches']:>6} "
+              f"{r['push_batch'] / 60:>7.1f}分 {r['process_batch'] / 60:>7.1f}分 "
+              f"{r['total_seconds'] / 3600:>10.1f}時  {'；'.join(r['notes'])}")
+    return results
 
 
 def check_all_files_processed(conn):
     """檢查是否所有文件都已處理"""
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM files WHERE status='pending'")
-    pending_count = cur.fetchone()[0]
-    return pending_count == 0
+    if scan_in_progress.is_set() or folder_watcher.active:
+        return False
+    pending_count = count_files_with_status(conn, ('pending',))
+    # 重試通道中仍有可重試的失敗文件
+    return pending_count == 0 and next_retry_time(conn) is None
 
 
-def wait_for_backup_complete():
-    """Enhanced backup completion detection with dynamic timing"""
-    stable_seconds = 0
+def wait_for_backup_complete(predicted_seconds=None):
+    """Enhanced backup completion detection (IdleDetector, or the legacy stable window)
+
+    predicted_seconds: the cost model's processing estimate for the batch, shown as the remaining time
+    """
     required_stable = params.get('backup_stable_time', 60)
 
     # Dynamic adjustment based on batch size
@@ -949,57 +4162,73 @@ def wait_for_backup_complete():
             print(
                 f"[標準] 大批次 ({current_batch_size} 文件)，使用標準等待時間 {required_stable} 秒")
 
+    detector = create_backup_detector(required_stable)
+    done, total = detector.progress()
+    record_wait_marker()
+    wait_started = time.time()
+
+    def predicted_remaining():
+        if not predicted_seconds:
+            return ""
+        remaining = predicted_seconds - (time.time() - wait_started)
+        if remaining > 0:
+            return f"預估處理剩餘 {format_duration(remaining)}"
+        return f"已超過預估 {format_duration(-remaining)}"
+
     if RICH_AVAILABLE:
         with Progress(
             TextColumn("[bold blue]備份等待: {task.fields[status]}"),
             BarColumn(bar_width=40),
             "[progress.percentage]{task.percentage:>3.0f}%",
-            "({task.completed}/{task.total})",
+            "({task.completed:.0f}/{task.total:.0f})",
+            TextColumn("{task.fields[predicted]}"),
             TimeElapsedColumn(),
             console=console,
             transient=False,
         ) as progress:
             task = progress.add_task(
-                "備份等待", total=required_stable, status=f"0/{required_stable} 秒 (CPU: 0%)"
+                "備份等待", total=total, status="等待 CPU 樣本", predicted=predicted_remaining()
             )
-            while stable_seconds < required_stable and batch_processing:
+            while not detector.backup_complete() and batch_processing:
+                if not device_health.online.is_set():
+                    # 離線期間讀不到 CPU，0% 不代表備份完成
+                    progress.update(task, status="裝置離線，等待重新連線")
+                    wait_until_device_online()
+                    continue
                 cpu = get_cpu_usage()
-                if cpu < params['cpu_threshold']:
-                    stable_seconds += params['monitor_interval']
-                    progress.update(
-                        task,
-                        completed=stable_seconds,
-                        status=f"{stable_seconds}/{required_stable} 秒 (CPU: {cpu:.1f}%)"
-                    )
-                else:
-                    if stable_seconds > 0:
-                        progress.update(
-                            task,
-                            status=f"CPU活躍 ({cpu:.1f}%)，重置計時器"
-                        )
-                    stable_seconds = 0
-                time.sleep(params['monitor_interval'])
-            if stable_seconds >= required_stable:
-                progress.update(task, completed=required_stable, status=f"完成! CPU已穩定 {required_stable} 秒")
+                record_cpu_sample(cpu)
+                detector.update(cpu)
+                done, total = detector.progress()
+                progress.update(task, completed=done, total=total, status=detector.describe(cpu),
+                                predicted=predicted_remaining())
+                if detector.backup_complete():
+                    break
+                pipeline_sleep(params['monitor_interval'])
+            if detector.backup_complete():
+                progress.update(task, completed=total, status="完成! CPU 已確認轉為閒置")
                 return True
             else:
                 progress.update(task, status="等待被中斷")
                 return False
     else:
-        print(f"[備份等待] 等待 {required_stable} 秒的穩定期...")
-        while stable_seconds < required_stable and batch_processing:
+        print(f"[備份等待] 等待 CPU 轉為閒置（至少 {total:.0f} 秒）...")
+        last_report = 0
+        while not detector.backup_complete() and batch_processing:
+            if not device_health.online.is_set():
+                # 離線期間讀不到 CPU，0% 不代表備份完成
+                wait_until_device_online()
+                continue
             cpu = get_cpu_usage()
-            if cpu < params['cpu_threshold']:
-                stable_seconds += params['monitor_interval']
-                if stable_seconds % 10 == 0:
-                    print(f"[備份等待] 已穩定 {stable_seconds}/{required_stable} 秒 (CPU: {cpu:.1f}%)")
-            else:
-                if stable_seconds > 0:
-                    print(f"[備份等待] CPU活躍 ({cpu:.1f}%)，重置計時器")
-                stable_seconds = 0
-            time.sleep(params['monitor_interval'])
-        if stable_seconds >= required_stable:
-            print(f"[備份完成] CPU已穩定 {required_stable} 秒，認為備份完成")
+            record_cpu_sample(cpu)
+            detector.update(cpu)
+            if time.time() - last_report >= 10:
+                print(f"[備份等待] {detector.describe(cpu)} {predicted_remaining()}")
+                last_report = time.time()
+            if detector.backup_complete():
+                break
+            pipeline_sleep(params['monitor_interval'])
+        if detector.backup_complete():
+            print(f"[備份完成] CPU 已確認轉為閒置，認為備份完成")
             return True
         else:
             print(f"[備份中斷] 等待被中斷")
@@ -1011,20 +4240,40 @@ def wait_for_backup_complete():
 def cpu_monitor_thread():
     global cpu_monitoring, status_text, cpu_active_flag
     log("[CPU監控] 線程啟動")
+    detector = IdleDetector(active=cpu_active_flag)
+    record_telemetry = make_telemetry_sampler()
 
     while cpu_monitoring:
+        if thread_profiler is not None:
+            thread_profiler.checkpoint()
         try:
+            if not device_health.online.is_set():
+                # 裝置離線: 不記錄 0% 樣本，以免被當成閒置
+                status_text = "Offline (裝置未連線)"
+                status_circle.set_facecolor('gray')
+                update_status_text()
+                time.sleep(params['monitor_interval'])
+                continue
+
             cpu = get_cpu_usage()
+            record_telemetry(cpu)
             with cpu_status_lock:
                 cpu_data.append(cpu)
-                avg_cpu = sum(cpu_data) / len(cpu_data) if cpu_data else 0.0
-                cpu_active_flag = avg_cpu > params['cpu_threshold']
+                # 門檻可在 UI 調整，每次取最新值
+                detector.threshold = float(params['cpu_threshold'])
+                detector.update(cpu)
+                was_active = cpu_active_flag
+                cpu_active_flag = detector.active
+
+            # 活躍/閒置轉換時立即喚醒排程線程
+            if cpu_active_flag != was_active:
+                notify_pipeline()
 
             # 更新狀態字串與 UI 顯示顏色
             if cpu_active_flag:
-                status_text = f"Active (Avg CPU: {avg_cpu:.1f}%)"
+                status_text = f"Active (EWMA CPU: {detector.ewma:.1f}%)"
             else:
-                status_text = f"Idle (Avg CPU: {avg_cpu:.1f}%)"
+                status_text = f"Idle (EWMA CPU: {detector.ewma:.1f}%)"
 
             # 更新 UI 狀態燈色
             if status_text.startswith("Active"):
@@ -1042,82 +4291,226 @@ def cpu_monitor_thread():
     log("[CPU監控] 線程結束")
 
 
+def query_phone_storage():
+    """以 df 讀取手機存儲狀態（每次都會執行 adb，請透過 storage_ledger 取用）"""
+    try:
+        output = run_adb_command(['shell', 'df', '/sdcard'])
+
+        for line in output.strip().split('\n'):
+            if '/sdcard' in line or '/storage/emulated' in line:
+                parts = line.split()
+                if len(parts) >= 4:
+                    # df output: Filesystem 1K-blocks Used Available Use% Mounted
+                    total_kb = int(parts[1])
+                    available_kb = int(parts[3])
+                    return {
+                        'total_bytes': total_kb * 1024,
+                        'available_bytes': available_kb * 1024,
+                    }
+        return None
+
+    except Exception as e:
+        log(f"[存储检查] 获取存储信息失败: {e}")
+        return None
+
+
+class StorageLedger:
+    """手機存儲帳本 - 快取 df 結果並追蹤每個排隊/傳輸中批次的預留空間
+
+    預測可用空間 = df 可用空間 - 各批次尚未反映在 df 快照中的預留位元組。
+    批次在推送時逐檔記錄已寫入量，清理完成後釋放預留並使快照失效。
+    """
+
+    def __init__(self, ttl=15):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.snapshot_time = 0
+        # batch_id -> {'reserved', 'written', 'written_at_snapshot', 'stage', 'sizes'}
+        self.reservations = {}
+
+    def refresh(self, force=False):
+        """按 TTL 更新 df 快照，回傳最新快照"""
+        with self.lock:
+            if not force and self.snapshot and time.time() - self.snapshot_time < self.ttl:
+                return self.snapshot
+
+        snapshot = query_phone_storage()
+
+        with self.lock:
+            if snapshot:
+                self.snapshot = snapshot
+                self.snapshot_time = time.time()
+                # 快照已包含目前寫入的位元組
+                for entry in self.reservations.values():
+                    entry['written_at_snapshot'] = entry['written']
+            return self.snapshot
+
+    def clear(self):
+        """清除所有預留並使快照失效（新一輪處理開始時呼叫）"""
+        with self.lock:
+            self.reservations.clear()
+            self.snapshot_time = 0
+
+    def invalidate(self):
+        """使快照失效，下一次查詢會重新執行 df"""
+        with self.lock:
+            self.snapshot_time = 0
+
+    def reserve(self, batch_id, file_batch, stage='pushing'):
+        """為批次預留空間"""
+        sizes = {f['path']: f['size'] for f in file_batch}
+        with self.lock:
+            self.reservations[batch_id] = {
+                'reserved': sum(sizes.values()),
+                'written': 0,
+                'written_at_snapshot': 0,
+                'stage': stage,
+                'sizes': sizes,
+            }
+
+    def record_written(self, batch_id, file_path):
+        """記錄批次中一個文件已寫入手機"""
+        with self.lock:
+            entry = self.reservations.get(batch_id)
+            if entry:
+                entry['written'] += entry['sizes'].get(file_path, 0)
+
+    def release_files(self, batch_id, file_paths):
+        """未推送即離開批次的文件（斷路器截斷、停止請求）不再佔用本批預留"""
+        with self.lock:
+            entry = self.reservations.get(batch_id)
+            if not entry:
+                return
+            for path in file_paths:
+                entry['reserved'] -= entry['sizes'].pop(path, 0)
+        notify_pipeline()
+
+    def set_stage(self, batch_id, stage):
+        """更新批次所在階段: pushing / staged / camera / cleaning"""
+        with self.lock:
+            if batch_id in self.reservations:
+                self.reservations[batch_id]['stage'] = stage
+
+    def release(self, batch_id):
+        """釋放批次預留（清理完成或批次放棄後呼叫）"""
+        with self.lock:
+            entry = self.reservations.pop(batch_id, None)
+            self.snapshot_time = 0
+        # 空間釋放後喚醒等待空間的推送線程
+        notify_pipeline()
+        return entry['reserved'] if entry else 0
+
+    def outstanding_bytes(self):
+        """已預留但尚未反映在 df 快照中的位元組"""
+        with self.lock:
+            return sum(max(0, e['reserved'] - e['written_at_snapshot'])
+                       for e in self.reservations.values())
+
+    def active_batches(self):
+        """目前持有預留的批次數"""
+        with self.lock:
+            return len(self.reservations)
+
+    def bytes_by_stage(self):
+        """各階段預留的總位元組"""
+        with self.lock:
+            totals = {}
+            for entry in self.reservations.values():
+                totals[entry['stage']] = totals.get(entry['stage'], 0) + entry['reserved']
+            return totals
+
+    def get_storage_info(self, force=False):
+        """回傳包含預測可用空間的存儲資訊（GB）"""
+        snapshot = self.refresh(force)
+        if not snapshot:
+            return None
+
+        gb = 1024 ** 3
+        total = snapshot['total_bytes']
+        device_available = snapshot['available_bytes']
+        outstanding = self.outstanding_bytes()
+        available = max(0, device_available - outstanding)
+
+        return {
+            'total_gb': total / gb,
+            'available_gb': available / gb,
+            'used_gb': (total - available) / gb,
+            'used_percent': ((total - available) / total) * 100 if total > 0 else 0,
+            'device_available_gb': device_available / gb,
+            'device_used_percent': ((total - device_available) / total) * 100 if total > 0 else 0,
+            'reserved_gb': outstanding / gb,
+        }
+
+
+# 推送與處理線程共用的存儲帳本
+storage_ledger = StorageLedger()
+
+
+def wait_for_cleanup_space(required_bytes=0):
+    """循序模式: 前一批仍在背景刪除時，確認帳本預測空間足夠 required_bytes 加保留量，否則等待清理釋放
+
+    沒有待刪除的資料夾時等待也無濟於事，直接放行（與原本行為相同）。回傳是否仍在處理。
+    """
+    required_gb = required_bytes / 1024 ** 3 + STORAGE_BUFFER_GB
+    while batch_processing and remote_cleanup.pending_count():
+        storage_info = storage_ledger.get_storage_info(force=True)
+        if not storage_info or storage_info['available_gb'] >= required_gb:
+            break
+        console.print(f"[yellow]⏸ 可用空間 {storage_info['available_gb']:.1f}GB，需要 {required_gb:.1f}GB，"
+                      f"等待前一批背景清理[/yellow]")
+        wait_pipeline(lambda: not remote_cleanup.pending_count() or not batch_processing, timeout=30)
+    return batch_processing
+
+
 class StorageAwareBatchManager(DynamicBatchManager):
     """Storage-aware batch manager with dynamic sizing"""
-    
+
     def __init__(self, conn):
         super().__init__(conn)
         self.min_batch_size_gb = 5   # Minimum viable batch
         self.max_batch_size_gb = params.get('batch_size_gb', 90)
-        self.storage_buffer_gb = 10  # Always keep 10GB free
-        self.last_storage_check = 0
-        self.storage_check_interval = 15  # Check every 15 seconds
-        
-    def get_phone_storage_info(self):
-        """Get detailed phone storage information"""
-        try:
-            # Method 1: Use df command
-            output = run_adb_command(['shell', 'df', '/sdcard'])
-            
-            for line in output.strip().split('\n'):
-                if '/sdcard' in line or '/storage/emulated' in line:
-                    parts = line.split()
-                    if len(parts) >= 4:
-                        # df output: Filesystem 1K-blocks Used Available Use% Mounted
-                        total_kb = int(parts[1])
-                        available_kb = int(parts[3])
-                        used_kb = total_kb - available_kb
-                        
-                        return {
-                            'total_gb': total_kb / (1024 * 1024),
-                            'available_gb': available_kb / (1024 * 1024),
-                            'used_gb': used_kb / (1024 * 1024),
-                            'used_percent': (used_kb / total_kb) * 100 if total_kb > 0 else 0
-                        }
-            
-            # Fallback method: Use statvfs
-            stat_output = run_adb_command(['shell', 'stat', '-f', '/sdcard'])
-            # Parse statvfs output for block size and free blocks
-            
-            return None
-            
-        except Exception as e:
-            log(f"[存储检查] 获取存储信息失败: {e}")
-            return None
-    
+        self.storage_buffer_gb = STORAGE_BUFFER_GB  # Always keep 10GB free
+        self.parallel_slots = PARALLEL_SLOTS        # One batch pushing + one batch in Camera
+
+    def get_phone_storage_info(self, force=False):
+        """Get phone storage information from the shared ledger (cached df + reservations)"""
+        return storage_ledger.get_storage_info(force)
+
+    def mark_file_pushed(self, file_path, file_id=None):
+        """標記文件為已推送，並把寫入量記入存儲帳本"""
+        pushed = super().mark_file_pushed(file_path, file_id)
+        if pushed and self.current_batch_id:
+            storage_ledger.record_written(self.current_batch_id, file_path)
+        return pushed
+
     def calculate_safe_batch_size_adaptive(self, parallel_mode=True):
-        """Calculate safe batch size with adaptive logic"""
-        current_time = time.time()
-        
-        # Rate limit storage checks
-        if current_time - self.last_storage_check < self.storage_check_interval:
-            return min(self.max_batch_size_gb, params.get('batch_size_gb', 90))
-        
-        self.last_storage_check = current_time
+        """Calculate safe batch size from predicted free space"""
         storage_info = self.get_phone_storage_info()
-        
+
         if not storage_info:
             console.print("[yellow]⚠ 无法获取存储信息，使用保守批次大小[/yellow]")
             return self.min_batch_size_gb * 2  # Conservative fallback
-        
+
         available_gb = storage_info['available_gb']
         used_percent = storage_info['used_percent']
-        
-        console.print(f"[blue]📱 存储状态: {available_gb:.1f}GB 可用 ({used_percent:.1f}% 已用)[/blue]")
-        
-        # Calculate safe space accounting for parallel processing
+
+        console.print(f"[blue]📱 存储状态: {available_gb:.1f}GB 可用 ({used_percent:.1f}% 已用, 预留 {storage_info['reserved_gb']:.1f}GB)[/blue]")
+
+        # Predicted free space already excludes queued/in-flight batches
         reserve_space = self.storage_buffer_gb
         if parallel_mode:
-            # Account for potential 2 batches + processing overhead
-            usable_space = (available_gb - reserve_space) / 2.5
+            # Split what is left across the slots not yet held by a batch
+            free_slots = max(1, self.parallel_slots - storage_ledger.active_batches())
+            usable_space = (available_gb - reserve_space) / free_slots
         else:
             # Single batch mode
             usable_space = available_gb - reserve_space
-        
+
         # Apply size constraints
         safe_batch_size = max(self.min_batch_size_gb, usable_space)
         safe_batch_size = min(self.max_batch_size_gb, safe_batch_size)
-        
+
         # Emergency reductions based on usage
         if used_percent > 95:
             safe_batch_size = self.min_batch_size_gb
@@ -1130,9 +4523,9 @@ class StorageAwareBatchManager(DynamicBatchManager):
             console.print(f"[yellow]📊 存储警告 ({used_percent:.1f}%)，调整批次: {safe_batch_size:.1f}GB[/yellow]")
         else:
             console.print(f"[green]✅ 存储充足，批次大小: {safe_batch_size:.1f}GB[/green]")
-        
+
         return safe_batch_size
-    
+
     def get_next_file_batch_with_storage_awareness(self, parallel_mode=True):
         """Get next batch with storage-aware sizing"""
         # Calculate safe batch size
@@ -1156,35 +4549,14 @@ class StorageAwareBatchManager(DynamicBatchManager):
             max_size_gb=safe_batch_size_gb
         )
     
-    def verify_storage_after_cleanup(self, expected_freed_gb):
-        """Verify storage was actually freed after cleanup"""
-        try:
-            time.sleep(2)  # Wait for filesystem sync
-            storage_info = self.get_phone_storage_info()
-            
-            if storage_info:
-                available_gb = storage_info['available_gb']
-                console.print(f"[blue]📊 清理后存储: {available_gb:.1f}GB 可用[/blue]")
-                
-                # Check if we have reasonable space for next batch
-                if available_gb > (self.min_batch_size_gb + self.storage_buffer_gb):
-                    return True
-                else:
-                    console.print(f"[yellow]⚠ 清理后存储仍不足: {available_gb:.1f}GB[/yellow]")
-                    return False
-            return False
-        except Exception as e:
-            console.print(f"[red]存储验证失败: {e}[/red]")
-            return False
-    
     def emergency_storage_check(self):
-        """Emergency check if storage is critically low"""
+        """Emergency check if storage is critically low (actual device state)"""
         storage_info = self.get_phone_storage_info()
         if storage_info:
-            if storage_info['used_percent'] > 98:
+            if storage_info['device_used_percent'] > 98:
                 console.print("[red]🚨 存储严重不足，强制暂停[/red]")
                 return False
-            elif storage_info['available_gb'] < 2:
+            elif storage_info['device_available_gb'] < 2:
                 console.print("[red]🚨 可用空间不足2GB，强制暂停[/red]")
                 return False
         return True
@@ -1205,15 +4577,18 @@ class SafeParallelBatchScheduler:
         storage_manager = StorageAwareBatchManager(conn)
         
         consecutive_failures = 0
-        max_failures = 3
         
         try:
             while self.running and batch_processing:
                 try:
+                    # Device offline or breaker open: pause instead of burning through pending files
+                    if not wait_until_transfer_ready():
+                        break
+
                     # Emergency storage check
                     if not storage_manager.emergency_storage_check():
-                        console.print("[red]🛑 存储紧急暂停，等待60秒[/red]")
-                        time.sleep(60)
+                        console.print("[red]🛑 存储紧急暂停，等待空间释放（最多60秒）[/red]")
+                        wait_pipeline(timeout=60)
                         continue
                     
                     # Check if we can push (queue not full)
@@ -1227,25 +4602,35 @@ class SafeParallelBatchScheduler:
                             # Pre-push storage verification
                             batch_size_gb = sum(f['size'] for f in file_batch) / (1024**3)
                             
-                            # Double-check storage before push
+                            # Double-check storage before push (cached ledger snapshot, no extra df)
                             storage_info = storage_manager.get_phone_storage_info()
                             if storage_info:
                                 required_space = batch_size_gb + storage_manager.storage_buffer_gb
                                 if storage_info['available_gb'] < required_space:
                                     console.print(f"[yellow]⏸ 推送前检查: 需要{required_space:.1f}GB，仅有{storage_info['available_gb']:.1f}GB[/yellow]")
-                                    time.sleep(30)
+                                    discard_batch(conn, storage_manager.current_batch_id)
+                                    storage_manager.current_batch_id = None
+                                    wait_pipeline(timeout=30)
                                     continue
                             
                             # Proceed with push
-                            batch_id = storage_manager.start_new_batch()
+                            batch_id = storage_manager.current_batch_id
+                            storage_ledger.reserve(batch_id, file_batch)
                             console.print(f"[cyan]📤 推送批次 {self.total_batches_pushed + 1}: {len(file_batch)} 文件 ({batch_size_gb:.1f}GB)[/cyan]")
                             
                             remote_temp_folder = f"{REMOTE_ROOT}/batch_temp_{int(time.time())}"
+                            push_started = time.time()
                             success_count = push_files_individually(
                                 storage_manager, file_batch, remote_temp_folder
                             )
+                            record_batch_timing(conn, batch_id, push_seconds=time.time() - push_started)
+                            report_backlog_eta(conn, parallel=True)
                             
+                            # Read ahead the next batch while this one waits for processing
+                            storage_manager.prefetch_next_batch()
+
                             if success_count > 0:
+                                storage_ledger.set_stage(batch_id, 'staged')
                                 batch_info = {
                                     'batch_id': batch_id,
                                     'file_batch': file_batch,
@@ -1258,33 +4643,32 @@ class SafeParallelBatchScheduler:
                                     self.push_queue.put(batch_info, timeout=30)
                                     self.total_batches_pushed += 1
                                     consecutive_failures = 0
+                                    notify_pipeline()
                                     console.print(f"[green]✅ 批次 {self.total_batches_pushed} 推送完成[/green]")
-                                except:
+                                except Full:
                                     console.print("[yellow]⚠ 处理队列满，等待处理[/yellow]")
-                                    time.sleep(10)
+                                    wait_pipeline(lambda: not self.push_queue.full(), timeout=10)
                             else:
                                 console.print(f"[red]❌ 批次推送失败: {batch_id}[/red]")
+                                storage_ledger.release(batch_id)
                                 storage_manager.complete_batch('failed')
-                                consecutive_failures += 1
-                                
-                                if consecutive_failures >= max_failures:
-                                    console.print(f"[red]🛑 连续{max_failures}次推送失败，暂停推送[/red]")
-                                    time.sleep(120)
-                                    consecutive_failures = 0
+                                # Failed files wait in the retry lane; the device monitor and
+                                # push breaker pause the next batch instead of a fixed sleep
                         else:
                             # No more files to process
                             if check_all_files_processed_with_retry(conn):
                                 console.print("[green]📤 所有文件推送完成[/green]")
                                 break
-                            time.sleep(5)
+                            # Woken by scan commits or requeued files
+                            wait_pipeline(timeout=5)
                     else:
-                        # Queue full, wait for processing
-                        time.sleep(15)
+                        # Queue full, wait until the process worker takes the batch
+                        wait_pipeline(lambda: self.push_queue.qsize() == 0 or not self.running, timeout=15)
                         
                 except Exception as e:
                     console.print(f"[red]推送线程错误: {e}[/red]")
                     consecutive_failures += 1
-                    time.sleep(min(10 * consecutive_failures, 60))
+                    pipeline_sleep(min(10 * consecutive_failures, 60))
         finally:
             conn.close()
     
@@ -1302,45 +4686,52 @@ class SafeParallelBatchScheduler:
                     
                     if cpu_idle and not self.push_queue.empty():
                         try:
-                            batch_info = self.push_queue.get(timeout=5)
+                            batch_info = self.push_queue.get_nowait()
+                            notify_pipeline()
                             
                             console.print(f"[yellow]📱 处理批次 {self.total_batches_processed + 1}: {batch_info['batch_id']}[/yellow]")
                             
                             # Move to Camera with storage verification
                             camera_folder = f"{CAMERA_ROOT}/batch_{int(time.time())}"
                             
-                            if move_remote_folder_safe(batch_info['remote_temp_folder'], camera_folder):
-                                mark_pushed_files_completed(conn, batch_info['file_batch'])
+                            if run_when_online(lambda: move_remote_folder_safe(batch_info['remote_temp_folder'], camera_folder)):
+                                storage_ledger.set_stage(batch_info['batch_id'], 'camera')
+                                mark_pushed_files_completed(conn, batch_info['batch_id'])
                                 
                                 console.print("[yellow]⏳ 等待 Google Photos 处理...[/yellow]")
-                                backup_completed = wait_for_backup_complete()
+                                wait_started = time.time()
+                                backup_completed = wait_for_backup_complete(
+                                    cost_model.predict_process_seconds(batch_info['file_batch']))
                                 
                                 if backup_completed:
+                                    record_batch_timing(conn, batch_info['batch_id'],
+                                                        process_seconds=time.time() - wait_started)
                                     # Enhanced cleanup with verification
+                                    # Deletion runs in the background; the ledger releases the
+                                    # reservation (and wakes the push worker) once it finishes
                                     console.print(f"[cyan]🧹 清理 Camera 目录: {camera_folder}[/cyan]")
-                                    cleanup_camera_folder(camera_folder)
+                                    storage_ledger.set_stage(batch_info['batch_id'], 'cleaning')
+                                    remote_cleanup.submit(camera_folder, batch_info['batch_id'])
                                     
                                     # Create temporary batch manager for completion
                                     temp_storage_manager = StorageAwareBatchManager(conn)
                                     temp_storage_manager.current_batch_id = batch_info['batch_id']
-                                    
-                                    # Verify cleanup freed space
-                                    if temp_storage_manager.verify_storage_after_cleanup(batch_info['batch_size_gb']):
-                                        self.total_batches_processed += 1
-                                        temp_storage_manager.complete_batch('completed')
-                                        console.print(f"[green]✅ 批次 {self.total_batches_processed} 完成，存储已释放[/green]")
-                                    else:
-                                        console.print("[yellow]⚠ 清理验证失败，但标记为完成[/yellow]")
-                                        self.total_batches_processed += 1
-                                        temp_storage_manager.complete_batch('completed')
+                                    self.total_batches_processed += 1
+                                    temp_storage_manager.complete_batch('completed')
+                                    console.print(f"[green]✅ 批次 {self.total_batches_processed} 完成，后台清理中[/green]")
                                 else:
                                     console.print("[yellow]⚠ 备份被中断[/yellow]")
+                                    storage_ledger.release(batch_info['batch_id'])
                                     temp_storage_manager = StorageAwareBatchManager(conn)
                                     temp_storage_manager.current_batch_id = batch_info['batch_id']
                                     temp_storage_manager.complete_batch('interrupted')
                                     self.total_batches_processed += 1
                             else:
                                 console.print("[red]❌ 批次移动失败[/red]")
+                                # Files are pushed again into a new temp folder; delete the old one in the background
+                                storage_ledger.set_stage(batch_info['batch_id'], 'cleaning')
+                                remote_cleanup.submit(batch_info['remote_temp_folder'], batch_info['batch_id'])
+                                requeue_batch_files(conn, batch_info['batch_id'], ('pushed',))
                                 temp_storage_manager = StorageAwareBatchManager(conn)
                                 temp_storage_manager.current_batch_id = batch_info['batch_id']
                                 temp_storage_manager.complete_batch('failed')
@@ -1349,20 +4740,16 @@ class SafeParallelBatchScheduler:
                             # Queue was empty, continue
                             pass
                             
-                    elif not cpu_idle:
-                        time.sleep(params['monitor_interval'])
                     else:
-                        # No batch to process, wait
-                        if self.total_batches_pushed > self.total_batches_processed:
-                            time.sleep(2)
-                        else:
-                            if not self.running or not batch_processing:
-                                break
-                            time.sleep(5)
+                        # Block until the CPU goes idle with a batch queued (or stop)
+                        wait_pipeline(
+                            lambda: (not cpu_active_flag and not self.push_queue.empty())
+                            or not self.running,
+                            timeout=60)
                             
                 except Exception as e:
                     console.print(f"[red]处理线程错误: {e}[/red]")
-                    time.sleep(10)
+                    pipeline_sleep(10)
         finally:
             conn.close()
     
@@ -1374,7 +4761,11 @@ class SafeParallelBatchScheduler:
         # Initial storage check with temporary connection
         temp_conn = sqlite3.connect(self.db_path)
         temp_storage_manager = StorageAwareBatchManager(temp_conn)
-        storage_info = temp_storage_manager.get_phone_storage_info()
+        # Reservations from an earlier run are already on the device; start from a fresh df
+        storage_ledger.clear()
+        remote_cleanup.retry_failed()
+        staging_cache.configure()
+        storage_info = temp_storage_manager.get_phone_storage_info(force=True)
         temp_conn.close()
         
         if storage_info:
@@ -1386,11 +4777,12 @@ class SafeParallelBatchScheduler:
                 return False
         
         self.running = True
+        device_health.start()
         console.print("[bold green]🚀 安全并行处理启动[/bold green]")
         
         # Start worker threads
-        self.push_thread = threading.Thread(target=self._push_worker, daemon=True)
-        self.process_thread = threading.Thread(target=self._process_worker, daemon=True)
+        self.push_thread = threading.Thread(target=profiled(self._push_worker, 'push_worker'), daemon=True)
+        self.process_thread = threading.Thread(target=profiled(self._process_worker, 'process_worker'), daemon=True)
         
         self.push_thread.start()
         self.process_thread.start()
@@ -1413,6 +4805,7 @@ def safe_parallel_batch_process_thread():
         # Monitor processing with separate connection
         conn = sqlite3.connect(DB_PATH)
         last_status_time = time.time()
+        report_backlog_eta(conn, parallel=True, refresh=True)
         
         try:
             while batch_processing:
@@ -1427,7 +4820,8 @@ def safe_parallel_batch_process_thread():
                     temp_storage_manager = StorageAwareBatchManager(conn)
                     storage_info = temp_storage_manager.get_phone_storage_info()
                     if storage_info:
-                        console.print(f"[blue]📊 进度: 推送{status['total_pushed']}/处理{status['total_processed']}, 存储:{storage_info['available_gb']:.1f}GB[/blue]")
+                        console.print(f"[blue]📊 进度: 推送{status['total_pushed']}/处理{status['total_processed']}, 存储:{storage_info['available_gb']:.1f}GB, "
+                                      f"速率:{transfer_meter.rate() / 1024 ** 2:.1f}MB/s[/blue]")
                     last_status_time = time.time()
                 
                 # Check completion
@@ -1440,17 +4834,22 @@ def safe_parallel_batch_process_thread():
                         show_completion_notification(status['total_processed'])
                         break
                         
-                time.sleep(3)
+                # Woken by queue hand-offs; the timeout keeps the status report ticking
+                wait_pipeline(timeout=30)
         finally:
             conn.close()
             
         scheduler.running = False
+        notify_pipeline()
         
     except Exception as e:
         console.print(f"[red]安全并行处理错误: {e}[/red]")
     finally:
         batch_processing = False
-        ui_state.set_state('idle')
+        notify_pipeline()
+        ui_state.set_idle_state()
+        staging_cache.clear()
+        schedule_db_maintenance()
 
 
 
@@ -1471,7 +4870,7 @@ def on_start_safe_parallel(event):
 
     # Check prerequisites
     pending_count = query_pending_files_count()
-    if pending_count == 0:
+    if pending_count == 0 and not scan_in_progress.is_set() and not folder_watcher.active:
         print("[提示] 没有待处理文件，请先扫描资料夹")
         return
 
@@ -1489,11 +4888,17 @@ def on_start_safe_parallel(event):
         print(f"[错误] ADB连接失败: {e}")
         return
 
-    ui_state.set_state('processing')
-    batch_processing = True
+    if not maintenance_lock.acquire(blocking=False):
+        print("[提示] 数据库维护进行中，请稍后再开始传输")
+        return
+    try:
+        ui_state.set_state('processing')
+        batch_processing = True
+    finally:
+        maintenance_lock.release()
     
     log("[UI] 启动安全并行批次处理")
-    threading.Thread(target=safe_parallel_batch_process_thread, daemon=True).start()
+    threading.Thread(target=profiled(safe_parallel_batch_process_thread, 'safe_parallel_batch'), daemon=True).start()
     
     print(f"[成功] 安全并行处理已启动，待处理: {pending_count}")
 
@@ -1506,7 +4911,13 @@ def dynamic_batch_process_thread():
 
     try:
         conn = init_db()
-        batch_manager = DynamicBatchManager(conn)
+        # 帳本版管理器: 推送寫入量記入存儲帳本，背景清理與下一批共用同一份空間預測
+        batch_manager = StorageAwareBatchManager(conn)
+        storage_ledger.clear()
+        remote_cleanup.retry_failed()
+        staging_cache.configure()
+        device_health.start()
+        report_backlog_eta(conn, parallel=False, refresh=True)
         total_processed_batches = 0
         max_rounds = params.get('max_rounds', 9999)
 
@@ -1525,7 +4936,7 @@ def dynamic_batch_process_thread():
 
                             if file_batch:
                                 batch_in_process = True
-                                batch_id = batch_manager.start_new_batch()
+                                batch_id = batch_manager.current_batch_id
 
                                 try:
                                     console.print(
@@ -1534,23 +4945,51 @@ def dynamic_batch_process_thread():
                                     # 清理和推送（使用 rich progress）
                                     # clean_camera_batch()
 
+                                    # 前一批可能仍在背景刪除: 以帳本確認空間，並為本批預留
+                                    batch_bytes = sum(f['size'] for f in file_batch)
+                                    if not wait_for_cleanup_space(batch_bytes):
+                                        # 停止請求: 批次尚未開始推送，文件仍為 pending
+                                        discard_batch(conn, batch_id)
+                                        batch_manager.current_batch_id = None
+                                        continue
+                                    storage_ledger.reserve(batch_id, file_batch)
+
                                     remote_temp_folder = f"{REMOTE_ROOT}/temp_{int(time.time())}"
+                                    push_started = time.time()
                                     success_count = push_files_individually(
                                         batch_manager, file_batch, remote_temp_folder
                                     )
-
-                                    if success_count > 0:
+                                    record_batch_timing(conn, batch_id, push_seconds=time.time() - push_started)
+                                    report_backlog_eta(conn, parallel=False)
+
+                                    # 等待備份期間預讀下一批
+                                    batch_manager.prefetch_next_batch()
+
+                                    # 移入 Camera 前再確認一次空間: 前一批 Camera 資料夾可能尚未刪除完
+                                    if success_count > 0 and not wait_for_cleanup_space():
+                                        # 停止請求: 已推送的文件退回待處理；暫存資料夾背景刪除，刪完才釋放預留
+                                        storage_ledger.set_stage(batch_id, 'cleaning')
+                                        remote_cleanup.submit(remote_temp_folder, batch_id)
+                                        requeue_batch_files(conn, batch_id, ('pushed',))
+                                        batch_manager.complete_batch('interrupted')
+                                    elif success_count > 0:
                                         camera_folder = f"{CAMERA_ROOT}/batch_{int(time.time())}"
-                                        if move_remote_folder_safe(remote_temp_folder, camera_folder):
+                                        if run_when_online(lambda: move_remote_folder_safe(remote_temp_folder, camera_folder)):
+                                            storage_ledger.set_stage(batch_id, 'camera')
                                             mark_pushed_files_completed(
-                                                conn, file_batch)
+                                                conn, batch_id)
 
                                             console.print(
                                                 "[yellow]⏳ 等待 Google Photos 備份完成...[/yellow]")
-                                            wait_for_backup_complete()
-
-                                            cleanup_camera_folder(
-                                                camera_folder)
+                                            wait_started = time.time()
+                                            if wait_for_backup_complete(
+                                                    cost_model.predict_process_seconds(file_batch)):
+                                                record_batch_timing(conn, batch_id,
+                                                                    process_seconds=time.time() - wait_started)
+
+                                            storage_ledger.set_stage(batch_id, 'cleaning')
+                                            remote_cleanup.submit(
+                                                camera_folder, batch_id)
                                             batch_manager.complete_batch(
                                                 'completed')
                                             total_processed_batches += 1
@@ -1563,14 +5002,21 @@ def dynamic_batch_process_thread():
                                         else:
                                             console.print(
                                                 "[red]✗ 批次搬移失敗[/red]")
+                                            # 文件會重新推送到新的暫存資料夾，舊的不刪除會佔用兩倍空間
+                                            storage_ledger.set_stage(batch_id, 'cleaning')
+                                            remote_cleanup.submit(remote_temp_folder, batch_id)
+                                            requeue_batch_files(
+                                                conn, batch_id, ('pushed',))
                                             batch_manager.complete_batch(
                                                 'failed')
                                     else:
                                         console.print("[red]✗ 批次推送失敗[/red]")
+                                        storage_ledger.release(batch_id)
                                         batch_manager.complete_batch('failed')
 
                                 except Exception as e:
                                     console.print(f"[red]✗ 批次處理異常: {e}[/red]")
+                                    storage_ledger.release(batch_id)
                                     batch_manager.complete_batch('failed')
                                 finally:
                                     batch_in_process = False
@@ -1582,22 +5028,27 @@ def dynamic_batch_process_thread():
                                         total_processed_batches)
                                     break
                                 else:
-                                    time.sleep(1)
+                                    # 等待掃描寫入新文件
+                                    wait_pipeline(timeout=5)
                         else:
-                            time.sleep(1)
+                            wait_pipeline(timeout=1)
                 else:
-                    time.sleep(1)
+                    # 等待 CPU 轉為閒置
+                    wait_pipeline(lambda: not cpu_active_flag, timeout=60)
 
             except Exception as e:
                 console.print(f"[red]線程錯誤: {e}[/red]")
-                time.sleep(5)
+                pipeline_sleep(5)
 
         conn.close()
         console.print("[bold blue]📴 動態批次處理結束[/bold blue]")
 
     finally:
         batch_processing = False
-        ui_state.set_state('idle')
+        notify_pipeline()
+        ui_state.set_idle_state()
+        staging_cache.clear()
+        schedule_db_maintenance()
         update_pending_count_text()
 
 
@@ -1608,14 +5059,22 @@ def get_completion_statistics_dynamic(conn):
     cur = conn.cursor()
 
     try:
-        # 文件統計
-        cur.execute("SELECT status, COUNT(*) FROM files GROUP BY status")
-        file_stats = dict(cur.fetchall())
+        # 文件統計（讀取觸發器維護的計數表）
+        status_counts = get_status_counts(conn)
+        file_stats = {status: count for status, (count, _) in status_counts.items() if count}
+        file_bytes = {status: total for status, (count, total) in status_counts.items() if count}
 
-        # 動態批次統計
+        # 已歸檔文件視為已完成
+        if 'archived' in file_stats:
+            file_stats['completed'] = file_stats.get('completed', 0) + file_stats.pop('archived')
+            file_bytes['completed'] = file_bytes.get('completed', 0) + file_bytes.pop('archived')
+
+        # 動態批次統計（含歸檔）
         cur.execute(
             "SELECT status, COUNT(*) FROM batch_history GROUP BY status")
         batch_stats = dict(cur.fetchall())
+        for status, count in get_archived_batch_stats().items():
+            batch_stats[status] = batch_stats.get(status, 0) + count
 
         # 處理時間統計 - 使用 batch_history 表
         cur.execute("""
@@ -1629,8 +5088,11 @@ def get_completion_statistics_dynamic(conn):
 
         return {
             'file_stats': file_stats,
+            'file_bytes': file_bytes,
             'batch_stats': batch_stats,
-            'time_stats': time_stats
+            'time_stats': time_stats,
+            'failure_batches': get_batch_failure_summary(conn, limit=3),
+            'telemetry_24h': telemetry.summary(24 * 3600)
         }
 
     except Exception as e:
@@ -1638,8 +5100,11 @@ def get_completion_statistics_dynamic(conn):
         # 返回基本統計
         return {
             'file_stats': {'pending': 0, 'completed': 0},
+            'file_bytes': {},
             'batch_stats': {'completed': 0},
-            'time_stats': (None, None)
+            'time_stats': (None, None),
+            'failure_batches': [],
+            'telemetry_24h': None
         }
 
 
@@ -1654,7 +5119,7 @@ def show_completion_notification(processed_batches):
         # 創建通知窗口
         root = tk.Tk()
         root.title("傳輸完成")
-        root.geometry("500x400")
+        root.geometry("500x460")
         root.resizable(False, False)
 
         # 設置窗口居中
@@ -1662,8 +5127,8 @@ def show_completion_notification(processed_batches):
         screen_width = root.winfo_screenwidth()
         screen_height = root.winfo_screenheight()
         x = (screen_width // 2) - (500 // 2)
-        y = (screen_height // 2) - (400 // 2)
-        root.geometry(f"500x400+{x}+{y}")
+        y = (screen_height // 2) - (460 // 2)
+        root.geometry(f"500x460+{x}+{y}")
 
         # 標題
         title_label = tk.Label(root, text="🎉 動態批次傳輸完成！",
@@ -1698,18 +5163,34 @@ def show_completion_notification(processed_batches):
         file_stats = stats['file_stats']
         total_files = sum(file_stats.values())
         completed_files = file_stats.get('completed', 0)
+        completed_gb = stats.get('file_bytes', {}).get('completed', 0) / (1024 ** 3)
 
         tk.Label(file_frame,
                  text=f"📁 總文件數: {total_files}",
                  font=("Microsoft JhengHei", 10)).pack(anchor="w", padx=10)
         tk.Label(file_frame,
-                 text=f"✅ 成功傳輸: {completed_files}",
+                 text=f"✅ 成功傳輸: {completed_files} ({completed_gb:.1f} GB)",
                  font=("Microsoft JhengHei", 10)).pack(anchor="w", padx=10)
 
         if file_stats.get('failed', 0) > 0:
             tk.Label(file_frame,
                      text=f"❌ 傳輸失敗: {file_stats.get('failed', 0)}",
                      font=("Microsoft JhengHei", 10), fg="red").pack(anchor="w", padx=10)
+            for batch_id, _, batch_count, failed_count, _ in stats.get('failure_batches', []):
+                tk.Label(file_frame,
+                         text=f"   └ {batch_id}: {failed_count}/{batch_count} 失敗",
+                         font=("Microsoft JhengHei", 9), fg="red").pack(anchor="w", padx=10)
+
+        # 最近 24 小時遙測（讀取環形檔的分鐘層）
+        telemetry_24h = stats.get('telemetry_24h')
+        if telemetry_24h:
+            telemetry_frame = tk.LabelFrame(stats_frame, text="近 24 小時",
+                                            font=("Microsoft JhengHei", 12, "bold"))
+            telemetry_frame.pack(fill="x", pady=5)
+            tk.Label(telemetry_frame,
+                     text=f"📈 CPU 平均 {telemetry_24h['cpu_avg']:.1f}% / 最高 {telemetry_24h['cpu_max']:.1f}%，"
+                          f"平均推送 {telemetry_24h['throughput_mbps']:.1f} MB/s",
+                     font=("Microsoft JhengHei", 10)).pack(anchor="w", padx=10)
 
         # 按鈕區域
         button_frame = tk.Frame(root)
@@ -1751,7 +5232,7 @@ def auto_start_cpu_monitoring():
     if not cpu_monitoring:
         cpu_monitoring = True
         log("[自動啟動] CPU監控已開始")
-        threading.Thread(target=cpu_monitor_thread, daemon=True).start()
+        threading.Thread(target=profiled(cpu_monitor_thread, 'cpu_monitor'), daemon=True).start()
     else:
         print("[提示] CPU監控已在運行中")
 
@@ -1792,7 +5273,8 @@ def update_pending_count_text():
     try:
         count = query_pending_files_count()
 #        print(f"待處理文件數: {count}")
-        pending_count_text.set_text(f"待處理文件數: {count:,}")
+        eta = f"（預估剩餘 {format_duration(backlog_eta_seconds)}）" if count and backlog_eta_seconds else ""
+        pending_count_text.set_text(f"待處理文件數: {count:,}{eta}")
         ax_pending_count.figure.canvas.draw_idle()
     except Exception as e:
         print(f"[刷新失敗] 無法更新待處理文件數: {e}")
@@ -1857,7 +5339,7 @@ def on_start_dynamic(event):
 
     # 檢查前置條件
     pending_count = query_pending_files_count()
-    if pending_count == 0:
+    if pending_count == 0 and not scan_in_progress.is_set() and not folder_watcher.active:
         print("[提示] 沒有待處理文件，請先掃描資料夾")
         return
 
@@ -1869,13 +5351,18 @@ def on_start_dynamic(event):
         print(f"[錯誤] ADB連接失敗: {e}")
         return
 
-    # 設置處理狀態
-    ui_state.set_state('processing')
-
-    # 啟動動態批次處理
-    batch_processing = True
+    # 設置處理狀態（維護進行中則拒絕）
+    if not maintenance_lock.acquire(blocking=False):
+        print("[提示] 數據庫維護進行中，請稍後再開始傳輸")
+        return
+    try:
+        ui_state.set_state('processing')
+        # 啟動動態批次處理
+        batch_processing = True
+    finally:
+        maintenance_lock.release()
     log("[UI] 開始動態批次文件傳輸")
-    threading.Thread(target=dynamic_batch_process_thread, daemon=True).start()
+    threading.Thread(target=profiled(dynamic_batch_process_thread, 'dynamic_batch'), daemon=True).start()
     #threading.Thread(target=optimized_batch_process_thread, daemon=True).start()
 
     print(f"[成功] 動態批次處理已啟動，待處理文件數: {pending_count}")
@@ -1888,14 +5375,22 @@ def on_scan_folder_final(event):
         print(f"[防護] {message}")
         return
 
-    # 設置掃描狀態
-    ui_state.set_state('scanning')
+    # 設置掃描狀態（維護進行中則拒絕）
+    if not maintenance_lock.acquire(blocking=False):
+        print("[提示] 數據庫維護進行中，請稍後再掃描")
+        return
+    try:
+        ui_state.set_state('scanning')
+    finally:
+        maintenance_lock.release()
 
     def scan_with_state_reset():
         try:
             select_folder_with_dynamic_batch()
         finally:
-            ui_state.set_state('idle')
+            # 掃描期間已開始的傳輸保持 processing 狀態
+            if ui_state.get_state() == 'scanning':
+                ui_state.set_state('idle')
 
     threading.Thread(target=scan_with_state_reset, daemon=True).start()
 
@@ -1906,7 +5401,9 @@ def on_stop_final(event):
 
     if batch_processing:
         batch_processing = False
-        ui_state.set_state('idle')
+        notify_pipeline()
+        terminate_active_adb_processes()
+        ui_state.set_idle_state()
         log("[UI] 停止動態批次處理")
         print("[成功] 動態批次處理已停止")
 
@@ -1930,6 +5427,87 @@ def on_refresh_pending_count_final(event):
 def on_run_refresh_album_script(event):
     run_remote_shell_script("/sdcard/ToProcess/refresh.sh")
 
+
+def show_telemetry_history(hours=6):
+    """另開視窗顯示遙測歷史（CPU / 推送速率 / 手機可用空間）"""
+    data = telemetry.query(time.time() - hours * 3600)
+    if not data['time']:
+        print("[遙測] 尚無歷史記錄")
+        return
+
+    times = [datetime.fromtimestamp(t) for t in data['time']]
+    history_fig, (ax_hist_cpu, ax_hist_tp, ax_hist_storage) = plt.subplots(3, 1, figsize=(10, 7), sharex=True)
+    history_fig.suptitle(f"最近 {hours} 小時（解析度 {data['resolution']} 秒）", fontsize=12)
+
+    ax_hist_cpu.plot(times, data['cpu_avg'], color='red', linewidth=1, label='平均')
+    ax_hist_cpu.plot(times, data['cpu_max'], color='red', linewidth=0.5, alpha=0.4, label='最高')
+    ax_hist_cpu.axhline(y=params['cpu_threshold'], color='orange', linestyle='--', alpha=0.7)
+    ax_hist_cpu.set_ylabel('CPU %')
+    ax_hist_cpu.legend(loc='upper right')
+
+    ax_hist_tp.plot(times, data['throughput_mbps'], color='blue', linewidth=1)
+    ax_hist_tp.set_ylabel('推送 MB/s')
+
+    ax_hist_storage.plot(times, data['storage_free_gb'], color='green', linewidth=1)
+    ax_hist_storage.set_ylabel('可用 GB')
+
+    for axis in (ax_hist_cpu, ax_hist_tp, ax_hist_storage):
+        axis.grid(True)
+    history_fig.autofmt_xdate()
+    history_fig.show()
+
+
+def on_show_telemetry_history(event):
+    show_telemetry_history()
+
+
+def update_watch_button(watching):
+    """監看按鈕文字；監看線程結束時（含異常結束）也會呼叫"""
+    try:
+        button_watch.label.set_text('停止監看' if watching else '監看資料夾')
+        fig.canvas.draw_idle()
+    except Exception as e:
+        log(f"[UI錯誤] 更新監看按鈕失敗: {e}")
+
+
+def toggle_folder_watch():
+    """開始監看（可選擇再登記一個根目錄）或停止監看"""
+    if folder_watcher.active:
+        folder_watcher.stop()
+        update_watch_button(False)
+        return
+
+    root = tk.Tk()
+    root.withdraw()
+    folder = filedialog.askdirectory(title="選擇要監看的資料夾（取消則監看已登記的資料夾）")
+    root.destroy()
+    if folder:
+        folder_watcher.add_root(folder)
+
+    conn = init_db()
+    registered = FolderWatcher.registered_roots(conn)
+    conn.close()
+    if not registered:
+        print("[UI] 尚未登記任何監看資料夾")
+        return
+    print(f"[UI] 監看 {len(registered)} 個資料夾: " + ", ".join(path for path, _ in registered))
+    if not maintenance_lock.acquire(blocking=False):
+        print("[提示] 數據庫維護進行中，請稍後再開始監看")
+        return
+    try:
+        folder_watcher.start()
+    finally:
+        maintenance_lock.release()
+    update_watch_button(True)
+
+
+def on_toggle_folder_watch(event):
+    can_watch, message = ui_state.can_perform_action('watch_folder', 2.0)
+    if not can_watch:
+        print(f"[防護] {message}")
+        return
+    threading.Thread(target=toggle_folder_watch, daemon=True).start()
+
 def apply_params_from_ui():
     """自動從UI元件讀取並更新參數"""
     global params
@@ -2051,18 +5629,60 @@ button_refresh_album_script = Button(ax_refresh_album_script, '重新整理相
 button_refresh_album_script.label.set_fontsize(12)
 button_refresh_album_script.on_clicked(on_run_refresh_album_script)
 
+# 第三行：資料夾監看（持續匯入新文件）
+ax_watch = plt.axes([base_x + 2 * (button_width + button_gap_x), base_y_bottom - button_gap_y,
+                     button_width, button_height])
+button_watch = Button(ax_watch, '監看資料夾')
+button_watch.label.set_fontsize(12)
+button_watch.on_clicked(on_toggle_folder_watch)
+
 # 刷新待處理文件數按鈕
 ax_refresh = plt.axes([0.44, 0.18, 0.1, 0.05])
 button_refresh = Button(ax_refresh, '刷新數字')
 button_refresh.label.set_fontsize(10)
 button_refresh.on_clicked(on_refresh_pending_count_final)
 
+# 遙測歷史按鈕
+ax_history = plt.axes([0.44, 0.11, 0.1, 0.05])
+button_history = Button(ax_history, '歷史趨勢')
+button_history.label.set_fontsize(10)
+button_history.on_clicked(on_show_telemetry_history)
+
 # 啟動畫面動畫刷新
 ani = FuncAnimation(fig, update, interval=1000)
 
 # /////////////////////////////////////////////////////////////////////////////
 # 程式啟動初始化
 if __name__ == "__main__":
+    if '--replay-cpu-trace' in sys.argv:
+        # 以記錄的 CPU 追蹤比較舊版穩定窗口與變點偵測器
+        print_cpu_trace_replay(sys.argv[sys.argv.index('--replay-cpu-trace') + 1])
+        sys.exit(0)
+
+    if '--plan' in sys.argv:
+        # 容量規劃: python allinone.py --plan [batch_size=500,1000] [batch_size_gb=20,45]
+        #          [cpu_threshold=40,60] [storage_gb=120] [trace=cpu_trace.csv]
+        conn = init_db()
+        plan_grid, plan_options = parse_plan_grid(sys.argv)
+        print_capacity_plan(conn, plan_grid, **plan_options)
+        conn.close()
+        sys.exit(0)
+
+    if '--check-query-plans' in sys.argv:
+        # 查詢計劃回歸檢查: 任一狀態選取退化為全表掃描即以非零碼結束
+        conn = init_db()
+        plan_problems = check_status_query_plans(conn)
+        conn.close()
+        for problem in plan_problems:
+            print(f"[查詢計劃] {problem}")
+        print("[查詢計劃] 正常" if not plan_problems else "[查詢計劃] 發現退化")
+        sys.exit(1 if plan_problems else 0)
+
+    # 選用的工作線程剖析: --profile sample[:秒數] / --profile cprofile[:秒數] 或 ALLINONE_PROFILE
+    profile_mode, profile_window = parse_profile_setting()
+    if profile_mode:
+        thread_profiler = ThreadProfiler(profile_mode, profile_window)
+
     log("[系統啟動] 正在初始化...")
 
     # 修復現有數據庫結構
@@ -2071,9 +5691,13 @@ if __name__ == "__main__":
 
     # 初始化數據庫
     conn = init_db()
+    recover_interrupted_batches(conn)
     update_pending_count_text()
     conn.close()
 
+    # 到期的歸檔 / ANALYZE / VACUUM 在背景執行
+    schedule_db_maintenance()
+
     # 初始化UI狀態管理
     ui_state.set_state('idle')
 
@@ -2081,6 +5705,7 @@ if __name__ == "__main__":
     log("[系統啟動] 正在啟動CPU監控...")
     auto_start_cpu_monitoring()
     log("[系統啟動] CPU監控已啟動")
+    device_health.start()
     log("[系統提示] 點擊'開始傳輸'按鈕開始動態批次處理")
     log("[系統提示] UI狀態管理已啟用 - 防止重複操作")
     log("[系統說明] 動態批次管理 - 真正的斷點續傳功能")
@@ -2088,3 +5713,6 @@ if __name__ == "__main__":
     # plt.tight_layout()
     plt.subplots_adjust()
     plt.show()
+    telemetry.close()
+    if thread_profiler is not None:
+        thread_profiler.stop()
@@ -8,6 +8,9 @@ from collections import deque
 from datetime import datetime
 import re
 
+from fastwalk import FastWalker
+from compactpaths import uses_compact_paths, file_exists, get_status_counts
+
 # Try to import rich modules
 try:
     from rich.progress import Progress, TextColumn, BarColumn, TimeElapsedColumn, TimeRemainingColumn
@@ -129,9 +132,8 @@ def init_db(db_path=DB_PATH):
 def query_pending_files_count():
     try:
         conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM files WHERE status IN ('pending', 'failed')")
-        pending_count = cur.fetchone()[0]
+        counts = get_status_counts(conn)
+        pending_count = sum(counts.get(status, (0, 0))[0] for status in ('pending', 'failed'))
         conn.close()
         return pending_count
     except Exception as e:
@@ -436,8 +438,8 @@ def show_statistics():
         cur = conn.cursor()
         
         # File statistics
-        cur.execute("SELECT status, COUNT(*) FROM files GROUP BY status")
-        file_stats = dict(cur.fetchall())
+        # Counter rows stay at 0 once a status empties; show only non-empty ones like GROUP BY did
+        file_stats = {status: count for status, (count, _) in get_status_counts(conn).items() if count}
         
         # Batch statistics
         cur.execute("SELECT status, COUNT(*) FROM batch_history GROUP BY status")
@@ -486,40 +488,46 @@ def stop_cpu_monitoring():
     cpu_monitoring = False
     log("[CPU Monitor] Stopped")
 
-def scan_folder_cli():
-    """CLI version of folder scanning"""
-    folder_path = input("Enter folder path to scan: ").strip()
-    
-    if not os.path.exists(folder_path):
-        print("Folder does not exist!")
+def scan_folder_cli(folder_paths=None):
+    """CLI version of folder scanning (folder_paths: one path or a list; prompts when omitted)"""
+    if folder_paths is None:
+        # Several folders can be entered separated by ';'
+        folder_paths = [p.strip() for p in input("Enter folder path(s) to scan (separate with ;): ").split(";")]
+    elif isinstance(folder_paths, str):
+        folder_paths = [folder_paths]
+
+    folder_paths = [p for p in folder_paths if p]
+    missing = [p for p in folder_paths if not os.path.isdir(p)]
+    for folder_path in missing:
+        print(f"Folder does not exist: {folder_path}")
+    folder_paths = [p for p in folder_paths if p not in missing]
+    if not folder_paths:
         return
     
-    print(f"Scanning folder: {folder_path}")
+    print(f"Scanning folder(s): {', '.join(folder_paths)}")
     
-    # Simplified scanning logic
+    # Simplified scanning logic; size/mtime come from the walker's directory entries
     conn = init_db()
+    compact = uses_compact_paths(conn)
     files_added = 0
+    walker = FastWalker(folder_paths)
     
     try:
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if os.path.exists(file_path):
-                    stat_info = os.stat(file_path)
-                    
-                    cur = conn.cursor()
-                    cur.execute("SELECT id FROM files WHERE path=?", (file_path,))
-                    
-                    if not cur.fetchone():
-                        cur.execute("""
-                            INSERT INTO files (path, size, mtime, status)
-                            VALUES (?, ?, ?, 'pending')
-                        """, (file_path, stat_info.st_size, int(stat_info.st_mtime)))
-                        files_added += 1
+        cur = conn.cursor()
+        for info in walker:
+            if not file_exists(cur, info.path, compact):
+                cur.execute("""
+                    INSERT INTO files (path, size, mtime, status)
+                    VALUES (?, ?, ?, 'pending')
+                """, (info.path, info.size, int(info.mtime)))
+                files_added += 1
         
         conn.commit()
         conn.close()
         
+        for root, stats in walker.stats.items():
+            log(f"  {root}: {stats['files']} files, {stats['dirs']} folders, "
+                f"{stats['bytes'] / 1024**3:.2f} GB, {stats['seconds']:.1f}s, {stats['errors']} errors")
         log(f"Scan completed: {files_added} new files added")
         
     except Exception as e:
@@ -2,11 +2,21 @@ import os
 import sys
 import subprocess
 import sqlite3
+from bisect import bisect_right
 from datetime import datetime
+from itertools import accumulate
 from math import ceil
 from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn
 import time
 
+from fastwalk import FastWalker
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
 ####################
 # CONFIGURATION
 ####################
@@ -48,18 +58,17 @@ def init_db(db_path="filetransfer.db"):
     return conn
 
 
-def scan_and_prepare(conn, source_root):
-    print(f"Scanning files in {source_root} ...")
-    all_files = []
-    for dirpath, _, filenames in os.walk(source_root):
-        for f in filenames:
-            full_path = os.path.join(dirpath, f)
-            try:
-                size = os.path.getsize(full_path)
-                mtime = int(os.path.getmtime(full_path))
-                all_files.append((full_path, size, mtime))
-            except Exception as e:
-                print(f"Skipping unreadable file: {full_path} ({e})")
+def scan_and_prepare(conn, source_roots):
+    """Scan one folder or a list of folders and record new files as pending."""
+    walker = FastWalker(source_roots)
+    print(f"Scanning files in {', '.join(walker.roots)} ...")
+    # Walker output is unordered; sort so ids (and therefore batches) follow folder order
+    all_files = sorted((info.path, info.size, int(info.mtime)) for info in walker)
+    for path, e in walker.errors:
+        print(f"Skipping unreadable entry: {path} ({e})")
+    for root, stats in walker.stats.items():
+        print(f"  {root}: {stats['files']} files, {stats['dirs']} folders, "
+              f"{stats['bytes'] / 1_000_000_000:.2f} GB in {stats['seconds']:.1f}s")
 
     print(f"Found {len(all_files)} files. Inserting into database...")
 
@@ -101,23 +110,97 @@ def adb_push_file(local_path, remote_folder):
     run_adb_command(["push", local_path, remote_path])
 
 ####################
-# PROCESSING PHASE
+# TRANSFER PLANNING
 ####################
 
+def prefix_sums(sizes):
+    """Cumulative sizes with a leading 0, so bytes of files [a, b) are cum[b] - cum[a]."""
+    if NUMPY_AVAILABLE:
+        cum = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(sizes, dtype=np.int64), out=cum[1:])
+        return cum
+    return [0] + list(accumulate(sizes))
 
-def process_files(conn):
+
+def last_within(cum, limit, lo, hi):
+    """Largest end in [lo, hi] with cum[end] <= limit (cum is non-decreasing)."""
+    if NUMPY_AVAILABLE:
+        end = int(np.searchsorted(cum[lo:hi + 1], limit, side="right")) + lo - 1
+    else:
+        end = bisect_right(cum, limit, lo, hi + 1) - 1
+    return max(end, lo)
+
+
+def plan_transfers(pending_files,
+                   max_files=MAX_FILES_PER_BATCH,
+                   max_batch_bytes=MAX_BATCH_SIZE_BYTES,
+                   max_session_bytes=MAX_TOTAL_TRANSFER_BYTES):
+    """
+    Split pending (id, path, size) rows, in order, into sessions of batches.
+
+    Same greedy rules as a transfer run: a session stops before the file that would
+    exceed max_session_bytes, and a batch rolls over at max_files or before the file
+    that would exceed max_batch_bytes; a file larger than max_batch_bytes on its own
+    goes out as a one-file batch. Boundaries are found by binary search over the
+    cumulative sizes, so the whole plan costs one pass plus a search per batch.
+
+    Only files larger than the session cap can never be sent; they are returned
+    separately instead of stalling the plan.
+
+    Returns (sessions, oversized): sessions is a list of sessions, each a list of
+    batches, each a list of rows.
+    """
+    files = [f for f in pending_files if f[2] <= max_session_bytes]
+    oversized = [f for f in pending_files if f[2] > max_session_bytes]
+
+    cum = prefix_sums([f[2] for f in files])
+    n = len(files)
+    sessions = []
+    start = 0
+    while start < n:
+        session_end = last_within(cum, cum[start] + max_session_bytes, start + 1, n)
+        batches = []
+        batch_start = start
+        while batch_start < session_end:
+            batch_end = last_within(cum, cum[batch_start] + max_batch_bytes,
+                                    batch_start + 1, min(batch_start + max_files, session_end))
+            batches.append(files[batch_start:batch_end])
+            batch_start = batch_end
+        sessions.append(batches)
+        start = session_end
+    return sessions, oversized
+
+
+def load_transfer_plan(conn):
     cur = conn.cursor()
     cur.execute("SELECT id, path, size FROM files WHERE status='pending' ORDER BY id")
-    pending_files = cur.fetchall()
+    return plan_transfers(cur.fetchall())
 
-    if not pending_files:
+
+def print_oversized(oversized):
+    if oversized:
+        print(f"\nSkipping {len(oversized)} file(s) larger than the session limit:")
+        for f in oversized[:5]:
+            print(f"  {f[1]} ({f[2] / 1_000_000_000:.2f} GB)")
+        if len(oversized) > 5:
+            print(f"  ... and {len(oversized)-5} more files")
+
+
+####################
+# PROCESSING PHASE
+####################
+
+
+def process_files(conn):
+    sessions, oversized = load_transfer_plan(conn)
+    print_oversized(oversized)
+
+    if not sessions:
         print("No pending files to process.")
         return
 
+    cur = conn.cursor()
     total_transferred = 0
-    batch_files = []
-    batch_size = 0
-    batch_index = 1
 
     def create_remote_folder(batch_index):
         timestamp = datetime.now().strftime("%m%d%H%M%S")
@@ -126,8 +209,6 @@ def process_files(conn):
         adb_create_remote_folder(remote_batch_folder)
         return remote_batch_folder
 
-    remote_batch_folder = create_remote_folder(batch_index)
-
     print("\nStarting file transfers with progress bar:")
 
     # Rich progress bar context
@@ -139,54 +220,35 @@ def process_files(conn):
         TimeRemainingColumn(),
         transient=True,
     ) as progress:
-        task = None
-
-        for file_id, filepath, filesize in pending_files:
-            # Stop if total transferred exceeds max allowed
-            if total_transferred + filesize > MAX_TOTAL_TRANSFER_BYTES:
-                print(f"\nReached total transfer limit of ~{MAX_TOTAL_TRANSFER_BYTES / 1e9:.1f} GB. Stopping processing.")
-                break
-
-            # Check batch size and count limits for folder organization
-            if len(batch_files) >= MAX_FILES_PER_BATCH or batch_size + filesize > MAX_BATCH_SIZE_BYTES:
-                batch_index += 1
-                remote_batch_folder = create_remote_folder(batch_index)
-                batch_files = []
-                batch_size = 0
-                if task is not None:
-                    progress.remove_task(task)
-                    task = None  # Reset for new batch
-
-            # Add new progress task when batch starts or after batch rollover
-            if task is None:
-                # Get total number of files in the batch ahead (up to limits)
-                # Since we do not precompute batch files here, we can assign total=1, and update total dynamically,
-                # or just keep total unknown by estimating remaining files of this batch.
-                # For simplicity, set total=max batch size in files or unknown. Or set total to 1 temporarily.
-                task = progress.add_task(f"Batch {batch_index} files", total=None)  # total unknown
-
-            try:
-                adb_push_file(filepath, remote_batch_folder)
-
-                # Update DB immediately after successful push
-                cur.execute(
-                    "UPDATE files SET status='transferred', batch_id=?, transfer_time=datetime('now') WHERE id=?",
-                    (batch_index, file_id)
-                )
-                conn.commit()
-                total_transferred += filesize
-                batch_files.append(file_id)
-                batch_size += filesize
-
-                # Increment progress task by 1 file
+        # One run transfers the first planned session; the rest stay pending for later runs
+        for batch_index, batch_files in enumerate(sessions[0], start=1):
+            remote_batch_folder = create_remote_folder(batch_index)
+            task = progress.add_task(f"Batch {batch_index} files", total=len(batch_files))
+
+            for file_id, filepath, filesize in batch_files:
+                try:
+                    adb_push_file(filepath, remote_batch_folder)
+
+                    # Update DB immediately after successful push
+                    cur.execute(
+                        "UPDATE files SET status='transferred', batch_id=?, transfer_time=datetime('now') WHERE id=?",
+                        (batch_index, file_id)
+                    )
+                    conn.commit()
+                    total_transferred += filesize
+                except Exception as e:
+                    print(f"\nError pushing file {filepath}: {e}")
+                    # Optionally mark as failed:
+                    # cur.execute("UPDATE files SET status='failed' WHERE id=?", (file_id,))
+                    conn.commit()
+                    # Continue despite errors
+
                 progress.update(task, advance=1)
-            except Exception as e:
-                print(f"\nError pushing file {filepath}: {e}")
-                # Optionally mark as failed:
-                # cur.execute("UPDATE files SET status='failed' WHERE id=?", (file_id,))
-                conn.commit()
-                # Continue despite errors
-                continue
+
+            progress.remove_task(task)
+
+        if len(sessions) > 1:
+            print(f"\nReached total transfer limit of ~{MAX_TOTAL_TRANSFER_BYTES / 1e9:.1f} GB. Stopping processing.")
 
         # End of loop
     print(f"Finished processing session. Total transferred: {total_transferred / 1_000_000_000:.2f} GB\n")
@@ -257,67 +319,25 @@ def dry_run(conn):
 
 
 def dry_run_simulate_full(conn):
-    MAX_FILES_PER_BATCH = 1000
-    MAX_BATCH_SIZE_BYTES = 90 * 1_000_000_000
-    MAX_TOTAL_TRANSFER_BYTES = 100 * 1_000_000_000
-
-    cur = conn.cursor()
-    cur.execute("SELECT id, path, size FROM files WHERE status='pending' ORDER BY id")
-    all_pending_files = cur.fetchall()
+    sessions, oversized = load_transfer_plan(conn)
+    print_oversized(oversized)
 
-    if not all_pending_files:
+    if not sessions:
         print("No pending files to process.")
         return
 
     print("Dry run (simulated full transfer): showing batches grouped by sessions capped at ~100GB")
 
-    # Simulate file status in memory
-    simulated_pending = list(all_pending_files)
-    session_count = 1
-
-    while simulated_pending:
-        total_tracked = 0
-        batch_files = []
-        batch_size = 0
-        batch_index = 1
-
+    for session_count, batches in enumerate(sessions, start=1):
         print(f"\n=== Simulated session #{session_count} ===")
-
-        i = 0
-        while i < len(simulated_pending):
-            file_id, filepath, filesize = simulated_pending[i]
-
-            # Session cap: stop if session would be exceeded
-            if total_tracked + filesize > MAX_TOTAL_TRANSFER_BYTES:
-                break
-
-            # Batch boundary: print and move to next batch if limit would be exceeded
-            if len(batch_files) >= MAX_FILES_PER_BATCH or batch_size + filesize > MAX_BATCH_SIZE_BYTES:
-                print_batch_summary(batch_index, batch_files, batch_size)
-                batch_index += 1
-                batch_files = []
-                batch_size = 0
-                continue  # Do not increment i, re-check this file in new batch
-
-            # Add file to current batch
-            batch_files.append((file_id, filepath, filesize))
-            batch_size += filesize
-            total_tracked += filesize
-
-            # Remove from pending — simulating successful transfer
-            simulated_pending.pop(i)
-            # Don't increment i: we just shortened the list
-
-        # Print the last batch if it has files
-        if batch_files:
+        total_tracked = 0
+        for batch_index, batch_files in enumerate(batches, start=1):
+            batch_size = sum(f[2] for f in batch_files)
             print_batch_summary(batch_index, batch_files, batch_size)
-
+            total_tracked += batch_size
         print(f"\nSimulated session #{session_count} total transfer: {total_tracked / 1_000_000_000:.2f} GB")
 
-        if not simulated_pending:
-            print("\nAll pending files simulated as transferred.")
-            break
-        session_count += 1
+    print("\nAll pending files simulated as transferred.")
 
 def print_batch_summary(batch_index, batch_files, batch_size):
     print(f"\nBatch {batch_index}: {len(batch_files)} files, total size: {batch_size / 1_000_000_000:.2f} GB")
@@ -338,60 +358,17 @@ def print_batch_summary(batch_index, batch_files, batch_size):
 
 
 def estimate_sessions(conn):
-    MAX_FILES_PER_BATCH = 1000
-    MAX_BATCH_SIZE_BYTES = 90 * 1_000_000_000
-    MAX_TOTAL_TRANSFER_BYTES = 100 * 1_000_000_000
+    sessions, oversized = load_transfer_plan(conn)
+    print_oversized(oversized)
 
-    cur = conn.cursor()
-    cur.execute("SELECT id, path, size FROM files WHERE status='pending' ORDER BY id")
-    pending_files = cur.fetchall()
-
-    if not pending_files:
+    if not sessions:
         print("No pending files to process.")
         return
 
-    # Copy to mutable list to simulate processing
-    simulated_pending = list(pending_files)
-    sessions = []
-    session_count = 1
-
-    while simulated_pending:
-        total_transferred = 0
-        batch_files = []
-        batch_size = 0
-        batch_index = 1
-
-        # For session size accumulation
-        session_size = 0
-
-        i = 0
-        while i < len(simulated_pending):
-            file_id, filepath, filesize = simulated_pending[i]
-
-            # Stop adding files if this file would exceed session total limit
-            if total_transferred + filesize > MAX_TOTAL_TRANSFER_BYTES:
-                break
-
-            # Start new batch if limits exceeded (batch file count or batch size)
-            if len(batch_files) >= MAX_FILES_PER_BATCH or batch_size + filesize > MAX_BATCH_SIZE_BYTES:
-                batch_index += 1
-                batch_files = []
-                batch_size = 0
-                # Continue without incrementing i to reprocess the file in new batch
-                continue
-
-            # Add file to batch and session total
-            batch_files.append((file_id, filepath, filesize))
-            batch_size += filesize
-            total_transferred += filesize
-
-            # Remove it from pending files to simulate transfer progress
-            simulated_pending.pop(i)
-            # Do not increment i since we removed current file
-
-        sessions.append(total_transferred)
-        print(f"Session {session_count}: {total_transferred / 1_000_000_000:.2f} GB to transfer")
-        session_count += 1
+    for session_count, batches in enumerate(sessions, start=1):
+        total_transferred = sum(f[2] for batch_files in batches for f in batch_files)
+        print(f"Session {session_count}: {total_transferred / 1_000_000_000:.2f} GB to transfer "
+              f"({len(batches)} batches)")
 
     print(f"\nTotal sessions needed: {len(sessions)}")
 
@@ -423,11 +400,13 @@ def main():
         choice = input("Enter choice: ").strip()
 
         if choice == '1':
-            source_folder = input("Enter source folder path to scan: ").strip()
-            if not os.path.isdir(source_folder):
-                print(f"Error: source folder '{source_folder}' does not exist or is not a directory")
+            source_folders = [p.strip() for p in input("Enter source folder path(s) to scan (separate with ;): ").split(";") if p.strip()]
+            missing = [p for p in source_folders if not os.path.isdir(p)]
+            if missing or not source_folders:
+                for source_folder in missing:
+                    print(f"Error: source folder '{source_folder}' does not exist or is not a directory")
                 continue
-            scan_and_prepare(conn, source_folder)
+            scan_and_prepare(conn, source_folders)
 
         elif choice == '2':
             process_files(conn)
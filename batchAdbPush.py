@@ -1,27 +1,29 @@
 import os
 import sys
+import shutil
 import subprocess
 from math import ceil
 from datetime import datetime
-import time
 import locale
 from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn
 
+from fastwalk import FastWalker
+
 # This program will:
 # 1. Scans all files in a specified local folder
 # 2. Splits files into batches (default: 1000 per batch)
 # 3. Creates a unique timestamped folder on the Android device for each batch
 # 4. Pushes files to corresponding remote folders via ADB
+# 5. Records every confirmed push in a journal so a rerun skips files already on the device
+# 6. With --staged, hardlinks each batch into a local staging folder and pushes it with one adb call
 
-if len(sys.argv) < 1:
-    print("Usage: python batchAdbPush.py <source_folder>")
-    sys.exit(1)
-    
 #local_root = r"N:\2021\05"  # <-- Change to your source folder
-local_root = sys.argv[1]
 remote_root = "/sdcard/ToProcess"
 batch_size = 1000
 adb_path = r"D:\Apps\QtScrcpy-win-x64-v3.2.0\adb.exe"  # <-- Your adb.exe location
+# Append-only record of pushed files (size, mtime, path); kept next to this script so reruns from any directory share it
+journal_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batchAdbPush.journal")
+staging_root = None  # Staging folder for --staged; None puts it next to the source folder (same volume for hardlinks)
 
 # Get system encoding for subprocess output
 SYSTEM_ENCODING = locale.getpreferredencoding(False)
@@ -44,15 +46,47 @@ def run_adb_command(cmd):
     # result.stdout may be None if the command produces no output
     return result.stdout.strip() if result.stdout else ""
 
-def get_all_files(root):
-    """Recursively get all file paths under root."""
-    file_list = []
-    for dirpath, _, filenames in os.walk(root):
-        for f in filenames:
-            full_path = os.path.join(dirpath, f)
-            file_list.append(full_path)
+def get_all_files(roots, exclude_dir=None):
+    """Recursively get (path, size, mtime) for all files under one or more roots, in path order."""
+    walker = FastWalker(roots, exclude_dirs=[exclude_dir] if exclude_dir else ())
+    file_list = sorted((info.path, info.size, int(info.mtime)) for info in walker)
+    for path, e in walker.errors:
+        print(f"Skipping unreadable entry: {path} ({e})")
+    for root, stats in walker.stats.items():
+        print(f"  {root}: {stats['files']} files, {stats['bytes'] / 1_000_000_000:.2f} GB "
+              f"scanned in {stats['seconds']:.1f}s")
     return file_list
 
+def journal_key(entry):
+    """(path, size, mtime) with the path absolute and case/separator-normalized, so spellings of a root match."""
+    path, size, mtime = entry
+    return os.path.normcase(os.path.abspath(path)), size, mtime
+
+def load_journal(path):
+    """Return the set of normalized (path, size, mtime) entries already confirmed on the device."""
+    confirmed = set()
+    if not os.path.exists(path):
+        return confirmed
+    with open(path, "r", encoding="utf-8", errors="replace") as journal:
+        for line in journal:
+            # A line cut short by an interruption has no newline and is ignored
+            if not line.endswith("\n"):
+                continue
+            parts = line.rstrip("\n").split("\t", 2)
+            if len(parts) != 3:
+                continue
+            try:
+                confirmed.add(journal_key((parts[2], int(parts[0]), int(parts[1]))))
+            except ValueError:
+                continue
+    return confirmed
+
+def journal_record(journal, entry):
+    """Append one confirmed push to the journal."""
+    path, size, mtime = journal_key(entry)
+    journal.write(f"{size}\t{mtime}\t{path}\n")
+    journal.flush()
+
 def create_remote_folder(folder_name):
     """Create folder on Android device via adb shell mkdir."""
     remote_path = f"{remote_root}/{folder_name}"
@@ -68,40 +102,115 @@ def push_file_to_remote(local_path, remote_folder):
     # print(f"Pushing {local_path} -> {remote_path}")
     run_adb_command(["push", local_path, remote_path])
 
+def stage_batch(batch_files, staging_folder):
+    """
+    Hardlink batch files into staging_folder under their remote names.
+    Returns (staged, unstaged): files that could not be linked (other volume,
+    filesystem without hardlinks) are left for a per-file push.
+    """
+    if os.path.exists(staging_folder):
+        shutil.rmtree(staging_folder)
+    os.makedirs(staging_folder)
+    staged, unstaged = [], []
+    for entry in batch_files:
+        link_path = os.path.join(staging_folder, os.path.basename(entry[0]))
+        try:
+            # Same name twice in a batch: the later file wins, as with per-file pushes
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.link(entry[0], link_path)
+            staged.append(entry)
+        except OSError:
+            unstaged.append(entry)
+    return staged, unstaged
+
+def push_folder_to_remote(staging_folder):
+    """Push a staged batch folder in one adb sync session; it lands as remote_root/<folder name>."""
+    run_adb_command(["push", staging_folder, remote_root])
+
+def push_batch_staged(batch_files, staging_folder, journal):
+    """Stage and push one batch as a folder; returns the files left for per-file push."""
+    try:
+        staged, unstaged = stage_batch(batch_files, staging_folder)
+        if staged:
+            remote_batch_folder = f"{remote_root}/{os.path.basename(staging_folder)}"
+            # The batch folder must not exist yet, or adb nests the pushed folder inside it
+            run_adb_command(["shell", "mkdir", "-p", remote_root])
+            print(f"Pushing staged folder ({len(staged)} files) -> {remote_batch_folder}")
+            push_folder_to_remote(staging_folder)
+            for entry in staged:
+                journal_record(journal, entry)
+    finally:
+        # Also after a failed push, so no link trees are left behind; the source files are untouched
+        shutil.rmtree(staging_folder, ignore_errors=True)
+    if unstaged:
+        print(f"Could not hardlink {len(unstaged)} files; pushing them one by one")
+    return unstaged
+
 def main():
-    # Step 1: Get all files
-    all_files = get_all_files(local_root)
-    total_files = len(all_files)
-    print(f"Total files found: {total_files}")
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if not args:
+        print("Usage: python batchAdbPush.py <source_folder> [<source_folder> ...] [--staged]")
+        sys.exit(1)
+    # Absolute roots: file paths (and journal keys) no longer depend on the CWD or a trailing separator
+    local_roots = [os.path.abspath(root) for root in args]
+    staged_mode = "--staged" in sys.argv
+    staging_base = os.path.abspath(staging_root or os.path.join(
+        os.path.dirname(local_roots[0]), ".adbpush_staging"))
+
+    # Step 1: Get all files, leaving out the ones the journal already confirms.
+    # The staging folder is always excluded: links left by an interrupted --staged run are not new files.
+    all_files = get_all_files(local_roots, exclude_dir=staging_base)
+    confirmed = load_journal(journal_path)
+    pending_files = [entry for entry in all_files if journal_key(entry) not in confirmed]
+    total_files = len(pending_files)
+    print(f"Total files found: {len(all_files)}")
+    if len(all_files) != total_files:
+        print(f"Skipping {len(all_files) - total_files} files already pushed (journal: {journal_path})")
 
     # Step 2: Calculate number of batches
     num_batches = ceil(total_files / batch_size)
     print(f"Splitting into {num_batches} batches of up to {batch_size} files each")
 
+    # Batch folders share the run's start time and are numbered, so names stay unique without waiting
+    run_timestamp = datetime.now().strftime("%m%d%H%M%S")
+
     # Step 3: Process each batch with Rich progress bar
-    for i in range(num_batches):
-        batch_files = all_files[i*batch_size:(i+1)*batch_size]
-        timestamp = datetime.now().strftime("%m%d%H%M%S")
-        batch_folder_name = f"batch_{timestamp}"
-        remote_batch_folder = create_remote_folder(batch_folder_name)
-
-        print(f"Pushing batch {i+1}/{num_batches} ({len(batch_files)} files)...")
-
-        # Rich progress bar for this batch
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            "[progress.percentage]{task.percentage:>3.0f}%",
-            TimeElapsedColumn(),
-            TimeRemainingColumn(),
-            transient=True,  # Remove bar after completion
-        ) as progress:
-            task = progress.add_task(f"Batch {i+1}/{num_batches}", total=len(batch_files))
-            for file_path in batch_files:
-                push_file_to_remote(file_path, remote_batch_folder)
-                progress.update(task, advance=1)
-        # Ensure unique timestamp for each batch
-        time.sleep(1)
+    with open(journal_path, "a", encoding="utf-8") as journal:
+        for i in range(num_batches):
+            batch_files = pending_files[i*batch_size:(i+1)*batch_size]
+            batch_folder_name = f"batch_{run_timestamp}_{i+1:04d}"
+            remote_batch_folder = f"{remote_root}/{batch_folder_name}"
+
+            unstaged = batch_files
+            if staged_mode:
+                unstaged = push_batch_staged(batch_files, os.path.join(staging_base, batch_folder_name), journal)
+                if not unstaged:
+                    os.fsync(journal.fileno())
+                    continue
+
+            # mkdir -p also covers a folder the staged push already created
+            create_remote_folder(batch_folder_name)
+            print(f"Pushing batch {i+1}/{num_batches} ({len(unstaged)} files)...")
+
+            # Rich progress bar for this batch
+            with Progress(
+                TextColumn("[progress.description]{task.description}"),
+                BarColumn(),
+                "[progress.percentage]{task.percentage:>3.0f}%",
+                TimeElapsedColumn(),
+                TimeRemainingColumn(),
+                transient=True,  # Remove bar after completion
+            ) as progress:
+                task = progress.add_task(f"Batch {i+1}/{num_batches}", total=len(unstaged))
+                for entry in unstaged:
+                    push_file_to_remote(entry[0], remote_batch_folder)
+                    journal_record(journal, entry)
+                    progress.update(task, advance=1)
+            os.fsync(journal.fileno())
+
+    if staged_mode and os.path.isdir(staging_base) and not os.listdir(staging_base):
+        os.rmdir(staging_base)
 
     print("All files pushed successfully.")
 
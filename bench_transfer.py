@@ -0,0 +1,357 @@
+import os
+import sys
+import io
+import json
+import time
+import random
+import sqlite3
+import platform
+import argparse
+import subprocess
+import contextlib
+from datetime import datetime
+
+# Scan and database micro-benchmarks for the ADB transfer scripts.
+#
+# 1. Generates synthetic source trees (sparse files with real media headers,
+#    photo/video/sidecar size mix) in a deep (year/month/day/event) and a flat
+#    layout. Trees are cached in the work folder and reused across runs.
+# 2. Times the scanners: allinone.scan_and_add_files (first scan and rescan),
+#    batchAdbProcess.scan_and_prepare, allinonecmd.scan_folder_cli, plus the
+#    bare walkers (fastwalk vs os.walk + os.stat).
+# 3. Times the allinone DB hot paths on the scanned catalog: get_next_file_batch,
+#    mark_file_pushed, mark_pushed_files_completed and the status counts.
+# 4. Writes everything to JSON with the git commit, to compare across commits:
+#
+#    python bench_transfer.py --sizes 10k,100k --output before.json
+#    python bench_transfer.py --sizes 10k,100k --compare before.json
+#
+# Files are sparse, so 1M files take little disk space but need a filesystem
+# with sparse file support (NTFS/ext4/APFS, not FAT/exFAT). Hashing of small
+# files is off by default because it would read every synthetic file; use
+# --hash to include it.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("MPLBACKEND", "Agg")   # allinone builds its matplotlib UI on import
+
+SIZE_PRESETS = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+LAYOUTS = ("deep", "flat")
+
+MB = 1024 * 1024
+# (extension, share of files, header bytes, median size, lognormal sigma, max size)
+FILE_MIX = [
+    (".jpg",  0.60, b"\xff\xd8\xff\xe0\x00\x10JFIF\x00", 3.5 * MB, 0.6, 40 * MB),
+    (".heic", 0.20, b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00", 2.5 * MB, 0.5, 30 * MB),
+    (".png",  0.03, b"\x89PNG\r\n\x1a\n", 1.0 * MB, 1.0, 50 * MB),
+    (".mp4",  0.08, b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00", 60 * MB, 1.1, 4096 * MB),
+    (".mov",  0.04, b"\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00", 80 * MB, 1.0, 4096 * MB),
+    (".aae",  0.03, b"<?xml version=\"1.0\"?>", 2 * 1024, 0.3, 16 * 1024),
+    (".txt",  0.02, b"notes", 4 * 1024, 1.0, 64 * 1024),
+]
+
+FILES_PER_LEAF_DEEP = 40      # Files per event folder in the deep layout
+FILES_PER_DIR_FLAT = 5000     # Files per folder in the flat layout
+
+
+def git_revision():
+    """(commit, dirty) of the repo, or (None, None) outside git."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        return commit, bool(status)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+####################
+# SYNTHETIC TREES
+####################
+
+def pick_file(rng):
+    roll = rng.random()
+    for ext, share, header, median, sigma, max_size in FILE_MIX:
+        roll -= share
+        if roll <= 0:
+            break
+    size = int(min(max_size, max(len(header), rng.lognormvariate(0, sigma) * median)))
+    return ext, header, size
+
+
+def tree_dirs(layout, count, rng):
+    """Yield (relative folder, number of files) until count files are placed."""
+    placed = 0
+    if layout == "flat":
+        index = 0
+        while placed < count:
+            n = min(FILES_PER_DIR_FLAT, count - placed)
+            yield f"dir_{index:04d}", n
+            placed += n
+            index += 1
+        return
+    year, month, day, event = 2005, 1, 1, 0
+    while placed < count:
+        n = min(max(1, int(rng.gauss(FILES_PER_LEAF_DEEP, FILES_PER_LEAF_DEEP / 3))), count - placed)
+        yield os.path.join(f"{year}", f"{month:02d}", f"{day:02d}", f"event_{event:02d}"), n
+        placed += n
+        event += 1
+        if event >= rng.randint(1, 4):
+            event, day = 0, day + rng.randint(1, 6)
+            if day > 28:
+                day, month = 1, month + 1
+                if month > 12:
+                    month, year = 1, year + 1
+
+
+def build_tree(work_dir, layout, count, seed):
+    """Create (or reuse) a synthetic tree; returns (root, manifest)."""
+    name = f"{layout}_{count}_s{seed}"
+    root = os.path.join(work_dir, "trees", name)
+    manifest_path = os.path.join(work_dir, "trees", f"{name}.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            return root, json.load(f)
+
+    print(f"Generating {layout} tree with {count:,} files ...")
+    rng = random.Random(seed)
+    started = time.time()
+    total_bytes = dirs = 0
+    serial = 0
+    for rel_dir, n in tree_dirs(layout, count, rng):
+        folder = os.path.join(root, rel_dir)
+        os.makedirs(folder, exist_ok=True)
+        dirs += 1
+        for _ in range(n):
+            ext, header, size = pick_file(rng)
+            path = os.path.join(folder, f"IMG_{serial:07d}{ext}")
+            with open(path, "wb") as f:
+                f.write(header)
+                f.truncate(size)   # Sparse: only the header is stored
+            total_bytes += size
+            serial += 1
+
+    manifest = {"layout": layout, "files": count, "dirs": dirs, "bytes": total_bytes, "seed": seed,
+                "generate_seconds": round(time.time() - started, 2)}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"  {dirs:,} folders, {total_bytes / 1024**4:.2f} TB logical, {manifest['generate_seconds']}s")
+    return root, manifest
+
+
+####################
+# TIMING HELPERS
+####################
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the scanners' console output while timing."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+@contextlib.contextmanager
+def case_dir(work_dir, name):
+    """Run in a fresh folder so the scripts' default relative DB paths land there."""
+    path = os.path.join(work_dir, "runs", name)
+    if os.path.exists(path):
+        for entry in os.listdir(path):
+            os.remove(os.path.join(path, entry))
+    os.makedirs(path, exist_ok=True)
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    with quiet():
+        result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def scan_result(name, tree, files, seconds):
+    return {"name": name, "tree": tree, "files": files, "seconds": round(seconds, 4),
+            "files_per_second": round(files / seconds) if seconds else None}
+
+
+def op_result(name, tree, samples):
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"name": name, "tree": tree, "count": len(samples), "total_seconds": round(sum(samples), 4),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 4), "p50_ms": round(pick(0.5), 4),
+            "p95_ms": round(pick(0.95), 4), "max_ms": round(ordered[-1] * 1000, 4)}
+
+
+####################
+# BENCHMARKS
+####################
+
+def bench_walkers(tree, root):
+    from fastwalk import FastWalker
+
+    def os_walk_stat():
+        n = 0
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                os.stat(os.path.join(dirpath, filename))
+                n += 1
+        return n
+
+    seconds, n = timed(os_walk_stat)
+    results = [scan_result("walk.os_walk_stat", tree, n, seconds)]
+    seconds, n = timed(lambda: sum(1 for _ in FastWalker(root)))
+    results.append(scan_result("walk.fastwalk", tree, n, seconds))
+    return results
+
+
+def bench_allinone(tree, root, manifest, work_dir, args):
+    import allinone
+
+    results = []
+    allinone.params["small_file_threshold"] = allinone.params["small_file_threshold"] if args.hash else 0
+    allinone.params["batch_size"] = args.batch_files
+    with case_dir(work_dir, f"allinone_{tree}"):
+        with quiet():
+            conn = allinone.init_db(allinone.DB_PATH)
+        seconds, _ = timed(allinone.scan_and_add_files, conn, root)
+        results.append(scan_result("scan.allinone", tree, manifest["files"], seconds))
+        seconds, _ = timed(allinone.scan_and_add_files, conn, root)
+        results.append(scan_result("scan.allinone.rescan", tree, manifest["files"], seconds))
+
+        select, pushed, completed = [], [], []
+        for _ in range(args.db_batches):
+            manager = allinone.DynamicBatchManager(conn)
+            seconds, batch = timed(manager.get_next_file_batch)
+            if not batch:
+                break
+            select.append(seconds)
+            for entry in batch:
+                seconds, _ = timed(manager.mark_file_pushed, entry["path"], entry["id"])
+                pushed.append(seconds)
+            seconds, _ = timed(allinone.mark_pushed_files_completed, conn, manager.current_batch_id)
+            completed.append(seconds)
+            with quiet():
+                manager.complete_batch("completed")
+
+        counts = {"get_status_counts": lambda: allinone.get_status_counts(conn),
+                  "count_files_with_status": lambda: allinone.count_files_with_status(conn, ("pending", "failed")),
+                  "query_pending_files_count": allinone.query_pending_files_count}
+        if select:
+            results.append(op_result("db.get_next_file_batch", tree, select))
+            results.append(op_result("db.mark_file_pushed", tree, pushed))
+            results.append(op_result("db.mark_pushed_files_completed", tree, completed))
+        for name, fn in counts.items():
+            results.append(op_result(f"db.{name}", tree, [timed(fn)[0] for _ in range(args.count_repeat)]))
+        conn.close()
+    return results
+
+
+def bench_batch_adb_process(tree, root, manifest, work_dir):
+    import batchAdbProcess
+
+    with case_dir(work_dir, f"batchAdbProcess_{tree}"):
+        conn = batchAdbProcess.init_db()
+        seconds, _ = timed(batchAdbProcess.scan_and_prepare, conn, root)
+        conn.close()
+    return [scan_result("scan.batchAdbProcess", tree, manifest["files"], seconds)]
+
+
+def bench_allinonecmd(tree, root, manifest, work_dir):
+    import allinonecmd
+
+    with case_dir(work_dir, f"allinonecmd_{tree}"):
+        seconds, _ = timed(allinonecmd.scan_folder_cli, root)
+    return [scan_result("scan.allinonecmd", tree, manifest["files"], seconds)]
+
+
+####################
+# REPORTING
+####################
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {(r["name"], r["tree"]): r for r in baseline["results"]}
+        print(f"\nCompared with {baseline.get('commit', '?')[:10]} ({baseline.get('timestamp', '?')})")
+    print(f"\n{'benchmark':<34} {'tree':<14} {'value':>14} {'baseline':>14} {'ratio':>7}")
+    for r in results:
+        key = "seconds" if "seconds" in r else "mean_ms"
+        unit = "s" if key == "seconds" else "ms"
+        line = f"{r['name']:<34} {r['tree']:<14} {r[key]:>13.4f}{unit}"
+        old = previous.get((r["name"], r["tree"]))
+        if old and old.get(key):
+            line += f" {old[key]:>13.4f}{unit} {r[key] / old[key]:>6.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan and DB benchmarks on synthetic trees")
+    parser.add_argument("--sizes", default="10k", help="comma list of 10k,100k,1m or plain numbers")
+    parser.add_argument("--layouts", default="deep,flat", help="comma list of deep,flat")
+    parser.add_argument("--work-dir", default=os.path.join(REPO_DIR, "bench_work"),
+                        help="trees and scratch databases (trees are reused)")
+    parser.add_argument("--output", help="JSON result file (default bench_<commit>.json)")
+    parser.add_argument("--compare", help="earlier JSON result to compare against")
+    parser.add_argument("--only", default="walk,allinone,batchAdbProcess,allinonecmd",
+                        help="comma list of benchmark groups")
+    parser.add_argument("--db-batches", type=int, default=5, help="batches selected/pushed/completed")
+    parser.add_argument("--batch-files", type=int, default=500, help="files per batch for the DB benchmarks")
+    parser.add_argument("--count-repeat", type=int, default=20, help="repetitions of each count query")
+    parser.add_argument("--hash", action="store_true", help="hash small files during allinone scans")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    groups = set(args.only.split(","))
+    commit, dirty = git_revision()
+    results, trees = [], {}
+
+    for size in args.sizes.split(","):
+        count = SIZE_PRESETS.get(size.lower()) or int(size)
+        for layout in args.layouts.split(","):
+            if layout not in LAYOUTS:
+                parser.error(f"unknown layout {layout}")
+            root, manifest = build_tree(work_dir, layout, count, args.seed)
+            tree = f"{layout}_{size}"
+            trees[tree] = manifest
+            print(f"Benchmarking {tree} ...")
+            if "walk" in groups:
+                results += bench_walkers(tree, root)
+            if "allinone" in groups:
+                results += bench_allinone(tree, root, manifest, work_dir, args)
+            if "batchAdbProcess" in groups:
+                results += bench_batch_adb_process(tree, root, manifest, work_dir)
+            if "allinonecmd" in groups:
+                results += bench_allinonecmd(tree, root, manifest, work_dir)
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"sizes": args.sizes, "layouts": args.layouts, "hash": args.hash,
+                   "db_batches": args.db_batches, "batch_files": args.batch_files, "seed": args.seed},
+        "trees": trees,
+        "results": results,
+    }
+    output = args.output or f"bench_{(commit or 'nogit')[:10]}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
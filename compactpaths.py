@@ -0,0 +1,61 @@
+# Compact path and status-count helpers shared by the transfer scripts.
+#
+# allinone stores every directory prefix once in dirs (with its trailing
+# separator) and each file as (dir_id, name) in file_entries; files is a view
+# that rebuilds the full path. Both allinone and allinonecmd open the same
+# database, so they must split paths the same way the dirs rows were written
+# or a lookup silently misses.
+#
+# allinone also keeps per-status totals in file_status_counts, maintained by
+# triggers on file_entries. Reading that table is O(1); a COUNT(*) on files
+# walks every row, since status has no plain index any more.
+#
+# Usage:
+#     compact = uses_compact_paths(conn)
+#     if not file_exists(conn.cursor(), path, compact):
+#         ...
+#     counts = get_status_counts(conn)   # {status: (files, bytes)}
+
+import sqlite3
+
+# Read by get_status_counts; allinone --check-query-plans checks it stays off file_entries
+STATUS_COUNTS_SQL = "SELECT status, file_count, total_bytes FROM file_status_counts"
+STATUS_COUNTS_FALLBACK_SQL = "SELECT status, COUNT(*), COALESCE(SUM(size), 0) FROM files GROUP BY status"
+
+
+def uses_compact_paths(conn):
+    """True when the DB uses the dirs/file_entries layout (files is a view)"""
+    cur = conn.cursor()
+    cur.execute("SELECT type FROM sqlite_master WHERE name='files'")
+    row = cur.fetchone()
+    return bool(row) and row[0] == 'view'
+
+
+def split_file_path(path):
+    """Split into (directory prefix incl. separator, file name), as stored in dirs/file_entries"""
+    cut = max(path.rfind('/'), path.rfind('\\')) + 1
+    return path[:cut], path[cut:]
+
+
+def file_exists(cur, file_path, compact):
+    """Indexed lookup of a recorded path in either DB layout"""
+    if compact:
+        dir_prefix, name = split_file_path(file_path)
+        cur.execute("""
+            SELECT e.id FROM file_entries e JOIN dirs d ON d.id = e.dir_id
+            WHERE d.path=? AND e.name=?
+        """, (dir_prefix, name))
+    else:
+        cur.execute("SELECT id FROM files WHERE path=?", (file_path,))
+    return cur.fetchone() is not None
+
+
+def get_status_counts(conn):
+    """Files and bytes per status {status: (count, bytes)} from the trigger-maintained counters"""
+    cur = conn.cursor()
+    try:
+        cur.execute(STATUS_COUNTS_SQL)
+    except sqlite3.OperationalError:
+        # Counter table not created yet (old DB): fall back to a full count
+        cur.execute(STATUS_COUNTS_FALLBACK_SQL)
+    return {status: (count, total) for status, count, total in cur.fetchall()}